@@ -0,0 +1,63 @@
+"""formulario_empresa_compartida
+
+Revision ID: 3f9a6c2d1e7b
+Revises: 25f37ebdda4b
+Create Date: 2026-02-18 10:12:41.208733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a6c2d1e7b'
+down_revision = '25f37ebdda4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('formulario_empresa_compartida',
+    sa.Column('id_formulario', sa.Integer(), nullable=False),
+    sa.Column('id_empresa', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['id_empresa'], ['empresas.id_empresa'], ),
+    sa.ForeignKeyConstraint(['id_formulario'], ['formularios.id_formulario'], ),
+    sa.PrimaryKeyConstraint('id_formulario', 'id_empresa')
+    )
+    with op.batch_alter_table('formulario_empresa_compartida', schema=None) as batch_op:
+        batch_op.create_index('ix_formulario_empresa_compartida_empresa_formulario', ['id_empresa', 'id_formulario'], unique=False)
+
+    # Backfill desde la columna JSON compartir_con_empresas_ids
+    conn = op.get_bind()
+    formularios = sa.table('formularios',
+        sa.column('id_formulario', sa.Integer),
+        sa.column('compartir_con_empresas_ids', sa.JSON)
+    )
+    empresas = sa.table('empresas', sa.column('id_empresa', sa.Integer))
+    compartidas = sa.table('formulario_empresa_compartida',
+        sa.column('id_formulario', sa.Integer),
+        sa.column('id_empresa', sa.Integer)
+    )
+
+    empresas_existentes = {fila[0] for fila in conn.execute(sa.select(empresas.c.id_empresa))}
+    filas = []
+    for id_formulario, empresas_ids in conn.execute(sa.select(formularios.c.id_formulario, formularios.c.compartir_con_empresas_ids)):
+        vistos = set()
+        for id_empresa in empresas_ids or []:
+            try:
+                id_empresa = int(id_empresa)
+            except (TypeError, ValueError):
+                continue
+            if id_empresa in empresas_existentes and id_empresa not in vistos:
+                vistos.add(id_empresa)
+                filas.append({'id_formulario': id_formulario, 'id_empresa': id_empresa})
+
+    if filas:
+        op.bulk_insert(compartidas, filas)
+
+
+def downgrade():
+    with op.batch_alter_table('formulario_empresa_compartida', schema=None) as batch_op:
+        batch_op.drop_index('ix_formulario_empresa_compartida_empresa_formulario')
+
+    op.drop_table('formulario_empresa_compartida')
@@ -6,6 +6,8 @@ from .models import (
     Respuesta, Observacion, Notificacion, Concepto, Grado, Estudiante, TransaccionRecibo, DetalleRecibo 
 )
 from flask_admin.contrib.sqla import ModelView
+from .form_automation import programar_automatizacion
+from .form_access import registrar_formulario, quitar_formulario
 from flask_admin.model import typefmt
 from datetime import datetime
 
@@ -115,6 +117,24 @@ class FormularioView(ModelView):
         'tipos_respuesta_disponibles' # NUEVO: Relación muchos a muchos con TipoRespuesta
     ]
 
+    def on_model_change(self, form, model, is_created):
+        # NUEVO: Mantener next_automation_at al activar/desactivar la automatización desde el panel
+        programar_automatizacion(model)
+        # NUEVO: El acceso se resuelve con formulario_empresa_compartida: sincronizarla con el JSON editado
+        ids = model.compartir_con_empresas_ids if isinstance(model.compartir_con_empresas_ids, list) else []
+        ids = list(dict.fromkeys(ids))
+        if model.es_plantilla and not model.es_plantilla_global and ids:
+            model.empresas_compartidas = Empresa.query.filter(Empresa.id_empresa.in_(ids)).all()
+        else:
+            model.empresas_compartidas = []
+        model.compartir_con_empresas_ids = [e.id_empresa for e in model.empresas_compartidas]
+
+    def after_model_change(self, form, model, is_created):
+        registrar_formulario(model)
+
+    def after_model_delete(self, model):
+        quitar_formulario(model.id_formulario)
+
 class PreguntaView(ModelView):
     column_list = ['id_pregunta', 'texto_pregunta', 'formulario.nombre_formulario', 'tipo_respuesta.nombre_tipo', 'orden']
     column_searchable_list = ['texto_pregunta']
@@ -0,0 +1,160 @@
+# src/api/auth_cache.py
+
+# Caché del "principal" (usuario autenticado) para las rutas protegidas.
+# role_required y los handlers consultaban el mismo Usuario (y muchas veces su Empresa)
+# en cada petición. Aquí se resuelve una sola vez por petición (flask.g) a partir de una
+# caché en memoria acotada y con TTL, que se invalida cuando se editan, desactivan o
+# reactivan usuarios o empresas.
+
+import os
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from flask import g
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event
+
+from api.models import db, Usuario, Empresa
+
+
+PRINCIPAL_CACHE_TTL = int(os.getenv('PRINCIPAL_CACHE_TTL', 60))  # segundos
+PRINCIPAL_CACHE_MAX = int(os.getenv('PRINCIPAL_CACHE_MAX', 4096))  # entradas
+
+Principal = namedtuple('Principal', ['id_usuario', 'rol', 'id_empresa', 'usuario_activo', 'empresa_activo',
+                                     'revocado_desde', 'version_empresa'])
+
+_principales = OrderedDict()  # id_usuario -> (expira_en, Principal)
+_usuarios_serializados = OrderedDict()  # id_usuario -> (expira_en, dict de Usuario.serialize())
+_principales_lock = Lock()
+
+
+def _cargar_principal(user_id):
+    """
+    Consulta en una sola query los datos de identidad del usuario y el estado de su empresa.
+    """
+    fila = db.session.query(
+        Usuario.id_usuario, Usuario.rol, Usuario.id_empresa, Usuario.activo, Empresa.activo,
+        Usuario.tokens_revocados_desde, Empresa.version_estado
+    ).outerjoin(Empresa, Usuario.id_empresa == Empresa.id_empresa).filter(
+        Usuario.id_usuario == user_id
+    ).first()
+
+    if not fila:
+        return None
+
+    id_usuario, rol, id_empresa, usuario_activo, empresa_activo, revocado_desde, version_empresa = fila
+    # Un usuario sin empresa (ej. owner) se considera con empresa activa
+    return Principal(id_usuario, rol, id_empresa, bool(usuario_activo), True if id_empresa is None else bool(empresa_activo),
+                     revocado_desde, version_empresa or 0)
+
+
+def obtener_principal(user_id):
+    """
+    Devuelve el Principal de un usuario desde la caché, cargándolo de la base de datos si no existe o expiró.
+    """
+    user_id = int(user_id)
+    ahora = time.monotonic()
+
+    with _principales_lock:
+        entrada = _principales.get(user_id)
+        if entrada and entrada[0] > ahora:
+            _principales.move_to_end(user_id)
+            return entrada[1]
+
+    principal = _cargar_principal(user_id)
+    if principal is None:
+        # No se cachean usuarios inexistentes
+        return None
+
+    with _principales_lock:
+        _principales[user_id] = (ahora + PRINCIPAL_CACHE_TTL, principal)
+        _principales.move_to_end(user_id)
+        while len(_principales) > PRINCIPAL_CACHE_MAX:
+            _principales.popitem(last=False)
+    return principal
+
+
+def get_current_principal():
+    """
+    Devuelve el Principal del usuario del JWT actual, resuelto una sola vez por petición.
+    Debe llamarse dentro de una ruta protegida con @jwt_required() o @role_required().
+    La verificación de revocación (token_registry) ya lo dejó en la caché, así que normalmente no consulta la base de datos.
+    """
+    if 'principal' not in g:
+        current_user_id = get_jwt_identity()
+        g.principal = obtener_principal(current_user_id) if current_user_id is not None else None
+    return g.principal
+
+
+def get_current_usuario():
+    """
+    Devuelve la instancia Usuario del JWT actual, cargada una sola vez por petición.
+    """
+    if 'usuario_actual' not in g:
+        principal = get_current_principal()
+        g.usuario_actual = db.session.get(Usuario, principal.id_usuario) if principal else None
+    return g.usuario_actual
+
+
+def obtener_usuario_serializado(user_id):
+    """
+    Devuelve Usuario.serialize() desde la caché (usado por /verificar-token, que el frontend consulta en cada navegación).
+    """
+    user_id = int(user_id)
+    ahora = time.monotonic()
+
+    with _principales_lock:
+        entrada = _usuarios_serializados.get(user_id)
+        if entrada and entrada[0] > ahora:
+            _usuarios_serializados.move_to_end(user_id)
+            return entrada[1]
+
+    usuario = db.session.get(Usuario, user_id)
+    if not usuario:
+        return None
+    datos = usuario.serialize()
+
+    with _principales_lock:
+        _usuarios_serializados[user_id] = (ahora + PRINCIPAL_CACHE_TTL, datos)
+        _usuarios_serializados.move_to_end(user_id)
+        while len(_usuarios_serializados) > PRINCIPAL_CACHE_MAX:
+            _usuarios_serializados.popitem(last=False)
+    return datos
+
+
+def invalidar_principal_usuario(*user_ids):
+    """
+    Elimina de la caché a los usuarios indicados. Llamar después de editarlos, desactivarlos o eliminarlos.
+    """
+    with _principales_lock:
+        for user_id in user_ids:
+            _principales.pop(int(user_id), None)
+            _usuarios_serializados.pop(int(user_id), None)
+
+
+def invalidar_principal_empresa(empresa_id):
+    """
+    Elimina de la caché a todos los usuarios de una empresa. Llamar después de editar,
+    desactivar, reactivar o eliminar la empresa.
+    """
+    empresa_id = int(empresa_id)
+    with _principales_lock:
+        for user_id in [uid for uid, (_, p) in _principales.items() if p.id_empresa == empresa_id]:
+            del _principales[user_id]
+        for user_id in [uid for uid, (_, d) in _usuarios_serializados.items() if d.get('id_empresa') == empresa_id]:
+            del _usuarios_serializados[user_id]
+
+
+# El perfil serializado cambia desde muchas rutas (perfil, imagen, firma, favoritos, contraseña, admin),
+# por eso se invalida a nivel de mapper cada vez que se escribe un Usuario o una Empresa.
+@event.listens_for(Usuario, 'after_update')
+@event.listens_for(Usuario, 'after_delete')
+def _invalidar_usuario_escrito(mapper, connection, target):
+    invalidar_principal_usuario(target.id_usuario)
+
+
+@event.listens_for(Empresa, 'after_update')
+@event.listens_for(Empresa, 'after_delete')
+def _invalidar_empresa_escrita(mapper, connection, target):
+    invalidar_principal_empresa(target.id_empresa)
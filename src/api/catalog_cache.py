@@ -0,0 +1,62 @@
+# src/api/catalog_cache.py
+
+# Caché de lectura (read-through) para catálogos casi estáticos: tipos de respuesta,
+# grados, conceptos y categorías de documentos. La primera petición arma el payload JSON
+# y lo guarda por catálogo y empresa; las siguientes lo devuelven sin consultar la BD.
+# Las rutas POST/PUT/DELETE de cada catálogo invalidan su entrada después del commit y
+# el TTL acota la desincronización entre procesos. Cada entrada guarda también un ETag,
+# de modo que el navegador puede revalidar y recibir 304 sin volver a descargar la lista.
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+
+CATALOGO_CACHE_TTL = int(os.getenv('CATALOGO_CACHE_TTL', 300))  # segundos
+# Segundos que el navegador puede reutilizar la respuesta sin revalidar (0 = revalidar siempre con ETag)
+CATALOGO_MAX_AGE = int(os.getenv('CATALOGO_MAX_AGE', 0))
+
+# Catálogos globales (no dependen de la empresa)
+TIPOS_RESPUESTA = 'tipos_respuesta'
+DOCUMENTOS = 'documentos'
+# Catálogos por empresa
+GRADOS = 'grados'
+CONCEPTOS = 'conceptos'
+
+_catalogos = {}  # (nombre, id_empresa) -> (expira, payload, etag)
+_catalogos_lock = Lock()
+
+
+def _calcular_etag(payload):
+    crudo = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(crudo.encode('utf-8')).hexdigest()
+
+
+def obtener_catalogo(nombre, cargar, id_empresa=None):
+    """
+    Devuelve (payload, etag) del catálogo `nombre` para la empresa dada.
+    Si no está en caché (o expiró) llama a `cargar()`, que debe devolver un dict serializable.
+    """
+    clave = (nombre, id_empresa)
+    ahora = time.monotonic()
+    with _catalogos_lock:
+        entrada = _catalogos.get(clave)
+        if entrada and entrada[0] > ahora:
+            return entrada[1], entrada[2]
+
+    # La consulta se hace fuera del lock; si dos peticiones cargan a la vez, gana la última
+    payload = cargar()
+    etag = _calcular_etag(payload)
+    with _catalogos_lock:
+        _catalogos[clave] = (ahora + CATALOGO_CACHE_TTL, payload, etag)
+    return payload, etag
+
+
+def invalidar_catalogo(nombre, id_empresa=None):
+    """
+    Descarta el catálogo de una empresa (o el global si id_empresa es None). Llamar después del commit.
+    """
+    with _catalogos_lock:
+        _catalogos.pop((nombre, id_empresa), None)
@@ -0,0 +1,231 @@
+# src/api/cloudinary_client.py
+
+# Cliente compartido para Cloudinary. Todas las llamadas (upload, upload_large, destroy) pasan por aquí:
+#   - Pool de conexiones keep-alive (urllib3) reutilizado entre peticiones y hilos.
+#   - Timeout de conexión y de lectura en cada llamada: un proveedor lento ya no deja al worker colgado.
+#   - Semáforo de concurrencia: como máximo CLOUDINARY_CONCURRENCIA llamadas a la vez por proceso; si
+#     no hay cupo en CLOUDINARY_ESPERA_CUPO segundos la llamada falla de inmediato.
+#   - Circuit breaker: si la tasa de errores en las últimas llamadas supera el umbral, el circuito se
+#     abre y las llamadas fallan al instante (ProveedorNoDisponible) durante CLOUDINARY_ENFRIAMIENTO
+#     segundos; después se deja pasar una llamada de prueba. Los envíos de formularios y las firmas
+#     usan la cola de subida diferida mientras el circuito está abierto.
+#   - Métricas de latencia y fallos (metricas_cloudinary), expuestas en /api/metricas/almacenamiento.
+
+import os
+import time
+from collections import deque
+from threading import BoundedSemaphore, Lock
+
+import cloudinary
+import cloudinary.uploader
+import urllib3
+from cloudinary.exceptions import BadRequest, NotFound, AlreadyExists
+
+
+CLOUDINARY_TIMEOUT_CONEXION = float(os.getenv('CLOUDINARY_TIMEOUT_CONEXION', 5))
+CLOUDINARY_TIMEOUT = float(os.getenv('CLOUDINARY_TIMEOUT', 60))  # lectura, por llamada
+CLOUDINARY_POOL = int(os.getenv('CLOUDINARY_POOL', 10))  # conexiones keep-alive por host
+CLOUDINARY_CONCURRENCIA = int(os.getenv('CLOUDINARY_CONCURRENCIA', 8))
+CLOUDINARY_ESPERA_CUPO = float(os.getenv('CLOUDINARY_ESPERA_CUPO', 10))
+CLOUDINARY_VENTANA = int(os.getenv('CLOUDINARY_VENTANA', 20))  # últimas llamadas consideradas por el breaker
+CLOUDINARY_MIN_LLAMADAS = int(os.getenv('CLOUDINARY_MIN_LLAMADAS', 5))
+CLOUDINARY_UMBRAL_FALLOS = float(os.getenv('CLOUDINARY_UMBRAL_FALLOS', 0.5))
+CLOUDINARY_ENFRIAMIENTO = float(os.getenv('CLOUDINARY_ENFRIAMIENTO', 30))
+
+_MUESTRAS_LATENCIA = 500
+
+# Errores del cliente (archivo inválido, recurso inexistente): el proveedor respondió, no abren el circuito
+_ERRORES_DEL_CLIENTE = (BadRequest, NotFound, AlreadyExists)
+
+
+class ProveedorNoDisponible(Exception):
+    """
+    La llamada no se hizo: el circuito está abierto o no hubo cupo de concurrencia.
+    """
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, ventana, min_llamadas, umbral, enfriamiento):
+        self.min_llamadas = min_llamadas
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self._resultados = deque(maxlen=ventana)  # True = éxito
+        self._abierto_desde = None
+        self._prueba_en_curso = False
+        self._lock = Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            return self._estado()
+
+    def _estado(self):
+        if self._abierto_desde is None:
+            return 'cerrado'
+        if time.monotonic() - self._abierto_desde >= self.enfriamiento:
+            return 'semiabierto'
+        return 'abierto'
+
+    def disponible(self):
+        """
+        Indica si una llamada pasaría ahora, sin reservar la llamada de prueba.
+        """
+        with self._lock:
+            estado = self._estado()
+            return estado == 'cerrado' or (estado == 'semiabierto' and not self._prueba_en_curso)
+
+    def permitir(self):
+        with self._lock:
+            estado = self._estado()
+            if estado == 'cerrado':
+                return True
+            if estado == 'semiabierto' and not self._prueba_en_curso:
+                # Una sola llamada de prueba; el resto sigue fallando rápido hasta conocer su resultado
+                self._prueba_en_curso = True
+                return True
+            return False
+
+    def registrar(self, exito):
+        with self._lock:
+            if self._prueba_en_curso:
+                self._prueba_en_curso = False
+                if exito:
+                    self._abierto_desde = None
+                    self._resultados.clear()
+                else:
+                    self._abierto_desde = time.monotonic()
+                return
+            self._resultados.append(exito)
+            fallos = self._resultados.count(False)
+            if (self._abierto_desde is None and len(self._resultados) >= self.min_llamadas
+                    and fallos / len(self._resultados) >= self.umbral):
+                self._abierto_desde = time.monotonic()
+                print(f"ADVERTENCIA: Circuito de Cloudinary abierto ({fallos}/{len(self._resultados)} fallos recientes).")
+
+
+class Metricas:
+    def __init__(self):
+        self._lock = Lock()
+        self._contadores = {"llamadas": 0, "exitos": 0, "fallos": 0, "timeouts": 0,
+                            "rechazos_circuito": 0, "rechazos_cupo": 0}
+        self._latencias = deque(maxlen=_MUESTRAS_LATENCIA)  # segundos de las últimas llamadas completadas
+        self._ultimo_error = None
+
+    def contar(self, nombre):
+        with self._lock:
+            self._contadores[nombre] += 1
+
+    def registrar(self, segundos, error=None, timeout=False):
+        with self._lock:
+            self._contadores["llamadas"] += 1
+            self._latencias.append(segundos)
+            if error is None:
+                self._contadores["exitos"] += 1
+            else:
+                self._contadores["fallos"] += 1
+                self._ultimo_error = error
+                if timeout:
+                    self._contadores["timeouts"] += 1
+
+    def resumen(self):
+        with self._lock:
+            latencias = sorted(self._latencias)
+            datos = dict(self._contadores)
+            datos["ultimo_error"] = self._ultimo_error
+
+        def percentil(p):
+            if not latencias:
+                return None
+            return round(latencias[min(len(latencias) - 1, int(p * len(latencias)))] * 1000, 1)
+
+        datos["latencia_ms"] = {"p50": percentil(0.5), "p95": percentil(0.95), "max": percentil(1.0),
+                                "muestras": len(latencias)}
+        return datos
+
+
+class ClienteCloudinary:
+    def __init__(self):
+        self.breaker = CircuitBreaker(CLOUDINARY_VENTANA, CLOUDINARY_MIN_LLAMADAS,
+                                      CLOUDINARY_UMBRAL_FALLOS, CLOUDINARY_ENFRIAMIENTO)
+        self.metricas = Metricas()
+        self._cupos = BoundedSemaphore(CLOUDINARY_CONCURRENCIA)
+        self._timeout = urllib3.Timeout(connect=CLOUDINARY_TIMEOUT_CONEXION, read=CLOUDINARY_TIMEOUT)
+        self._instalar_pool()
+
+    def _instalar_pool(self):
+        # El SDK hace todas sus llamadas con el PoolManager del módulo uploader; se reemplaza por uno
+        # con más conexiones reutilizables y sin reintentos propios (los maneja la cola diferida)
+        config = cloudinary.config()
+        if getattr(config, 'api_proxy', None):
+            return
+        cloudinary.uploader._http = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=CLOUDINARY_POOL,
+            retries=False,
+            timeout=self._timeout,
+            **cloudinary.CERT_KWARGS
+        )
+
+    def _llamar(self, funcion, *args, **opciones):
+        # Con el circuito abierto no se espera cupo: se falla de inmediato
+        if not self.breaker.disponible():
+            self.metricas.contar("rechazos_circuito")
+            raise ProveedorNoDisponible("Cloudinary no está disponible en este momento (circuito abierto).")
+        if not self._cupos.acquire(timeout=CLOUDINARY_ESPERA_CUPO):
+            self.metricas.contar("rechazos_cupo")
+            raise ProveedorNoDisponible("Demasiadas subidas simultáneas a Cloudinary; intenta de nuevo.")
+        if not self.breaker.permitir():
+            self._cupos.release()
+            self.metricas.contar("rechazos_circuito")
+            raise ProveedorNoDisponible("Cloudinary no está disponible en este momento (circuito abierto).")
+        inicio = time.monotonic()
+        try:
+            opciones.setdefault('timeout', self._timeout)
+            resultado = funcion(*args, **opciones)
+        except Exception as e:
+            es_timeout = isinstance(e, urllib3.exceptions.TimeoutError) or 'timed out' in str(e).lower()
+            self.metricas.registrar(time.monotonic() - inicio, str(e)[:300], es_timeout)
+            self.breaker.registrar(isinstance(e, _ERRORES_DEL_CLIENTE))
+            raise
+        finally:
+            self._cupos.release()
+        self.metricas.registrar(time.monotonic() - inicio)
+        self.breaker.registrar(True)
+        return resultado
+
+    def upload(self, archivo, **opciones):
+        return self._llamar(cloudinary.uploader.upload, archivo, **opciones)
+
+    def upload_large(self, ruta, **opciones):
+        return self._llamar(cloudinary.uploader.upload_large, ruta, **opciones)
+
+    def destroy(self, public_id, **opciones):
+        return self._llamar(cloudinary.uploader.destroy, public_id, **opciones)
+
+
+_cliente = None
+_cliente_lock = Lock()
+
+
+def obtener_cliente():
+    global _cliente
+    with _cliente_lock:
+        if _cliente is None:
+            _cliente = ClienteCloudinary()
+        return _cliente
+
+
+def cloudinary_disponible():
+    """
+    False mientras el circuito esté abierto: conviene encolar en lugar de intentar subir.
+    """
+    return obtener_cliente().breaker.disponible()
+
+
+def metricas_cloudinary():
+    cliente = obtener_cliente()
+    datos = cliente.metricas.resumen()
+    datos["circuito"] = cliente.breaker.estado
+    datos["concurrencia_max"] = CLOUDINARY_CONCURRENCIA
+    return datos
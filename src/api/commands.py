@@ -42,4 +42,323 @@ def setup_commands(app):
         # Aquí puedes añadir lógica para insertar otros tipos de datos de prueba
         # como empresas, espacios, formularios, etc.
         print("Insertando datos de prueba adicionales (vacío por ahora)...")
-        pass
\ No newline at end of file
+        pass
+
+    @app.cli.command("benchmark-submit")
+    @click.option("--dibujos", default=12, help="Preguntas de tipo dibujo en el formulario de prueba.")
+    @click.option("--envios", default=30, help="Envíos a medir por configuración.")
+    @click.option("--latencia-ms", default=150, help="Latencia simulada por subida en el servidor falso.")
+    def benchmark_submit(dibujos, envios, latencia_ms):
+        """
+        Mide la latencia de POST /api/envios-formulario (p50/p95) contra un servidor de
+        almacenamiento falso local, con subidas secuenciales (1 hilo) y en paralelo.
+        Crea datos temporales en la BD configurada y los elimina al terminar.
+        """
+        import base64
+        import json
+        import os
+        import statistics
+        import threading
+        import time
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        import cloudinary
+        from flask_jwt_extended import create_access_token
+
+        from api.models import Empresa, Formulario, Pregunta, TipoRespuesta, EnvioFormulario, Respuesta, MediaHash
+        from api.media_uploads import reiniciar_pool, MEDIA_UPLOAD_WORKERS
+        from api.token_registry import claims_para_usuario
+
+        class StorageFalso(BaseHTTPRequestHandler):
+            contador = 0
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latencia_ms / 1000.0)
+                StorageFalso.contador += 1
+                cuerpo = json.dumps({
+                    "public_id": f"bench_{StorageFalso.contador}",
+                    "secure_url": f"https://storage.local/bench_{StorageFalso.contador}.png"
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        servidor = ThreadingHTTPServer(('127.0.0.1', 0), StorageFalso)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        config_original = {k: getattr(cloudinary.config(), k, None) for k in ('upload_prefix', 'cloud_name', 'api_key', 'api_secret')}
+        cloudinary.config(upload_prefix=f"http://127.0.0.1:{servidor.server_address[1]}",
+                          cloud_name='bench', api_key='bench', api_secret='bench')
+
+        tipo_dibujo = TipoRespuesta.query.filter_by(nombre_tipo='dibujo').first()
+        if not tipo_dibujo:
+            print("No existe el tipo de respuesta 'dibujo'. Ejecuta primero POST /api/tipos-respuesta/seed.")
+            servidor.shutdown()
+            return
+
+        marca = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        empresa = Empresa(nombre_empresa=f"Benchmark {marca}")
+        db.session.add(empresa)
+        db.session.flush()
+        usuario = Usuario(
+            id_empresa=empresa.id_empresa,
+            email=f"benchmark_{marca}@test.com",
+            contrasena_hash=generate_password_hash("123456"),
+            nombre_completo="Usuario Benchmark",
+            rol="admin_empresa"
+        )
+        db.session.add(usuario)
+        db.session.flush()
+        formulario = Formulario(
+            id_empresa=empresa.id_empresa,
+            nombre_formulario=f"Benchmark dibujos {marca}",
+            creado_por_usuario_id=usuario.id_usuario,
+            max_submissions_per_period=envios * 2 + 10,
+            submission_period_days=1,
+            compartir_con_empresas_ids=[]
+        )
+        db.session.add(formulario)
+        db.session.flush()
+        preguntas = [Pregunta(id_formulario=formulario.id_formulario, texto_pregunta=f"Dibujo {i + 1}",
+                              tipo_respuesta_id=tipo_dibujo.id_tipo_respuesta, orden=i + 1)
+                     for i in range(dibujos)]
+        db.session.add_all(preguntas)
+        db.session.commit()
+
+        def nuevo_payload():
+            # Contenido aleatorio en cada dibujo: la deduplicación por contenido no debe evitar las subidas medidas
+            return {
+                "id_formulario": formulario.id_formulario,
+                "respuestas": [{
+                    "pregunta_id": p.id_pregunta,
+                    "firma_base64_list": ["data:image/png;base64," + base64.b64encode(os.urandom(2048)).decode('ascii')]
+                } for p in preguntas]
+            }
+
+        token = create_access_token(identity=str(usuario.id_usuario), additional_claims=claims_para_usuario(usuario))
+        cliente = app.test_client()
+
+        def medir(hilos):
+            reiniciar_pool(hilos)
+            tiempos = []
+            for _ in range(envios):
+                payload = nuevo_payload()
+                inicio = time.perf_counter()
+                respuesta = cliente.post('/api/envios-formulario', json=payload, headers={"Authorization": f"Bearer {token}"})
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+                if respuesta.status_code != 201:
+                    print(f"  Envío fallido ({respuesta.status_code}): {respuesta.get_json()}")
+            tiempos.sort()
+            p95 = tiempos[max(0, int(round(0.95 * len(tiempos))) - 1)]
+            print(f"  hilos={hilos:<3} p50={statistics.median(tiempos):8.1f} ms  p95={p95:8.1f} ms  max={tiempos[-1]:8.1f} ms")
+
+        hilos_paralelo = MEDIA_UPLOAD_WORKERS
+        print(f"Benchmark submit_formulario: {dibujos} dibujos por envío, {envios} envíos, {latencia_ms} ms por subida")
+        try:
+            medir(1)
+            medir(hilos_paralelo)
+        finally:
+            reiniciar_pool(hilos_paralelo)
+            servidor.shutdown()
+            cloudinary.config(**config_original)
+            # Limpieza de los datos temporales
+            envios_ids = [e.id_envio for e in EnvioFormulario.query.filter_by(id_formulario=formulario.id_formulario).all()]
+            if envios_ids:
+                Respuesta.query.filter(Respuesta.id_envio.in_(envios_ids)).delete(synchronize_session=False)
+                EnvioFormulario.query.filter(EnvioFormulario.id_envio.in_(envios_ids)).delete(synchronize_session=False)
+            db.session.query(MediaHash).filter(MediaHash.url.like('https://storage.local/bench_%')).delete(synchronize_session=False)
+            Pregunta.query.filter_by(id_formulario=formulario.id_formulario).delete(synchronize_session=False)
+            Formulario.query.filter_by(id_formulario=formulario.id_formulario).delete(synchronize_session=False)
+            Usuario.query.filter_by(id_usuario=usuario.id_usuario).delete(synchronize_session=False)
+            Empresa.query.filter_by(id_empresa=empresa.id_empresa).delete(synchronize_session=False)
+            db.session.commit()
+
+    @app.cli.command("benchmark-mail")
+    @click.option("--mensajes", default=200, help="Correos a enviar por configuración.")
+    @click.option("--sesiones", default=None, type=int, help="Sesiones SMTP / hilos (por defecto CORREO_SESIONES).")
+    @click.option("--latencia-ms", default=80, help="Costo simulado de abrir una sesión (handshake TLS + login).")
+    @click.option("--limite-por-minuto", default=0, help="Límite de destinatarios por minuto del envío masivo (0 = sin límite).")
+    def benchmark_mail(mensajes, sesiones, latencia_ms, limite_por_minuto):
+        """
+        Compara una conexión SMTP por correo (mail.send) con el envío masivo sobre sesiones reutilizadas,
+        contra un servidor SMTP local. Uno de cada 10 correos lleva además un destinatario que el
+        servidor rechaza, para verificar el reporte por destinatario. No toca la BD ni envía correos reales.
+        """
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        from flask_mail import Mail, Message
+
+        from api.smtp_bulk import PoolSMTP, CORREO_SESIONES
+        from api.smtp_local import ServidorSMTPLocal
+
+        sesiones = sesiones or CORREO_SESIONES
+        servidor = ServidorSMTPLocal(latencia_conexion=latencia_ms / 1000.0).iniciar()
+        mail_local = Mail().init_mail({
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': servidor.puerto,
+            'MAIL_USE_SSL': False,
+            'MAIL_USE_TLS': False,
+            'MAIL_USERNAME': None,
+            'MAIL_PASSWORD': None,
+            'MAIL_SUPPRESS_SEND': False
+        })
+
+        def nuevos_mensajes():
+            lista = []
+            for i in range(mensajes):
+                destinatarios = [f"usuario_{i}@bench.local"]
+                if i % 10 == 0:
+                    destinatarios.append(f"rechazar_{i}@bench.local")
+                msg = Message(f"Benchmark {i}", sender=("AuditEase", "benchmark@bench.local"), recipients=destinatarios)
+                msg.body = "Correo de prueba del benchmark de envío masivo."
+                lista.append(msg)
+            return lista
+
+        def enviar_uno(msg):
+            with app.app_context():
+                try:
+                    mail_local.send(msg)
+                    return None
+                except Exception as e:
+                    return f"{type(e).__name__}: {e}"
+
+        def reportar(nombre, segundos, errores, rechazados):
+            datos = servidor.contadores
+            print(f"  {nombre:<24} {segundos:7.2f} s  {mensajes / segundos:8.1f} correos/s  "
+                  f"conexiones={datos['conexiones']:<4} entregados={datos['entregados']:<5} "
+                  f"rechazos={rechazados:<4} errores={errores}")
+
+        print(f"Benchmark de correo: {mensajes} correos, {sesiones} hilo(s)/sesión(es), "
+              f"{latencia_ms} ms por conexión nueva")
+        try:
+            servidor.reiniciar_contadores()
+            lote = nuevos_mensajes()
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=sesiones) as hilos:
+                errores = list(hilos.map(enviar_uno, lote))
+            # smtplib.sendmail no lanza excepción por un rechazo parcial: mail.send los pierde sin aviso
+            reportar("mail.send por correo", time.perf_counter() - inicio,
+                     sum(1 for e in errores if e), 0)
+
+            servidor.reiniciar_contadores()
+            pool = PoolSMTP(app, mail=mail_local, sesiones=sesiones, limite_por_minuto=limite_por_minuto)
+            lote = nuevos_mensajes()
+            inicio = time.perf_counter()
+            resultados = pool.enviar_lote(lote)
+            segundos = time.perf_counter() - inicio
+            pool.cerrar()
+            reportar("sesiones reutilizadas", segundos,
+                     sum(1 for r in resultados if r["error"]),
+                     sum(len(r["rechazados"]) for r in resultados))
+        finally:
+            servidor.shutdown()
+            servidor.server_close()
+
+    @app.cli.command("benchmark-plantillas")
+    @click.option("--correos", default=1000, help="Recibos a renderizar por medición.")
+    @click.option("--items", default=5, help="Filas de detalle por recibo.")
+    def benchmark_plantillas(correos, items):
+        """
+        Mide el costo de render por correo de la plantilla de recibo: compilación en frío,
+        render uno por uno y render por lotes. No consulta la BD (la marca va en el contexto).
+        """
+        import time
+
+        from api.email_templates import precompilar, reiniciar_plantillas, renderizar, renderizar_lote, LOGO_POR_DEFECTO
+
+        marca = {"nombre": "Colegio Benchmark", "logo_url": LOGO_POR_DEFECTO}
+        contextos = [{
+            "marca": marca,
+            "recibo_id": i,
+            "fecha": datetime.utcnow().strftime('%d/%m/%Y %H:%M:%S'),
+            "tipo_pago": 'Abono' if i % 2 else 'Total',
+            "asunto_tipo": "Recibo de Abono" if i % 2 else "Recibo de Pago Total",
+            "registrado_por": "Usuario Benchmark",
+            "items": [{"concepto": f"Concepto {j}", "estudiante": f"Estudiante <{i}-{j}>", "grado": "5A",
+                       "valor_unitario": 125000.0, "cantidad": 1, "subtotal": 125000.0} for j in range(items)],
+            "monto_pagado": 125000.0 * items,
+            "saldo_pendiente": 0.0,
+            "observaciones": None
+        } for i in range(correos)]
+
+        reiniciar_plantillas()
+        inicio = time.perf_counter()
+        precompilar()
+        compilacion = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        for contexto in contextos:
+            renderizar('recibo', contexto)
+        uno_a_uno = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        resultados = renderizar_lote('recibo', contextos)
+        lote = time.perf_counter() - inicio
+
+        tamano = sum(len(r["html"]) for r in resultados) / len(resultados)
+        print(f"Benchmark de plantillas: {correos} recibos de {items} fila(s), ~{tamano / 1024:.1f} KB de HTML c/u")
+        print(f"  compilación (todas las plantillas, una vez): {compilacion * 1000:8.2f} ms")
+        print(f"  render uno por uno:                          {uno_a_uno / correos * 1e6:8.1f} µs/correo")
+        print(f"  render por lotes:                            {lote / correos * 1e6:8.1f} µs/correo")
+
+    @app.cli.command("smtp-local")
+    @click.option("--puerto", default=1025, help="Puerto en 127.0.0.1.")
+    @click.option("--latencia-ms", default=0, help="Costo simulado de abrir una sesión.")
+    def smtp_local(puerto, latencia_ms):
+        """
+        Servidor SMTP local que acepta y descarta los correos (desarrollo y benchmarks).
+        Configurar MAIL_SERVER=127.0.0.1 MAIL_PORT=<puerto> MAIL_USE_SSL=0 en el proceso que envía.
+        """
+        from api.smtp_local import ServidorSMTPLocal
+
+        servidor = ServidorSMTPLocal(puerto=puerto, latencia_conexion=latencia_ms / 1000.0)
+        print(f"Servidor SMTP local en 127.0.0.1:{servidor.puerto} (Ctrl+C para detener).")
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            servidor.server_close()
+            print(f"Resumen: {servidor.contadores}")
+
+    @app.cli.command("media-worker")
+    def media_worker():
+        """
+        Ejecuta en primer plano el worker que sube las imágenes en cola (modo de subida diferida).
+        Útil para correrlo como proceso aparte con MEDIA_WORKER_EN_WEB=0.
+        """
+        from api.media_queue import ejecutar_worker_media
+        ejecutar_worker_media(app)
+
+    @app.cli.command("mail-worker")
+    def mail_worker():
+        """
+        Ejecuta en primer plano el worker que envía los correos de la bandeja de salida.
+        Útil para correrlo como proceso aparte con CORREO_WORKER_EN_WEB=0.
+        """
+        from api.mail_outbox import ejecutar_worker_correo
+        ejecutar_worker_correo(app)
+
+    @app.cli.command("notification-worker")
+    def notification_worker():
+        """
+        Ejecuta en primer plano el despachador de notificaciones programadas.
+        Útil para correrlo como proceso aparte con NOTIFICACION_WORKER_EN_WEB=0; se pueden correr varios.
+        """
+        from api.notification_dispatcher import ejecutar_worker_notificaciones
+        ejecutar_worker_notificaciones(app)
+
+    @app.cli.command("automation-worker")
+    def automation_worker():
+        """
+        Ejecuta la automatización de llenado de formularios. Se pueden correr varias instancias:
+        solo una (el líder) ejecuta y las demás toman el relevo si se detiene.
+        """
+        from api.form_automation import ejecutar_worker_automatizacion
+        ejecutar_worker_automatizacion(app)
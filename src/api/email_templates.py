@@ -0,0 +1,206 @@
+# src/api/email_templates.py
+
+# Plantillas Jinja de los correos (recibo, anulación de recibo, recuperación de contraseña, contacto y
+# notificaciones programadas) en src/api/templates/correos. Cada plantilla se compila una sola vez por proceso (precompilar() al
+# arrancar) y el entorno no revisa los archivos en cada render (auto_reload=False).
+# Las rutas solo encolan el contexto del correo (mail_outbox.encolar_plantilla); el worker de la bandeja
+# de salida renderiza los cuerpos por lotes con renderizar_lote justo antes de enviar, fuera de la petición.
+# El nombre, el logo y la configuración de correo de cada empresa salen de una caché con TTL
+# (marca_empresa), que las rutas de edición de empresa invalidan después del commit.
+
+import os
+import time
+from threading import Lock
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined, select_autoescape
+
+from api.models import Empresa
+
+
+CORREO_MARCA_TTL = int(os.getenv('CORREO_MARCA_TTL', 300))  # segundos
+# Logo de los correos de las empresas que no han subido uno
+LOGO_POR_DEFECTO = "https://i.pinimg.com/736x/44/12/e9/4412e9bdd73724a178b18295e4ba921e.jpg"
+
+_DIRECTORIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'correos')
+
+# tipo -> asunto (plantilla en línea) y archivos del cuerpo HTML / texto
+CORREOS = {
+    'recibo': {
+        'asunto': "{{ asunto_tipo }} #{{ recibo_id }} - {{ marca.nombre }}",
+        'html': 'recibo.html',
+        'texto': 'recibo.txt'
+    },
+    'recibo_resumen': {
+        'asunto': "Resumen de {{ recibos | length }} recibos - {{ marca.nombre }}",
+        'html': 'recibo_resumen.html',
+        'texto': 'recibo_resumen.txt'
+    },
+    'anulacion_recibo': {
+        'asunto': "ANULACIÓN de Recibo #{{ recibo_id }} - {{ marca.nombre }}",
+        'html': 'anulacion_recibo.html',
+        'texto': 'anulacion_recibo.txt'
+    },
+    'recuperacion_password': {
+        'asunto': "Recuperación de Contraseña",
+        'html': None,
+        'texto': 'recuperacion_password.txt'
+    },
+    'contacto': {
+        'asunto': "Nueva solicitud de empresa: {{ company_name }}",
+        'html': None,
+        'texto': 'contacto.txt'
+    },
+    'notificacion': {
+        'asunto': "{{ tipo_notificacion }}: {{ nombre_formulario }} - {{ marca.nombre }}",
+        'html': None,
+        'texto': 'notificacion.txt'
+    }
+}
+
+
+class PlantillaInvalida(Exception):
+    """
+    El tipo de correo no existe o al contexto le falta un dato que usa la plantilla.
+    """
+    pass
+
+
+def _moneda(valor):
+    return f"${float(valor or 0):.2f}"
+
+
+_entorno = Environment(
+    loader=FileSystemLoader(_DIRECTORIO),
+    autoescape=select_autoescape(['html'], default_for_string=False),
+    undefined=StrictUndefined,
+    auto_reload=False,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    cache_size=-1
+)
+_entorno.filters['moneda'] = _moneda
+
+_compiladas = {}  # tipo -> (asunto, html, texto) ya compiladas
+_compiladas_lock = Lock()
+
+
+def precompilar():
+    """
+    Compila todas las plantillas de correo. Se llama al arrancar para que el primer envío no pague la compilación.
+    """
+    for tipo in CORREOS:
+        _plantillas(tipo)
+
+
+def reiniciar_plantillas():
+    """
+    Descarta las plantillas compiladas (ej. tras editar los archivos en desarrollo, o para medir la compilación).
+    """
+    with _compiladas_lock:
+        _compiladas.clear()
+        if _entorno.cache is not None:
+            _entorno.cache.clear()
+
+
+def _plantillas(tipo):
+    compiladas = _compiladas.get(tipo)
+    if compiladas:
+        return compiladas
+    definicion = CORREOS.get(tipo)
+    if definicion is None:
+        raise PlantillaInvalida(f"Tipo de correo desconocido: {tipo}")
+    with _compiladas_lock:
+        if tipo not in _compiladas:
+            _compiladas[tipo] = (
+                _entorno.from_string(definicion['asunto']),
+                _entorno.get_template(definicion['html']) if definicion['html'] else None,
+                _entorno.get_template(definicion['texto']) if definicion['texto'] else None
+            )
+        return _compiladas[tipo]
+
+
+# --- Marca por empresa (nombre, logo y configuración de correo) ---
+
+_marcas = {}  # id_empresa -> (expira, marca)
+_marcas_lock = Lock()
+
+
+def marca_empresa(id_empresa):
+    """
+    {"nombre", "logo_url", "recibos_resumen_minutos"} de la empresa, desde la caché.
+    Requiere app context si no está en caché.
+    """
+    if id_empresa is None:
+        return {"nombre": "AuditEase", "logo_url": LOGO_POR_DEFECTO, "recibos_resumen_minutos": None}
+    ahora = time.monotonic()
+    with _marcas_lock:
+        entrada = _marcas.get(id_empresa)
+        if entrada and entrada[0] > ahora:
+            return entrada[1]
+
+    empresa = Empresa.query.get(id_empresa)
+    marca = {
+        "nombre": empresa.nombre_empresa if empresa else "AuditEase",
+        "logo_url": (empresa.logo_url if empresa else None) or LOGO_POR_DEFECTO,
+        "recibos_resumen_minutos": empresa.recibos_resumen_minutos if empresa else None
+    }
+    with _marcas_lock:
+        _marcas[id_empresa] = (ahora + CORREO_MARCA_TTL, marca)
+    return marca
+
+
+def invalidar_marca(id_empresa):
+    """
+    Descarta la marca en caché de una empresa. Llamar después del commit que cambia su nombre o logo.
+    """
+    with _marcas_lock:
+        _marcas.pop(id_empresa, None)
+
+
+# --- Render ---
+
+def _contexto_con_marca(contexto):
+    if 'marca' in contexto:
+        return contexto
+    return dict(contexto, marca=marca_empresa(contexto.get('id_empresa')))
+
+
+def renderizar_asunto(tipo, contexto):
+    asunto, _, _ = _plantillas(tipo)
+    try:
+        return asunto.render(_contexto_con_marca(contexto))
+    except Exception as e:
+        raise PlantillaInvalida(f"No se pudo generar el asunto del correo '{tipo}': {e}")
+
+
+def renderizar(tipo, contexto):
+    """
+    Devuelve {"asunto", "html", "texto"} del correo `tipo` con el contexto dado.
+    """
+    return renderizar_lote(tipo, [contexto])[0]
+
+
+def renderizar_lote(tipo, contextos):
+    """
+    Renderiza muchos correos del mismo tipo en una pasada: las plantillas se resuelven una vez
+    y la marca de cada empresa se consulta una sola vez para todo el lote.
+    Devuelve una lista en el mismo orden; un contexto inválido lanza PlantillaInvalida.
+    """
+    asunto, html, texto = _plantillas(tipo)
+    marcas = {}
+    resultados = []
+    for contexto in contextos:
+        if 'marca' not in contexto:
+            id_empresa = contexto.get('id_empresa')
+            if id_empresa not in marcas:
+                marcas[id_empresa] = marca_empresa(id_empresa)
+            contexto = dict(contexto, marca=marcas[id_empresa])
+        try:
+            resultados.append({
+                "asunto": asunto.render(contexto),
+                "html": html.render(contexto) if html else None,
+                "texto": texto.render(contexto) if texto else None
+            })
+        except Exception as e:
+            raise PlantillaInvalida(f"No se pudo renderizar el correo '{tipo}': {e}")
+    return resultados
@@ -0,0 +1,214 @@
+# src/api/form_access.py
+
+# Índice en memoria de acceso a formularios por empresa.
+# Un usuario (no owner) puede acceder a un formulario si:
+#   - el formulario pertenece a su empresa, o
+#   - es una plantilla global, o
+#   - es una plantilla compartida con su empresa (tabla formulario_empresa_compartida).
+# En lugar de cargar el Formulario completo y repetir esa lógica en cada ruta, se mantiene
+# por empresa el conjunto de IDs accesibles. El índice se actualiza de forma incremental
+# cuando se crea, comparte o elimina un formulario, y tiene un TTL corto (FORM_ACCESS_CACHE_TTL,
+# 10 s por defecto) que acota la desincronización entre procesos: si otro worker de gunicorn deja de
+# compartir una plantilla o le quita es_plantilla_global, este proceso puede seguir concediendo el
+# acceso durante a lo sumo ese tiempo. Con FORM_ACCESS_CACHE_TTL=0 cada comprobación va a la BD.
+# Las cargas desde la BD se hacen fuera del lock, para que una empresa lenta no bloquee al resto. Los listados no usan el índice sino las condiciones SQL
+# equivalentes (condicion_formularios_accesibles), que no crecen con la cantidad de formularios.
+# Una respuesta negativa se confirma siempre contra la base de datos, para que un formulario creado
+# o compartido en otro proceso (otro worker de gunicorn, el panel de admin, el worker de
+# automatización) sea accesible de inmediato.
+
+import os
+import time
+from threading import Lock
+
+from sqlalchemy import and_, or_, exists
+
+from api.models import db, Formulario, formulario_empresa_compartida
+
+
+FORM_ACCESS_CACHE_TTL = int(os.getenv('FORM_ACCESS_CACHE_TTL', 10))  # segundos
+
+_indice_empresas = {}  # id_empresa -> {"expira": float, "propios": set, "compartidos": set}
+_plantillas_globales = {"expira": 0, "ids": set()}
+_indice_lock = Lock()
+_generacion = 0  # aumenta con cada cambio incremental; una carga iniciada antes no se guarda
+
+
+def _cargar_plantillas_globales(ahora):
+    with _indice_lock:
+        if _plantillas_globales["expira"] > ahora:
+            return _plantillas_globales["ids"]
+        generacion = _generacion
+
+    ids = {fila[0] for fila in db.session.query(Formulario.id_formulario).filter(
+        Formulario.es_plantilla == True,
+        Formulario.es_plantilla_global == True
+    ).all()}
+    with _indice_lock:
+        if generacion == _generacion:
+            _plantillas_globales["ids"] = ids
+            _plantillas_globales["expira"] = ahora + FORM_ACCESS_CACHE_TTL
+    return ids
+
+
+def _cargar_empresa(id_empresa, ahora):
+    with _indice_lock:
+        entrada = _indice_empresas.get(id_empresa)
+        if entrada and entrada["expira"] > ahora:
+            return entrada
+        generacion = _generacion
+
+    propios = {fila[0] for fila in db.session.query(Formulario.id_formulario).filter(
+        Formulario.id_empresa == id_empresa
+    ).all()}
+    # Usa el índice (id_empresa, id_formulario) de formulario_empresa_compartida en lugar de recorrer el JSON
+    compartidos = {fila[0] for fila in db.session.query(Formulario.id_formulario).join(
+        formulario_empresa_compartida,
+        formulario_empresa_compartida.c.id_formulario == Formulario.id_formulario
+    ).filter(
+        formulario_empresa_compartida.c.id_empresa == id_empresa,
+        Formulario.es_plantilla == True,
+        Formulario.es_plantilla_global == False
+    ).all()}
+
+    entrada = {"expira": ahora + FORM_ACCESS_CACHE_TTL, "propios": propios, "compartidos": compartidos}
+    with _indice_lock:
+        if generacion == _generacion:
+            _indice_empresas[id_empresa] = entrada
+    return entrada
+
+
+def _compartida_con(id_empresa):
+    return and_(
+        Formulario.es_plantilla == True,
+        Formulario.es_plantilla_global == False,
+        exists().where(
+            formulario_empresa_compartida.c.id_formulario == Formulario.id_formulario,
+            formulario_empresa_compartida.c.id_empresa == id_empresa
+        )
+    )
+
+
+def _plantilla_global():
+    return and_(Formulario.es_plantilla == True, Formulario.es_plantilla_global == True)
+
+
+def condicion_plantillas_accesibles(id_empresa):
+    """
+    Condición SQL de las plantillas globales y las compartidas con la empresa (sin incluir los formularios propios).
+    Para listados: usa el índice (id_empresa, id_formulario) de formulario_empresa_compartida en lugar de un IN con todos los IDs.
+    """
+    if id_empresa is None:
+        return _plantilla_global()
+    return or_(_plantilla_global(), _compartida_con(int(id_empresa)))
+
+
+def condicion_formularios_accesibles(id_empresa):
+    """
+    Condición SQL de todos los formularios a los que puede acceder una empresa: propios, plantillas globales y compartidas.
+    """
+    if id_empresa is None:
+        return _plantilla_global()
+    id_empresa = int(id_empresa)
+    return or_(Formulario.id_empresa == id_empresa, _plantilla_global(), _compartida_con(id_empresa))
+
+
+def _acceso_en_bd(id_empresa, form_id):
+    """
+    Comprueba el acceso de una empresa a un formulario con una sola consulta a la base de datos.
+    Devuelve "global", "propio", "compartido" o None.
+    """
+    fila = db.session.query(
+        Formulario.id_empresa, Formulario.es_plantilla, Formulario.es_plantilla_global,
+        db.session.query(formulario_empresa_compartida.c.id_formulario).filter(
+            formulario_empresa_compartida.c.id_formulario == Formulario.id_formulario,
+            formulario_empresa_compartida.c.id_empresa == id_empresa
+        ).exists()
+    ).filter(Formulario.id_formulario == form_id).first()
+    if not fila:
+        return None
+    dueno, es_plantilla, es_global, compartido = fila
+    if es_plantilla and es_global:
+        return "global"
+    if id_empresa is not None and dueno == id_empresa:
+        return "propio"
+    if es_plantilla and compartido:
+        return "compartido"
+    return None
+
+
+def puede_acceder_formulario(usuario, form_id):
+    """
+    Resuelve si un usuario (o Principal) puede acceder a un formulario. El owner accede a todos.
+    """
+    if usuario.rol == 'owner':
+        return True
+
+    id_empresa = int(usuario.id_empresa) if usuario.id_empresa is not None else None
+    ahora = time.monotonic()
+    if form_id in _cargar_plantillas_globales(ahora):
+        return True
+    if id_empresa is not None:
+        entrada = _cargar_empresa(id_empresa, ahora)
+        if form_id in entrada["propios"] or form_id in entrada["compartidos"]:
+            return True
+
+    # El índice puede no tener aún un formulario creado o compartido en otro proceso
+    acceso = _acceso_en_bd(id_empresa, form_id)
+    if acceso is None:
+        return False
+    with _indice_lock:
+        if acceso == "global":
+            _plantillas_globales["ids"].add(form_id)
+        elif id_empresa in _indice_empresas:
+            _indice_empresas[id_empresa]["propios" if acceso == "propio" else "compartidos"].add(form_id)
+    return True
+
+
+def registrar_formulario(formulario):
+    """
+    Actualiza el índice tras crear o editar un formulario (cambios de plantilla o de empresas compartidas).
+    Llamar después del commit.
+    """
+    form_id = formulario.id_formulario
+    compartir_ids = {e.id_empresa for e in formulario.empresas_compartidas}
+
+    global _generacion
+    with _indice_lock:
+        _generacion += 1
+        _plantillas_globales["ids"].discard(form_id)
+        if formulario.es_plantilla and formulario.es_plantilla_global:
+            _plantillas_globales["ids"].add(form_id)
+
+        for id_empresa, entrada in _indice_empresas.items():
+            entrada["propios"].discard(form_id)
+            entrada["compartidos"].discard(form_id)
+            if id_empresa == formulario.id_empresa:
+                entrada["propios"].add(form_id)
+            if formulario.es_plantilla and not formulario.es_plantilla_global and id_empresa in compartir_ids:
+                entrada["compartidos"].add(form_id)
+
+
+def quitar_formulario(form_id):
+    """
+    Elimina un formulario del índice. Llamar después de borrarlo.
+    """
+    global _generacion
+    with _indice_lock:
+        _generacion += 1
+        _plantillas_globales["ids"].discard(form_id)
+        for entrada in _indice_empresas.values():
+            entrada["propios"].discard(form_id)
+            entrada["compartidos"].discard(form_id)
+
+
+def reiniciar_indice_formularios():
+    """
+    Descarta el índice completo (ej. tras eliminar una empresa con todos sus formularios).
+    """
+    global _generacion
+    with _indice_lock:
+        _generacion += 1
+        _indice_empresas.clear()
+        _plantillas_globales["ids"] = set()
+        _plantillas_globales["expira"] = 0
@@ -0,0 +1,315 @@
+# src/api/form_automation.py
+
+# Automatización del llenado de formularios. Antes corría en APScheduler dentro de cada proceso web,
+# llamando a la vista HTTP (que depende de get_jwt_identity); ahora la ejecuta un proceso aparte,
+# `flask automation-worker`:
+#   - Solo el líder (worker_leader, concesión 'automatizacion') ejecuta; los demás quedan en espera
+#     y toman el relevo si el líder deja de renovar.
+#   - Los envíos automáticos se atribuyen a un actor de sistema por formulario (actor_sistema), sin JWT.
+#   - Cada formulario se automatiza a lo sumo una vez por día: el registro de EjecucionAutomatizacion
+#     (único por formulario y fecha) se inserta en la misma transacción que el envío, así que un
+#     relevo de líder o una ejecución manual simultánea no duplican el envío.
+#   - Cada formulario guarda su próxima ejecución en next_automation_at (indexada), calculada con
+#     scheduled_automation_time (UTC; medianoche si no tiene hora). El worker solo lee las vencidas y
+#     duerme hasta la más próxima, con un tope de AUTOMATIZACION_WORKER_INTERVALO para renovar el liderazgo
+#     y ver los cambios de programación hechos desde la web.
+
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta, time as hora_del_dia
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from api.models import db, Usuario, Formulario, Pregunta, EnvioFormulario, Respuesta, EjecucionAutomatizacion
+from api.worker_leader import identidad_proceso, adquirir_liderazgo, liberar_liderazgo
+
+
+AUTOMATIZACION_WORKER_INTERVALO = int(os.getenv('AUTOMATIZACION_WORKER_INTERVALO', 300))  # espera máxima entre ciclos
+AUTOMATIZACION_LOTE = int(os.getenv('AUTOMATIZACION_LOTE', 100))  # formularios vencidos por ciclo
+AUTOMATIZACION_REINTENTO = int(os.getenv('AUTOMATIZACION_REINTENTO', 900))  # segundos antes de reintentar un formulario que falló
+# Concesión del líder: debe cubrir un ciclo completo; si vence, otro worker toma el relevo
+AUTOMATIZACION_CONCESION = int(os.getenv('AUTOMATIZACION_CONCESION', 3 * AUTOMATIZACION_WORKER_INTERVALO))
+MIN_ENVIOS_MANUALES = 5
+_NOMBRE_BLOQUEO = 'automatizacion'
+
+
+def proxima_automatizacion(formulario, ahora=None):
+    """
+    Próxima ejecución (UTC) del formulario: hoy a su scheduled_automation_time si aún no se ejecutó hoy
+    (de inmediato si esa hora ya pasó), si no mañana. None si la automatización está desactivada.
+    """
+    if not formulario.automatizacion_activa:
+        return None
+    hoy = (ahora or datetime.utcnow()).date()
+    dia = hoy + timedelta(days=1) if formulario.last_automated_run_date == hoy else hoy
+    return datetime.combine(dia, formulario.scheduled_automation_time or hora_del_dia(0, 0))
+
+
+def programar_automatizacion(formulario, ahora=None):
+    """
+    Recalcula next_automation_at. Llamar (antes del commit) al cambiar automatizacion_activa o scheduled_automation_time.
+    """
+    formulario.next_automation_at = proxima_automatizacion(formulario, ahora)
+
+
+def _reprogramar_manana(formulario, hoy):
+    # Tras un intento del día (haya generado envío o no), la siguiente oportunidad es mañana a su hora
+    if formulario.automatizacion_activa:
+        formulario.next_automation_at = datetime.combine(hoy + timedelta(days=1),
+                                                         formulario.scheduled_automation_time or hora_del_dia(0, 0))
+    else:
+        formulario.next_automation_at = None
+
+
+def actor_sistema(formulario):
+    """
+    Usuario al que se atribuyen los envíos automáticos del formulario: su creador si sigue activo y es de
+    la empresa; si no, el primer admin_empresa activo de la empresa. None si la empresa no tiene ninguno.
+    """
+    creador = Usuario.query.get(formulario.creado_por_usuario_id)
+    if creador and creador.activo and creador.id_empresa == formulario.id_empresa:
+        return creador
+    return Usuario.query.filter_by(id_empresa=formulario.id_empresa, rol='admin_empresa', activo=True) \
+        .order_by(Usuario.id_usuario).first()
+
+
+def calcular_valores_automatizados(form_id, empresa_id):
+    """
+    Calcula los valores (moda o promedio) para las respuestas de un formulario.
+    """
+    valores_por_pregunta = {}
+    
+    # Obtener todas las preguntas del formulario
+    preguntas = Pregunta.query.filter_by(id_formulario=form_id).all()
+    
+    for pregunta in preguntas:
+        # Obtener todas las respuestas manuales para esta pregunta
+        # CORREGIDO: Ahora se obtienen los últimos 3 envíos manuales
+        respuestas_manuales = Respuesta.query.join(EnvioFormulario).\
+            filter(Respuesta.id_pregunta == pregunta.id_pregunta,
+                   EnvioFormulario.completado_automaticamente == False,
+                   EnvioFormulario.id_formulario == form_id).\
+            join(Usuario).filter(Usuario.id_empresa == empresa_id).\
+            order_by(EnvioFormulario.fecha_hora_envio.desc()).limit(3).all()
+            
+        if not respuestas_manuales:
+            continue
+
+        tipo_respuesta = pregunta.tipo_respuesta.nombre_tipo
+        valor_calculado = {}
+
+        if tipo_respuesta == 'numerico':
+            valores_numericos = [r.valor_numerico for r in respuestas_manuales if r.valor_numerico is not None]
+            if valores_numericos:
+                promedio = sum(valores_numericos) / len(valores_numericos)
+                valor_calculado = {'valor_numerico': promedio}
+        elif tipo_respuesta in ['seleccion_unica', 'booleano', 'texto_corto']:
+            valores_texto = [r.valor_texto for r in respuestas_manuales if r.valor_texto is not None]
+            if valores_texto:
+                moda = Counter(valores_texto).most_common(1)[0][0]
+                valor_calculado = {'valor_texto': moda}
+        elif tipo_respuesta == 'seleccion_multiple':
+            valores_multiples = []
+            for r in respuestas_manuales:
+                if r.valores_multiples_json:
+                    try:
+                        selected_options = json.loads(r.valores_multiples_json)
+                        valores_multiples.extend(selected_options)
+                    except json.JSONDecodeError:
+                        continue
+            if valores_multiples:
+                moda_multiple = Counter(valores_multiples).most_common(1)[0][0]
+                valor_calculado = {'valores_multiples_json': json.dumps([moda_multiple])}
+        elif tipo_respuesta == 'seleccion_recursos':
+            # CORREGIDO: Se recolectan todos los recursos únicos de los últimos 3 envíos
+            recursos_unicos = set()
+            for r in respuestas_manuales:
+                if r.valores_multiples_json:
+                    try:
+                        selected_options = json.loads(r.valores_multiples_json)
+                        if isinstance(selected_options, list):
+                            recursos_unicos.update(selected_options)
+                        else:
+                            recursos_unicos.add(selected_options)
+                    except json.JSONDecodeError:
+                        continue
+            
+            if recursos_unicos:
+                valor_calculado = {'valores_multiples_json': json.dumps(list(recursos_unicos))}
+
+        elif tipo_respuesta in ['firma', 'dibujo']:
+            # Obtener el valor de la última respuesta
+            ultima_respuesta = Respuesta.query.join(EnvioFormulario).\
+                filter(Respuesta.id_pregunta == pregunta.id_pregunta,
+                       # CORREGIDO: Se usa el campo 'completado_automaticamente' del modelo EnvioFormulario
+                       EnvioFormulario.completado_automaticamente == False,
+                       EnvioFormulario.id_formulario == form_id).\
+                join(Usuario).filter(Usuario.id_empresa == empresa_id).\
+                order_by(EnvioFormulario.fecha_hora_envio.desc()).first()
+            
+            if ultima_respuesta and ultima_respuesta.valor_texto:
+                valor_calculado = {'valor_texto': ultima_respuesta.valor_texto}
+        
+        # Tipos de respuesta que se dejan vacíos
+        elif tipo_respuesta in ['texto', 'texto_largo', 'fecha', 'hora']:
+            pass
+
+        if valor_calculado:
+            valores_por_pregunta[pregunta.id_pregunta] = valor_calculado
+            
+    return valores_por_pregunta
+
+
+def automatizar_formulario(formulario, actor, hoy, origen='worker'):
+    """
+    Genera el envío automático del día para el formulario, atribuido a `actor`. Hace commit.
+    Devuelve el id del envío, o None si no corresponde (ya se ejecutó hoy, pocos envíos manuales, sin valores).
+    """
+    if formulario.last_automated_run_date == hoy or \
+            EjecucionAutomatizacion.query.filter_by(id_formulario=formulario.id_formulario, fecha=hoy).first():
+        print(f"La automatización para el formulario {formulario.nombre_formulario} ya se ejecutó hoy. Saltando.")
+        return None
+
+    # Envíos manuales de la empresa dueña del formulario
+    manual_submissions_count = EnvioFormulario.query.join(Usuario).\
+        filter(EnvioFormulario.id_formulario == formulario.id_formulario,
+               EnvioFormulario.completado_automaticamente == False,
+               Usuario.id_empresa == formulario.id_empresa).count()
+    if manual_submissions_count < MIN_ENVIOS_MANUALES:
+        print(f"El formulario '{formulario.nombre_formulario}' no tiene suficientes envíos manuales para automatizar ({manual_submissions_count}/{MIN_ENVIOS_MANUALES}).")
+        return None
+
+    valores_calculados = calcular_valores_automatizados(formulario.id_formulario, formulario.id_empresa)
+    if not valores_calculados:
+        print(f"No se pudieron calcular valores para el formulario '{formulario.nombre_formulario}'. Saltando.")
+        return None
+
+    try:
+        # El registro del día va primero: si otro proceso ya lo insertó, falla aquí y no se crea nada
+        ejecucion = EjecucionAutomatizacion(id_formulario=formulario.id_formulario, fecha=hoy,
+                                            id_usuario_actor=actor.id_usuario, origen=origen)
+        db.session.add(ejecucion)
+        db.session.flush()
+
+        nuevo_envio = EnvioFormulario(
+            id_formulario=formulario.id_formulario,
+            id_usuario=actor.id_usuario,
+            fecha_hora_envio=datetime.utcnow(),
+            completado_automaticamente=True
+        )
+        db.session.add(nuevo_envio)
+        db.session.flush()  # Asigna id_envio
+
+        for id_pregunta, valor_calculado in valores_calculados.items():
+            db.session.add(Respuesta(
+                id_envio=nuevo_envio.id_envio,
+                id_pregunta=id_pregunta,
+                valor_texto=valor_calculado.get('valor_texto'),
+                valor_numerico=valor_calculado.get('valor_numerico'),
+                valor_booleano=valor_calculado.get('valor_booleano'),
+                valores_multiples_json=valor_calculado.get('valores_multiples_json')
+            ))
+
+        ejecucion.id_envio = nuevo_envio.id_envio
+        formulario.last_automated_run_date = hoy
+        _reprogramar_manana(formulario, hoy)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        print(f"La automatización para el formulario {formulario.nombre_formulario} ya la registró otro proceso hoy. Saltando.")
+        return None
+
+    print(f"Automatización exitosa para el formulario '{formulario.nombre_formulario}'.")
+    return nuevo_envio.id_envio
+
+
+def _automatizar(formularios, actor, origen, ahora):
+    hoy = ahora.date()
+    procesados = []
+    for formulario in formularios:
+        try:
+            responsable = actor if actor and actor.id_empresa == formulario.id_empresa else actor_sistema(formulario)
+            if responsable is None:
+                print(f"El formulario '{formulario.nombre_formulario}' no tiene un usuario activo al que atribuir el envío. Saltando.")
+            elif automatizar_formulario(formulario, responsable, hoy, origen):
+                procesados.append(formulario.nombre_formulario)
+            _reprogramar_manana(formulario, hoy)
+            db.session.commit()
+        except Exception as e:
+            # Un formulario con datos inválidos no detiene al resto; se reintenta más tarde
+            db.session.rollback()
+            print(f"ERROR BACKEND: Error al automatizar el formulario {formulario.id_formulario}: {e}")
+            try:
+                formulario.next_automation_at = ahora + timedelta(seconds=AUTOMATIZACION_REINTENTO)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+    return procesados
+
+
+def ejecutar_automatizacion(actor=None, id_empresa=None, origen='worker'):
+    """
+    Automatiza ya todos los formularios con automatizacion_activa (opcionalmente solo los de `id_empresa`),
+    sin esperar a su hora. Con `actor`, sus formularios se le atribuyen a él; los demás, al actor de sistema.
+    Devuelve los nombres de los formularios automatizados.
+    """
+    consulta = Formulario.query.filter_by(automatizacion_activa=True)
+    if id_empresa is not None:
+        consulta = consulta.filter_by(id_empresa=id_empresa)
+    return _automatizar(consulta.order_by(Formulario.id_formulario).all(), actor, origen, datetime.utcnow())
+
+
+def procesar_vencidas(limite=AUTOMATIZACION_LOTE):
+    """
+    Automatiza los formularios cuya next_automation_at ya pasó (a lo sumo `limite`).
+    Devuelve (formularios revisados, nombres de los automatizados).
+    """
+    ahora = datetime.utcnow()
+    vencidos = Formulario.query.filter(Formulario.automatizacion_activa == True,
+                                       Formulario.next_automation_at <= ahora) \
+        .order_by(Formulario.next_automation_at).limit(limite).all()
+    return len(vencidos), _automatizar(vencidos, None, 'worker', ahora)
+
+
+def _segundos_hasta_proxima():
+    proxima = db.session.query(func.min(Formulario.next_automation_at)) \
+        .filter(Formulario.automatizacion_activa == True).scalar()
+    if proxima is None:
+        return AUTOMATIZACION_WORKER_INTERVALO
+    return max(0.0, min(AUTOMATIZACION_WORKER_INTERVALO, (proxima - datetime.utcnow()).total_seconds()))
+
+
+def ejecutar_worker_automatizacion(app):
+    """
+    Ciclo del comando `flask automation-worker`: si este proceso es el líder, automatiza los formularios
+    vencidos y duerme hasta el próximo; si no, vuelve a intentar tomar el liderazgo tras el intervalo.
+    """
+    titular = identidad_proceso()
+    print(f"Worker de automatización iniciado ({titular}).")
+    try:
+        while True:
+            espera = AUTOMATIZACION_WORKER_INTERVALO
+            with app.app_context():
+                try:
+                    if adquirir_liderazgo(_NOMBRE_BLOQUEO, titular, AUTOMATIZACION_CONCESION):
+                        revisados, procesados = procesar_vencidas()
+                        if procesados:
+                            print(f"✅ Automatización: {len(procesados)} formulario(s) automatizado(s).")
+                        # Lote lleno: quedan vencidos, se sigue sin esperar
+                        espera = 0 if revisados >= AUTOMATIZACION_LOTE else _segundos_hasta_proxima()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"ERROR BACKEND: Error en el worker de automatización: {e}")
+                finally:
+                    db.session.remove()
+            if espera > 0:
+                time.sleep(espera)
+    finally:
+        with app.app_context():
+            try:
+                liberar_liderazgo(_NOMBRE_BLOQUEO, titular)
+            except Exception as e:
+                print(f"⚠️ No se pudo liberar el liderazgo de automatización: {e}")
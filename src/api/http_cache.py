@@ -0,0 +1,92 @@
+# src/api/http_cache.py
+
+# GET condicionales (ETag / If-None-Match) para las definiciones de formularios y los catálogos.
+# Cada Formulario tiene una columna `version` que se incrementa cuando cambia el formulario,
+# alguna de sus preguntas o el nombre de un tipo de respuesta usado por sus preguntas.
+# El ETag se arma con esa versión, así que para responder 304 basta con leer una columna:
+# no se cargan ni se serializan las preguntas.
+
+from flask import Response, request
+from sqlalchemy import event, select, union, update
+from sqlalchemy.orm import object_session
+
+from api.models import db, Formulario, Pregunta, TipoRespuesta, formulario_tipo_respuesta
+
+
+# Incrementar si cambia la forma de las respuestas, para que los clientes no reutilicen el formato anterior
+FORMATO_RESPUESTA = 1
+
+
+def estado_formulario(form_id):
+    """
+    Lee solo (version, es_plantilla) de un formulario. Devuelve None si no existe.
+    """
+    return db.session.query(Formulario.version, Formulario.es_plantilla).filter(
+        Formulario.id_formulario == form_id
+    ).first()
+
+
+def etag_formulario(variante, form_id, version):
+    """
+    ETag fuerte para una representación (`variante`) de un formulario en una versión dada.
+    """
+    return f"{variante}-{form_id}-v{version}-f{FORMATO_RESPUESTA}"
+
+
+def _cabeceras_cache(respuesta, etag, max_age=0):
+    respuesta.set_etag(etag)
+    # Respuesta por usuario autenticado: el cliente puede guardarla; con max_age=0 debe revalidar siempre
+    respuesta.headers['Cache-Control'] = f'private, max-age={max_age}' if max_age else 'private, no-cache'
+    respuesta.vary.add('Authorization')
+    return respuesta
+
+
+def respuesta_no_modificada(etag, max_age=0):
+    """
+    Devuelve una respuesta 304 si el If-None-Match de la petición coincide con `etag`, o None.
+    """
+    if request.if_none_match.contains(etag):
+        return _cabeceras_cache(Response(status=304), etag, max_age)
+    return None
+
+
+def con_etag(respuesta, etag, max_age=0):
+    """
+    Agrega ETag y Cache-Control a una respuesta ya construida (ej. la de jsonify).
+    """
+    return _cabeceras_cache(respuesta, etag, max_age)
+
+
+def _incrementar_version(connection, condicion):
+    tabla = Formulario.__table__
+    connection.execute(update(tabla).where(condicion).values(version=tabla.c.version + 1))
+
+
+# Cualquier cambio en columnas o colecciones del formulario (datos, plantilla, tipos de respuesta...)
+@event.listens_for(Formulario, 'before_update')
+def _versionar_formulario(mapper, connection, target):
+    sesion = object_session(target)
+    if sesion is not None and sesion.is_modified(target, include_collections=True):
+        target.version = (target.version or 0) + 1
+
+
+# Crear, editar o eliminar una pregunta cambia la definición de su formulario
+@event.listens_for(Pregunta, 'after_insert')
+@event.listens_for(Pregunta, 'after_update')
+@event.listens_for(Pregunta, 'after_delete')
+def _versionar_por_pregunta(mapper, connection, target):
+    if target.id_formulario is not None:
+        _incrementar_version(connection, Formulario.__table__.c.id_formulario == target.id_formulario)
+
+
+# Las preguntas incluyen tipo_respuesta_nombre y el formulario sus tipos_respuesta_disponibles:
+# renombrar un tipo invalida los formularios que lo usan por cualquiera de los dos caminos
+@event.listens_for(TipoRespuesta, 'after_update')
+def _versionar_por_tipo_respuesta(mapper, connection, target):
+    formularios_con_tipo = union(
+        select(Pregunta.id_formulario).where(Pregunta.tipo_respuesta_id == target.id_tipo_respuesta),
+        select(formulario_tipo_respuesta.c.id_formulario).where(
+            formulario_tipo_respuesta.c.id_tipo_respuesta == target.id_tipo_respuesta
+        )
+    )
+    _incrementar_version(connection, Formulario.__table__.c.id_formulario.in_(formularios_con_tipo))
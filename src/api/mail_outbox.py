@@ -0,0 +1,415 @@
+# src/api/mail_outbox.py
+
+# Bandeja de salida persistente para los correos (recibos, anulaciones, recuperación de contraseña,
+# formulario de contacto). Las rutas solo guardan el mensaje en correos_pendientes y responden de
+# inmediato; un worker reclama lotes con el mismo UPDATE condicional + lease que la cola de imágenes
+# (media_queue) y los envía por las sesiones SMTP reutilizadas de smtp_bulk. Los fallos se reintentan
+# con backoff exponencial y cada correo queda con su estado, intentos, último error y los destinatarios
+# que el servidor rechazó. Como la cola está en la BD, un reinicio del worker web no pierde correos.
+# Los correos encolados con encolar_plantilla guardan solo el contexto; el worker renderiza sus cuerpos
+# por lotes (email_templates.renderizar_lote) antes de enviarlos, fuera de la petición.
+# Modo resumen de recibos (por empresa, Empresa.recibos_resumen_minutos): cada recibo se encola por
+# destinatario con una clave_resumen y queda retenido durante la ventana; al vencer el primero, el
+# worker reclama también los demás retenidos con la misma clave y envía un solo correo con todos.
+# Al enviarse un correo se borran sus cuerpos y su contexto (los de recuperación de contraseña llevan
+# el enlace con el token), y el worker purga periódicamente los enviados/fallidos más antiguos que
+# CORREO_RETENCION_DIAS.
+
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from flask_mail import Message
+from sqlalchemy import update, delete
+
+from api.models import db, CorreoPendiente
+from api.smtp_bulk import obtener_pool_smtp
+from api.email_templates import renderizar_asunto, renderizar, renderizar_lote, marca_empresa, PlantillaInvalida
+
+
+CORREO_WORKER_INTERVALO = int(os.getenv('CORREO_WORKER_INTERVALO', 5))
+CORREO_MAX_INTENTOS = int(os.getenv('CORREO_MAX_INTENTOS', 6))
+CORREO_BACKOFF_BASE = int(os.getenv('CORREO_BACKOFF_BASE', 30))  # segundos; se duplica en cada intento
+CORREO_BACKOFF_MAX = int(os.getenv('CORREO_BACKOFF_MAX', 3600))
+CORREO_LEASE = int(os.getenv('CORREO_LEASE', 300))
+CORREO_LOTE = int(os.getenv('CORREO_LOTE', 50))
+# Con '0' el proceso web solo encola y los correos los envía `flask mail-worker`
+CORREO_WORKER_EN_WEB = os.getenv('CORREO_WORKER_EN_WEB', '1') == '1'
+# Ventana del resumen de recibos para las empresas sin valor propio (0 = envío inmediato)
+RECIBOS_RESUMEN_MINUTOS = int(os.getenv('RECIBOS_RESUMEN_MINUTOS', 0))
+# Días que se conservan los correos enviados o fallidos (solo metadatos) antes de purgarlos
+CORREO_RETENCION_DIAS = int(os.getenv('CORREO_RETENCION_DIAS', 30))
+CORREO_PURGA_INTERVALO = int(os.getenv('CORREO_PURGA_INTERVALO', 3600))  # segundos entre purgas
+
+_ESTADOS_RECLAMABLES = ('pendiente', 'procesando')
+_ESTADOS_FINALES = ('enviado', 'fallido', 'cancelado')
+
+
+def encolar_correo(asunto, destinatarios, cuerpo_texto=None, cuerpo_html=None, remitente=None,
+                   tipo=None, id_empresa=None, referencia=None):
+    """
+    Agrega un correo a la bandeja de salida. `remitente` es un email o (nombre, email).
+    No hace commit: se confirma junto con el dato que origina el correo.
+    """
+    if isinstance(remitente, (tuple, list)):
+        remitente_nombre, remitente_email = remitente
+    else:
+        remitente_nombre, remitente_email = None, remitente
+    item = CorreoPendiente(
+        tipo=tipo,
+        id_empresa=id_empresa,
+        referencia=str(referencia) if referencia is not None else None,
+        asunto=asunto,
+        remitente_nombre=remitente_nombre,
+        remitente_email=remitente_email,
+        destinatarios=list(destinatarios),
+        cuerpo_texto=cuerpo_texto,
+        cuerpo_html=cuerpo_html
+    )
+    db.session.add(item)
+    return item
+
+
+def encolar_mensaje(msg, tipo=None, id_empresa=None, referencia=None):
+    """
+    Encola un flask_mail.Message ya armado. No hace commit.
+    """
+    return encolar_correo(msg.subject, msg.recipients, msg.body, msg.html, msg.sender,
+                          tipo=tipo, id_empresa=id_empresa, referencia=referencia)
+
+
+def encolar_plantilla(plantilla, contexto, destinatarios, remitente=None, tipo=None, id_empresa=None, referencia=None,
+                      clave_resumen=None, retener_segundos=0):
+    """
+    Encola un correo de email_templates.CORREOS. Solo se genera el asunto; los cuerpos los renderiza
+    el worker. `contexto` debe ser serializable a JSON. No hace commit.
+    Con `clave_resumen` el correo puede agruparse con otros de la misma clave; `retener_segundos` lo
+    deja en espera para que alcancen a llegar.
+    """
+    item = encolar_correo(renderizar_asunto(plantilla, contexto), destinatarios, remitente=remitente,
+                          tipo=tipo or plantilla, id_empresa=id_empresa, referencia=referencia)
+    item.plantilla = plantilla
+    item.contexto = contexto
+    item.clave_resumen = clave_resumen
+    if retener_segundos:
+        item.proximo_intento = datetime.utcnow() + timedelta(seconds=retener_segundos)
+    return item
+
+
+def minutos_resumen_recibos(id_empresa):
+    """
+    Ventana del resumen de recibos de la empresa (desde la caché de marca); 0 = envío inmediato.
+    """
+    minutos = marca_empresa(id_empresa).get("recibos_resumen_minutos")
+    return RECIBOS_RESUMEN_MINUTOS if minutos is None else minutos
+
+
+def encolar_recibo(contexto, destinatarios, remitente=None, id_empresa=None, referencia=None):
+    """
+    Encola la notificación de un recibo: un correo para todos los destinatarios, o, con el modo
+    resumen de la empresa, uno por destinatario retenido durante la ventana. No hace commit.
+    """
+    minutos = minutos_resumen_recibos(id_empresa)
+    if minutos <= 0:
+        return [encolar_plantilla('recibo', contexto, destinatarios, remitente=remitente,
+                                  id_empresa=id_empresa, referencia=referencia)]
+    return [encolar_plantilla('recibo', contexto, [destinatario], remitente=remitente,
+                              id_empresa=id_empresa, referencia=referencia,
+                              clave_resumen=f"{id_empresa}:{destinatario.strip().lower()}",
+                              retener_segundos=minutos * 60)
+            for destinatario in destinatarios]
+
+
+def cancelar_recibos_retenidos(id_empresa, referencia):
+    """
+    Cancela las notificaciones de un recibo que siguen retenidas en la ventana de resumen (ej. se anuló
+    el recibo antes de enviarlas). No hace commit: se confirma junto con la anulación.
+    """
+    db.session.execute(
+        update(CorreoPendiente)
+        .where(CorreoPendiente.tipo == 'recibo',
+               CorreoPendiente.id_empresa == id_empresa,
+               CorreoPendiente.referencia == str(referencia),
+               CorreoPendiente.estado == 'pendiente')
+        .values(estado='cancelado', cuerpo_texto=None, cuerpo_html=None, contexto=None)
+    )
+
+
+def _renderizar_pendientes(items):
+    """
+    Genera los cuerpos de los correos por plantilla que aún no los tienen, agrupados por plantilla.
+    Devuelve {id: error} de los que no se pudieron renderizar.
+    """
+    grupos = {}
+    for item in items:
+        if item.plantilla and item.cuerpo_html is None and item.cuerpo_texto is None:
+            grupos.setdefault(item.plantilla, []).append(item)
+
+    errores = {}
+    for plantilla, grupo in grupos.items():
+        try:
+            renderizados = renderizar_lote(plantilla, [item.contexto or {} for item in grupo])
+        except PlantillaInvalida:
+            # Un contexto inválido no debe frenar al resto del lote: se renderizan uno por uno
+            renderizados = []
+            for item in grupo:
+                try:
+                    renderizados.extend(renderizar_lote(plantilla, [item.contexto or {}]))
+                except PlantillaInvalida as e:
+                    errores[item.id] = str(e)[:1000]
+                    renderizados.append(None)
+        for item, cuerpos in zip(grupo, renderizados):
+            if cuerpos:
+                item.cuerpo_html = cuerpos["html"]
+                item.cuerpo_texto = cuerpos["texto"]
+    return errores
+
+
+def mensaje_de(item):
+    """
+    Reconstruye el flask_mail.Message de un correo pendiente.
+    """
+    remitente = (item.remitente_nombre, item.remitente_email) if item.remitente_nombre else item.remitente_email
+    msg = Message(item.asunto, sender=remitente, recipients=list(item.destinatarios))
+    msg.body = item.cuerpo_texto
+    msg.html = item.cuerpo_html
+    return msg
+
+
+def mensaje_resumen(grupo):
+    """
+    Un solo mensaje con todos los recibos retenidos de un destinatario (mismo remitente y empresa).
+    """
+    principal = grupo[0]
+    cuerpos = renderizar('recibo_resumen', {
+        "id_empresa": principal.id_empresa,
+        "recibos": [item.contexto or {} for item in grupo]
+    })
+    remitente = (principal.remitente_nombre, principal.remitente_email) if principal.remitente_nombre else principal.remitente_email
+    msg = Message(cuerpos["asunto"], sender=remitente, recipients=list(principal.destinatarios))
+    msg.body = cuerpos["texto"]
+    msg.html = cuerpos["html"]
+    return msg
+
+
+def _backoff(intentos):
+    return min(CORREO_BACKOFF_MAX, CORREO_BACKOFF_BASE * (2 ** max(0, intentos - 1)))
+
+
+def _reclamar_ids(candidatos, ahora, solo_vencidos=True):
+    reclamados = []
+    for item_id in candidatos:
+        condiciones = [CorreoPendiente.id == item_id, CorreoPendiente.estado.in_(_ESTADOS_RECLAMABLES)]
+        if solo_vencidos:
+            condiciones.append(CorreoPendiente.proximo_intento <= ahora)
+        resultado = db.session.execute(
+            update(CorreoPendiente)
+            .where(*condiciones)
+            .values(estado='procesando',
+                    intentos=CorreoPendiente.intentos + 1,
+                    proximo_intento=ahora + timedelta(seconds=CORREO_LEASE))
+        )
+        if resultado.rowcount == 1:
+            reclamados.append(item_id)
+    return reclamados
+
+
+def _reclamar(limite):
+    """
+    Reserva hasta `limite` correos listos para enviar. Devuelve sus IDs.
+    """
+    ahora = datetime.utcnow()
+    candidatos = [fila[0] for fila in db.session.query(CorreoPendiente.id).filter(
+        CorreoPendiente.estado.in_(_ESTADOS_RECLAMABLES),
+        CorreoPendiente.proximo_intento <= ahora
+    ).order_by(CorreoPendiente.proximo_intento).limit(limite).all()]
+
+    reclamados = _reclamar_ids(candidatos, ahora)
+    db.session.commit()
+    return reclamados
+
+
+def _reclamar_agrupados(reclamados):
+    """
+    Para los correos reclamados con clave_resumen, reserva también los retenidos con la misma clave
+    aunque su ventana no haya vencido: salen todos en el mismo resumen. Devuelve los IDs adicionales.
+    """
+    claves = [fila[0] for fila in db.session.query(CorreoPendiente.clave_resumen).filter(
+        CorreoPendiente.id.in_(reclamados),
+        CorreoPendiente.clave_resumen.isnot(None)
+    ).distinct().all()]
+    if not claves:
+        return []
+    candidatos = [fila[0] for fila in db.session.query(CorreoPendiente.id).filter(
+        CorreoPendiente.clave_resumen.in_(claves),
+        CorreoPendiente.estado == 'pendiente',
+        CorreoPendiente.id.notin_(reclamados)
+    ).all()]
+    adicionales = _reclamar_ids(candidatos, datetime.utcnow(), solo_vencidos=False)
+    db.session.commit()
+    return adicionales
+
+
+def _borrar_contenido(item):
+    # Ya no se va a reenviar: no guardar el cuerpo ni los datos con que se renderizó
+    item.cuerpo_texto = None
+    item.cuerpo_html = None
+    item.contexto = None
+
+
+def registrar_resultado(item, resultado):
+    """
+    Marca el correo como enviado, o lo reprograma / descarta según sus intentos. No hace commit.
+    `resultado` es el que devuelve PoolSMTP.enviar_lote para el mensaje.
+    """
+    error = resultado["error"]
+    item.destinatarios_rechazados = resultado["rechazados"] or None
+    if error is None:
+        item.estado = 'enviado'
+        item.fecha_envio = datetime.utcnow()
+        item.ultimo_error = None
+        _borrar_contenido(item)
+        if resultado["rechazados"]:
+            print(f"⚠️ Correo {item.id} enviado, pero el servidor rechazó a: {resultado['rechazados']}")
+    elif resultado["permanente"] or item.intentos >= CORREO_MAX_INTENTOS:
+        item.estado = 'fallido'
+        item.ultimo_error = error
+        if item.tipo == 'recuperacion_password':
+            _borrar_contenido(item)
+        print(f"🛑 ERROR DE CORREO: Correo {item.id} a {item.destinatarios} descartado tras {item.intentos} intento(s): {error}")
+    else:
+        item.estado = 'pendiente'
+        item.ultimo_error = error
+        item.proximo_intento = datetime.utcnow() + timedelta(seconds=_backoff(item.intentos))
+        print(f"⚠️ Falló el envío del correo {item.id} (intento {item.intentos}); se reintentará: {error}")
+
+
+def procesar_correos_pendientes(app, limite=CORREO_LOTE):
+    """
+    Envía un lote de correos pendientes. Debe ejecutarse dentro de un app context.
+    Devuelve el número de correos procesados.
+    """
+    reclamados = _reclamar(limite)
+    if not reclamados:
+        return 0
+
+    reclamados += _reclamar_agrupados(reclamados)
+    items = CorreoPendiente.query.filter(CorreoPendiente.id.in_(reclamados)).order_by(CorreoPendiente.id).all()
+
+    # Recibos retenidos del mismo destinatario: un solo correo de resumen por clave
+    grupos = {}
+    for item in items:
+        if item.clave_resumen:
+            grupos.setdefault(item.clave_resumen, []).append(item)
+    grupos = {clave: grupo for clave, grupo in grupos.items() if len(grupo) > 1}
+    agrupados = {item.id for grupo in grupos.values() for item in grupo}
+
+    individuales = [item for item in items if item.id not in agrupados]
+    errores_plantilla = _renderizar_pendientes(individuales)
+    envios = []  # (correos que cubre el mensaje, mensaje)
+    for item in individuales:
+        if item.id in errores_plantilla:
+            # Reintentar no arregla un contexto incompleto
+            registrar_resultado(item, {"error": errores_plantilla[item.id], "rechazados": {}, "permanente": True})
+        else:
+            envios.append(([item], mensaje_de(item)))
+    for grupo in grupos.values():
+        try:
+            envios.append((grupo, mensaje_resumen(grupo)))
+        except PlantillaInvalida as e:
+            for item in grupo:
+                registrar_resultado(item, {"error": str(e)[:1000], "rechazados": {}, "permanente": True})
+    db.session.commit()  # Cuerpos renderizados guardados; sin transacción abierta mientras se habla con el SMTP
+
+    resultados = obtener_pool_smtp(app).enviar_lote([msg for _, msg in envios])
+    for (cubiertos, _), resultado in zip(envios, resultados):
+        for item in cubiertos:
+            registrar_resultado(item, resultado)
+    db.session.commit()
+
+    enviados = sum(len(cubiertos) for cubiertos, _ in envios if cubiertos[0].estado == 'enviado')
+    if grupos:
+        print(f"📬 Bandeja de salida: {len(agrupados)} recibo(s) agrupados en {len(grupos)} resumen(es).")
+    print(f"✅ Bandeja de salida: {enviados}/{len(items)} correo(s) enviados.")
+    return len(items)
+
+
+def purgar_correos_antiguos(dias=CORREO_RETENCION_DIAS):
+    """
+    Elimina los correos enviados o fallidos creados hace más de `dias` días. Hace commit.
+    Devuelve el número de filas eliminadas.
+    """
+    limite = datetime.utcnow() - timedelta(days=dias)
+    eliminados = db.session.execute(
+        delete(CorreoPendiente).where(
+            CorreoPendiente.estado.in_(_ESTADOS_FINALES),
+            CorreoPendiente.fecha_creacion < limite
+        )
+    ).rowcount
+    db.session.commit()
+    if eliminados:
+        print(f"🧹 Bandeja de salida: {eliminados} correo(s) de más de {dias} día(s) purgados.")
+    return eliminados
+
+
+# --- Worker en segundo plano ---
+
+_worker = None
+_worker_lock = Lock()
+_despertar = Event()
+
+
+def _ciclo_worker(app):
+    proxima_purga = 0.0
+    while True:
+        procesados = 0
+        with app.app_context():
+            try:
+                if time.monotonic() >= proxima_purga:
+                    proxima_purga = time.monotonic() + CORREO_PURGA_INTERVALO
+                    purgar_correos_antiguos()
+                procesados = procesar_correos_pendientes(app)
+            except Exception as e:
+                db.session.rollback()
+                print(f"ERROR BACKEND: Error en el worker de correos: {e}")
+            finally:
+                db.session.remove()
+        if procesados < CORREO_LOTE:
+            _despertar.wait(CORREO_WORKER_INTERVALO)
+            _despertar.clear()
+
+
+def asegurar_worker_correo(app):
+    """
+    Inicia (una sola vez por proceso) el hilo que vacía la bandeja de salida.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_ciclo_worker, args=(app,), name='correo-worker', daemon=True)
+            _worker.start()
+
+
+def despertar_worker_correo():
+    """
+    Pide al worker que revise la bandeja ahora, sin esperar el intervalo.
+    """
+    _despertar.set()
+
+
+def correos_encolados(app):
+    """
+    Llamar después del commit que encoló correos: arranca o despierta el worker de este proceso.
+    """
+    if CORREO_WORKER_EN_WEB:
+        asegurar_worker_correo(app)
+        despertar_worker_correo()
+
+
+def ejecutar_worker_correo(app):
+    """
+    Ejecuta el worker en primer plano (comando `flask mail-worker`).
+    """
+    print("Worker de correos iniciado.")
+    _ciclo_worker(app)
@@ -0,0 +1,201 @@
+# src/api/media_dedup.py
+
+# Deduplicación de imágenes por contenido. Antes de subir una firma o dibujo se calcula el
+# SHA-256 de sus bytes decodificados; si ya existe en media_hash se reutiliza su URL sin
+# llamar a Cloudinary. Las imágenes repetidas dentro del mismo envío se suben una sola vez.
+# La tabla lleva un conteo de referencias (respuestas y firmas de usuario que usan la URL):
+# los incrementos de un INSERT masivo se registran de forma explícita y el resto de altas
+# y bajas se mantienen con eventos de mapper sobre Respuesta y Usuario.
+
+import hashlib
+from collections import Counter
+from io import BytesIO
+
+from sqlalchemy import event, inspect, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from api.models import db, MediaHash, Respuesta, Usuario
+from api.media_uploads import subir_archivos, decodificar_imagen, es_archivo
+
+
+_BLOQUE_HASH = 64 * 1024
+
+
+def _contenido(valor):
+    if isinstance(valor, (bytes, bytearray)):
+        return bytes(valor)
+    return decodificar_imagen(valor)[0]
+
+
+def hash_contenido(contenido):
+    return hashlib.sha256(contenido).hexdigest()
+
+
+def _preparar(imagen):
+    """
+    Devuelve (sha256, archivo para subir, tamaño). Los archivos (partes multipart ya volcadas a
+    disco) se leen por bloques y se suben tal cual, sin cargarlos completos en memoria.
+    """
+    if es_archivo(imagen):
+        resumen = hashlib.sha256()
+        tamano = 0
+        imagen.seek(0)
+        for bloque in iter(lambda: imagen.read(_BLOQUE_HASH), b''):
+            resumen.update(bloque)
+            tamano += len(bloque)
+        if not tamano:
+            raise ValueError("Imagen vacía.")
+        imagen.seek(0)
+        return resumen.hexdigest(), imagen, tamano
+    contenido = _contenido(imagen)
+    return hash_contenido(contenido), BytesIO(contenido), len(contenido)
+
+
+def urls_conocidas(hashes):
+    """
+    {sha256: url} de los hashes que ya están en media_hash (una sola consulta).
+    """
+    if not hashes:
+        return {}
+    return dict(db.session.query(MediaHash.sha256, MediaHash.url).filter(MediaHash.sha256.in_(list(hashes))).all())
+
+
+def registrar_hashes(nuevos):
+    """
+    Inserta {sha256: (url, tamano_bytes)} en media_hash. Si otro proceso registró el mismo
+    hash al mismo tiempo se conserva el existente. No hace commit.
+    """
+    if not nuevos:
+        return
+    filas = [{"sha256": sha, "url": url, "tamano_bytes": tamano, "referencias": 0}
+             for sha, (url, tamano) in nuevos.items()]
+    dialecto = db.session.get_bind().dialect.name
+    if dialecto == 'postgresql':
+        db.session.execute(pg_insert(MediaHash).values(filas).on_conflict_do_nothing(index_elements=['sha256']))
+    elif dialecto == 'sqlite':
+        db.session.execute(sqlite_insert(MediaHash).values(filas).on_conflict_do_nothing(index_elements=['sha256']))
+    else:
+        existentes = set(urls_conocidas(nuevos.keys()))
+        db.session.add_all([MediaHash(**fila) for fila in filas if fila["sha256"] not in existentes])
+
+
+def _sumar(ejecutar, conteo):
+    tabla = MediaHash.__table__
+    for url, n in conteo.items():
+        if url and n:
+            ejecutar(update(tabla).where(tabla.c.url == url).values(referencias=tabla.c.referencias + n))
+
+
+def sumar_referencias(urls):
+    """
+    Incrementa las referencias de cada URL (se puede repetir). Para altas que no pasan por el ORM,
+    como el INSERT masivo de respuestas. No hace commit.
+    """
+    _sumar(db.session.execute, Counter(urls))
+
+
+def subir_deduplicado(imagenes):
+    """
+    Sube una lista de (clave, imagen) reutilizando las URLs de contenidos ya conocidos y subiendo
+    una sola vez cada contenido nuevo. `imagen` puede ser base64 (con o sin data:), bytes o un archivo.
+    Devuelve {clave: url o None}. Cierra la transacción de lectura antes de subir y deja los
+    hashes nuevos registrados en la sesión (se confirman con el commit del llamador).
+    """
+    if not imagenes:
+        return {}
+
+    hash_por_clave = {}
+    por_subir = {}  # sha256 -> (archivo, tamano)
+    sin_hash = []
+    for clave, imagen in imagenes:
+        try:
+            sha, archivo, tamano = _preparar(imagen)
+        except ValueError:
+            # No se pudo decodificar: se sube tal cual, como antes
+            sin_hash.append((clave, imagen))
+            continue
+        hash_por_clave[clave] = sha
+        por_subir.setdefault(sha, (archivo, tamano))
+
+    conocidas = urls_conocidas(por_subir.keys())
+    db.session.commit()
+
+    archivos = [(sha, archivo) for sha, (archivo, _) in por_subir.items() if sha not in conocidas]
+    archivos += [(('sin_hash', clave), imagen) for clave, imagen in sin_hash]
+    resultados = subir_archivos(archivos)
+
+    nuevos = {}
+    urls = {}
+    for clave, sha in hash_por_clave.items():
+        url = conocidas.get(sha)
+        if url is None:
+            url, error = resultados[sha]
+            if url:
+                nuevos[sha] = (url, por_subir[sha][1])
+            else:
+                print(f"ERROR BACKEND: Error al subir imagen {clave} a Cloudinary: {error}")
+        urls[clave] = url
+    for clave, _ in sin_hash:
+        url, error = resultados[('sin_hash', clave)]
+        if error:
+            print(f"ERROR BACKEND: Error al subir imagen {clave} a Cloudinary: {error}")
+        urls[clave] = url
+
+    registrar_hashes(nuevos)
+    print(f"DEBUG BACKEND: {len(imagenes)} imágenes, {len(archivos)} subidas, {len(imagenes) - len(archivos)} reutilizadas por contenido.")
+    return urls
+
+
+# --- Conteo de referencias vía eventos de mapper ---
+
+def _cambios_lista(historial):
+    anteriores = Counter()
+    nuevos = Counter()
+    for valor in historial.deleted or ():
+        anteriores.update(valor or [])
+    for valor in historial.added or ():
+        nuevos.update(valor or [])
+    return nuevos, anteriores
+
+
+def _aplicar_diferencia(connection, nuevos, anteriores):
+    diferencia = Counter(nuevos)
+    diferencia.subtract(anteriores)
+    _sumar(connection.execute, {url: n for url, n in diferencia.items() if n})
+
+
+@event.listens_for(Respuesta, 'after_update')
+def _referencias_respuesta_actualizada(mapper, connection, target):
+    nuevos, anteriores = _cambios_lista(inspect(target).attrs.valor_firma_url.history)
+    if nuevos or anteriores:
+        _aplicar_diferencia(connection, nuevos, anteriores)
+
+
+# En las bajas solo se usa el valor ya cargado: acceder a un atributo expirado de una fila borrada fallaría
+@event.listens_for(Respuesta, 'after_delete')
+def _referencias_respuesta_eliminada(mapper, connection, target):
+    urls = target.__dict__.get('valor_firma_url')
+    if urls:
+        _aplicar_diferencia(connection, Counter(), Counter(urls))
+
+
+@event.listens_for(Respuesta, 'after_insert')
+def _referencias_respuesta_creada(mapper, connection, target):
+    _aplicar_diferencia(connection, Counter(target.valor_firma_url or []), Counter())
+
+
+@event.listens_for(Usuario, 'after_update')
+def _referencias_firma_usuario(mapper, connection, target):
+    historial = inspect(target).attrs.firma_digital_url.history
+    if historial.added or historial.deleted:
+        nuevos = Counter(url for url in (historial.added or ()) if url)
+        anteriores = Counter(url for url in (historial.deleted or ()) if url)
+        _aplicar_diferencia(connection, nuevos, anteriores)
+
+
+@event.listens_for(Usuario, 'after_delete')
+def _referencias_usuario_eliminado(mapper, connection, target):
+    url = target.__dict__.get('firma_digital_url')
+    if url:
+        _aplicar_diferencia(connection, Counter(), Counter([url]))
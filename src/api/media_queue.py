@@ -0,0 +1,247 @@
+# src/api/media_queue.py
+
+# Subida diferida de imágenes (firmas de respuestas y firma digital del usuario).
+# En modo diferido la petición solo guarda los bytes en la tabla media_pendiente y responde
+# de inmediato; un worker en segundo plano sube las imágenes a Cloudinary, completa
+# Respuesta.valor_firma_url / Usuario.firma_digital_url y reintenta con backoff exponencial
+# si la subida falla. Los elementos se reclaman con un UPDATE condicional y un "lease", así
+# que varios procesos pueden ejecutar el worker sin subir dos veces la misma imagen, y un
+# elemento reclamado por un proceso que murió se vuelve a intentar cuando vence el lease.
+# Las subidas pasan por la deduplicación por contenido (media_dedup).
+
+import os
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from flask import request
+from sqlalchemy import update
+
+from api.models import db, MediaPendiente, Respuesta, Usuario
+from api.media_dedup import subir_deduplicado
+from api.storage import obtener_almacenamiento
+
+
+MEDIA_UPLOAD_MODO = os.getenv('MEDIA_UPLOAD_MODO', 'inmediato')  # 'inmediato' o 'diferido'
+MEDIA_WORKER_INTERVALO = int(os.getenv('MEDIA_WORKER_INTERVALO', 5))  # segundos entre revisiones de la cola
+MEDIA_MAX_INTENTOS = int(os.getenv('MEDIA_MAX_INTENTOS', 8))
+MEDIA_BACKOFF_BASE = int(os.getenv('MEDIA_BACKOFF_BASE', 15))  # segundos; se duplica en cada intento
+MEDIA_BACKOFF_MAX = int(os.getenv('MEDIA_BACKOFF_MAX', 3600))
+MEDIA_LEASE = int(os.getenv('MEDIA_LEASE', 300))  # segundos que un worker tiene reservado un elemento
+MEDIA_LOTE = int(os.getenv('MEDIA_LOTE', 20))
+
+_ESTADOS_RECLAMABLES = ('pendiente', 'procesando')
+
+
+def subida_diferida():
+    """
+    Indica si la petición actual debe usar la subida diferida.
+    Por defecto se usa MEDIA_UPLOAD_MODO; el cliente puede pedirla con ?modo_subida=diferido o X-Modo-Subida.
+    Si el almacenamiento no está disponible (circuito abierto) se difiere siempre en lugar de fallar.
+    """
+    modo = request.args.get('modo_subida') or request.headers.get('X-Modo-Subida') or MEDIA_UPLOAD_MODO
+    return modo == 'diferido' or not obtener_almacenamiento().disponible()
+
+
+def encolar_respuesta(id_envio, id_pregunta, posicion, contenido, content_type):
+    """
+    Agrega a la sesión una imagen para la posición `posicion` de valor_firma_url de una respuesta.
+    No hace commit: se confirma junto con el envío.
+    """
+    item = MediaPendiente(
+        destino='respuesta',
+        id_envio=id_envio,
+        id_pregunta=id_pregunta,
+        posicion=posicion,
+        contenido=contenido,
+        content_type=content_type
+    )
+    db.session.add(item)
+    return item
+
+
+def cancelar_firma_usuario(id_usuario):
+    """
+    Cancela las firmas de usuario aún no subidas (la firma se borró o se reemplazó).
+    No hace commit.
+    """
+    db.session.execute(
+        update(MediaPendiente)
+        .where(MediaPendiente.destino == 'firma_usuario',
+               MediaPendiente.id_usuario == id_usuario,
+               MediaPendiente.estado.in_(_ESTADOS_RECLAMABLES))
+        .values(estado='cancelado', contenido=None)
+    )
+
+
+def encolar_firma_usuario(id_usuario, contenido, content_type):
+    """
+    Agrega a la sesión la nueva firma digital de un usuario, cancelando las anteriores pendientes.
+    No hace commit.
+    """
+    cancelar_firma_usuario(id_usuario)
+    item = MediaPendiente(
+        destino='firma_usuario',
+        id_usuario=id_usuario,
+        contenido=contenido,
+        content_type=content_type
+    )
+    db.session.add(item)
+    return item
+
+
+def _backoff(intentos):
+    return min(MEDIA_BACKOFF_MAX, MEDIA_BACKOFF_BASE * (2 ** max(0, intentos - 1)))
+
+
+def _reclamar(limite):
+    """
+    Reserva hasta `limite` elementos listos para subir. Devuelve sus IDs.
+    """
+    ahora = datetime.utcnow()
+    candidatos = [fila[0] for fila in db.session.query(MediaPendiente.id).filter(
+        MediaPendiente.estado.in_(_ESTADOS_RECLAMABLES),
+        MediaPendiente.proximo_intento <= ahora
+    ).order_by(MediaPendiente.proximo_intento).limit(limite).all()]
+
+    reclamados = []
+    for item_id in candidatos:
+        # Solo uno de los workers que compitan por el elemento ve rowcount == 1
+        resultado = db.session.execute(
+            update(MediaPendiente)
+            .where(MediaPendiente.id == item_id,
+                   MediaPendiente.estado.in_(_ESTADOS_RECLAMABLES),
+                   MediaPendiente.proximo_intento <= ahora)
+            .values(estado='procesando',
+                    intentos=MediaPendiente.intentos + 1,
+                    proximo_intento=ahora + timedelta(seconds=MEDIA_LEASE))
+        )
+        if resultado.rowcount == 1:
+            reclamados.append(item_id)
+    db.session.commit()
+    return reclamados
+
+
+def _aplicar_resultado(item):
+    """
+    Copia la URL subida al registro destino. Devuelve False si el destino ya no existe.
+    """
+    if item.destino == 'respuesta':
+        respuesta = Respuesta.query.filter_by(id_envio=item.id_envio, id_pregunta=item.id_pregunta).first()
+        if not respuesta:
+            return False
+        # Se reconstruye la lista completa en orden, con las imágenes de la respuesta ya subidas
+        subidas = MediaPendiente.query.filter_by(
+            destino='respuesta', id_envio=item.id_envio, id_pregunta=item.id_pregunta, estado='subido'
+        ).order_by(MediaPendiente.posicion).all()
+        respuesta.valor_firma_url = [m.url_resultado for m in subidas]
+        return True
+
+    if item.destino == 'firma_usuario':
+        usuario = db.session.get(Usuario, item.id_usuario)
+        if not usuario:
+            return False
+        usuario.firma_digital_url = item.url_resultado
+        return True
+
+    return False
+
+
+def _finalizar(item, **valores):
+    """
+    Cierra un elemento reclamado solo si sigue 'procesando': si mientras se subía lo cancelaron
+    (ej. el usuario borró o reemplazó su firma), no se toca ni se aplica al destino.
+    Devuelve True si se actualizó.
+    """
+    resultado = db.session.execute(
+        update(MediaPendiente)
+        .where(MediaPendiente.id == item.id, MediaPendiente.estado == 'procesando')
+        .values(**valores)
+        .execution_options(synchronize_session=False)
+    )
+    # Releer el elemento con lo que quedó en la BD (propio o de la cancelación)
+    db.session.expire(item)
+    return resultado.rowcount == 1
+
+
+def procesar_media_pendiente(limite=MEDIA_LOTE):
+    """
+    Sube un lote de imágenes pendientes y actualiza sus registros destino. Debe ejecutarse
+    dentro de un app context. Devuelve el número de elementos procesados.
+    """
+    # Con el circuito abierto cada intento fallaría al instante y gastaría un reintento
+    if not obtener_almacenamiento().disponible():
+        return 0
+    reclamados = _reclamar(limite)
+    if not reclamados:
+        return 0
+
+    items = MediaPendiente.query.filter(MediaPendiente.id.in_(reclamados)).all()
+    # Las subidas van en paralelo, sin transacción abierta y sin repetir contenidos ya subidos
+    urls = subir_deduplicado([(item.id, item.contenido) for item in items if item.contenido])
+
+    for item in items:
+        url = urls.get(item.id)
+        error = None if url else ("Error al subir a Cloudinary (ver log)." if item.contenido else "Elemento sin contenido.")
+        if url:
+            if _finalizar(item, estado='subido', url_resultado=url, contenido=None, ultimo_error=None):
+                if not _aplicar_resultado(item):
+                    item.estado = 'cancelado'
+        elif item.intentos >= MEDIA_MAX_INTENTOS or not item.contenido:
+            if _finalizar(item, estado='fallido', ultimo_error=error):
+                print(f"ERROR BACKEND: Imagen pendiente {item.id} descartada tras {item.intentos} intento(s): {error}")
+        else:
+            if _finalizar(item, estado='pendiente', ultimo_error=error,
+                          proximo_intento=datetime.utcnow() + timedelta(seconds=_backoff(item.intentos))):
+                print(f"ADVERTENCIA: Falló la subida de la imagen pendiente {item.id} (intento {item.intentos}); se reintentará: {error}")
+        db.session.commit()
+    return len(items)
+
+
+# --- Worker en segundo plano ---
+
+_worker = None
+_worker_lock = Lock()
+_despertar = Event()
+
+
+def _ciclo_worker(app):
+    while True:
+        procesados = 0
+        with app.app_context():
+            try:
+                procesados = procesar_media_pendiente()
+            except Exception as e:
+                db.session.rollback()
+                print(f"ERROR BACKEND: Error en el worker de imágenes pendientes: {e}")
+            finally:
+                db.session.remove()
+        # Si el lote vino lleno probablemente quedan más: se sigue sin esperar
+        if procesados < MEDIA_LOTE:
+            _despertar.wait(MEDIA_WORKER_INTERVALO)
+            _despertar.clear()
+
+
+def asegurar_worker_media(app):
+    """
+    Inicia (una sola vez por proceso) el hilo que vacía la cola de imágenes pendientes.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_ciclo_worker, args=(app,), name='media-worker', daemon=True)
+            _worker.start()
+
+
+def despertar_worker_media():
+    """
+    Pide al worker que revise la cola ahora (ej. justo después de encolar), sin esperar el intervalo.
+    """
+    _despertar.set()
+
+
+def ejecutar_worker_media(app):
+    """
+    Ejecuta el worker en primer plano (comando `flask media-worker`).
+    """
+    print("Worker de imágenes pendientes iniciado.")
+    _ciclo_worker(app)
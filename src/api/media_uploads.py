@@ -0,0 +1,131 @@
+# src/api/media_uploads.py
+
+# Subida concurrente de imágenes (firmas y dibujos en base64) al almacenamiento configurado (api/storage.py).
+# Las subidas se hacen en un pool de hilos acotado y ANTES de abrir la transacción del envío:
+# así una subida lenta no mantiene ocupada una conexión de la BD ni bloquea filas, y el
+# tiempo total es el de la subida más lenta en lugar de la suma de todas.
+
+import base64
+import binascii
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from api.storage import obtener_almacenamiento
+
+
+MEDIA_UPLOAD_WORKERS = int(os.getenv('MEDIA_UPLOAD_WORKERS', 8))
+
+_pool = None
+_pool_lock = Lock()
+
+_DATA_URI = re.compile(r'^data:(?P<tipo>[\w.+-]+/[\w.+-]+)?(;[\w=.+-]+)*;base64,', re.IGNORECASE)
+
+
+def es_archivo(valor):
+    """
+    Indica si la imagen llegó como archivo (parte binaria de un multipart) en lugar de base64.
+    """
+    return hasattr(valor, 'read') and hasattr(valor, 'seek')
+
+
+def decodificar_imagen(valor):
+    """
+    Convierte una imagen en base64 (con o sin prefijo data:) o un archivo en (bytes, content_type).
+    Lanza ValueError si no es base64 válido.
+    """
+    if es_archivo(valor):
+        valor.seek(0)
+        contenido = valor.read()
+        if not contenido:
+            raise ValueError("Imagen vacía.")
+        return contenido, getattr(valor, 'mimetype', None) or 'image/png'
+    if not isinstance(valor, str) or not valor:
+        raise ValueError("Imagen vacía o con formato no válido.")
+    content_type = 'image/png'
+    coincidencia = _DATA_URI.match(valor)
+    if coincidencia:
+        content_type = coincidencia.group('tipo') or content_type
+        valor = valor[coincidencia.end():]
+    try:
+        return base64.b64decode(valor, validate=True), content_type
+    except (binascii.Error, ValueError):
+        raise ValueError("La imagen no es base64 válido.")
+
+
+def _obtener_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_WORKERS, thread_name_prefix='media-upload')
+        return _pool
+
+
+def reiniciar_pool(max_workers=None):
+    """
+    Reemplaza el pool de subidas (ej. para cambiar el número de hilos en un benchmark).
+    """
+    global _pool, MEDIA_UPLOAD_WORKERS
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+        _pool = None
+        if max_workers is not None:
+            MEDIA_UPLOAD_WORKERS = max_workers
+
+
+def _guardar(imagen):
+    # El base64 se decodifica para que cualquier backend lo acepte; lo que no se pueda decodificar
+    # (ej. una URL remota, que Cloudinary descarga por su cuenta) se entrega tal cual
+    content_type = getattr(imagen, 'mimetype', None)
+    if isinstance(imagen, str):
+        try:
+            imagen, content_type = decodificar_imagen(imagen)
+        except ValueError:
+            pass
+    return obtener_almacenamiento().guardar(imagen, 'image', content_type)
+
+
+def _subir(clave, imagen_base64):
+    try:
+        return _guardar(imagen_base64)
+    except Exception as e:
+        print(f"ERROR BACKEND: Error al subir imagen {clave} al almacenamiento: {str(e)}")
+        return None
+
+
+def _subir_con_error(imagen):
+    try:
+        return _guardar(imagen), None
+    except Exception as e:
+        return None, str(e)
+
+
+def subir_archivos(archivos):
+    """
+    Como subir_imagenes, pero acepta base64, bytes, archivos (BytesIO, partes multipart...)
+    y devuelve {clave: (secure_url, error)} para que el llamador decida si reintentar.
+    """
+    if not archivos:
+        return {}
+    pool = _obtener_pool()
+    futuros = [(clave, pool.submit(_subir_con_error, archivo)) for clave, archivo in archivos]
+    return {clave: futuro.result() for clave, futuro in futuros}
+
+
+def subir_imagenes(imagenes):
+    """
+    Sube en paralelo una lista de (clave, imagen_base64) y devuelve {clave: secure_url}.
+    Las imágenes que fallan quedan con valor None (mismo comportamiento que la subida secuencial:
+    el error se registra y el envío continúa).
+    """
+    if not imagenes:
+        return {}
+    if len(imagenes) == 1:
+        clave, imagen = imagenes[0]
+        return {clave: _subir(clave, imagen)}
+
+    pool = _obtener_pool()
+    futuros = [(clave, pool.submit(_subir, clave, imagen)) for clave, imagen in imagenes]
+    return {clave: futuro.result() for clave, futuro in futuros}
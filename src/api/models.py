@@ -1,5 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, Integer, DateTime, Text, JSON, ForeignKey, Table, Float, Time, Date
+from sqlalchemy import String, Boolean, Integer, DateTime, Text, JSON, ForeignKey, Table, Float, Time, Date, LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from datetime import datetime, date, time
 from typing import List, Optional
@@ -37,6 +37,17 @@ formulario_tipo_respuesta = Table(
     db.Column('id_tipo_respuesta', Integer, ForeignKey('tipos_respuesta.id_tipo_respuesta'), primary_key=True)
 )
 
+# NUEVA TABLA INTERMEDIA: formulario_empresa_compartida
+# Versión normalizada de Formulario.compartir_con_empresas_ids (plantillas compartidas con empresas específicas).
+# El índice (id_empresa, id_formulario) permite resolver "plantillas compartidas con mi empresa" sin recorrer el JSON.
+formulario_empresa_compartida = Table(
+    'formulario_empresa_compartida',
+    db.metadata,
+    db.Column('id_formulario', Integer, ForeignKey('formularios.id_formulario'), primary_key=True),
+    db.Column('id_empresa', Integer, ForeignKey('empresas.id_empresa'), primary_key=True),
+    db.Index('ix_formulario_empresa_compartida_empresa_formulario', 'id_empresa', 'id_formulario')
+)
+
 
 class Empresa(db.Model):
     __tablename__ = 'empresas'
@@ -50,6 +61,11 @@ class Empresa(db.Model):
     creado_por_admin_general_id: Mapped[int] = mapped_column(Integer, nullable=True)
     logo_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
     activo: Mapped[bool] = mapped_column(db.Boolean, default=True) # Campo para activar/desactivar empresa
+    # NUEVO: Minutos que se retienen los correos de recibos para agruparlos por destinatario en un resumen.
+    # None = valor global (RECIBOS_RESUMEN_MINUTOS), 0 = envío inmediato
+    recibos_resumen_minutos: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # NUEVO: Versión del estado (activo) de la empresa; los tokens emitidos con una versión anterior se rechazan
+    version_estado: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
 
     usuarios: Mapped[List["Usuario"]] = relationship("Usuario", back_populates="empresa")
     espacios: Mapped[List["Espacio"]] = relationship("Espacio", back_populates="empresa")
@@ -95,7 +111,8 @@ class Empresa(db.Model):
             "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None,
             "creado_por_admin_general_id": self.creado_por_admin_general_id,
             "logo_url": self.logo_url,
-            "activo": self.activo
+            "activo": self.activo,
+            "recibos_resumen_minutos": self.recibos_resumen_minutos
         }
 
 
@@ -120,6 +137,8 @@ class Usuario(db.Model):
     
     # NUEVO: Campo para la firma digital del usuario
     firma_digital_url: Mapped[Optional[str]] = mapped_column(String(500), nullable=True) 
+    # NUEVO: Epoch (segundos) desde el cual sus tokens anteriores no son válidos (desactivación, cambio de rol)
+    tokens_revocados_desde: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
     empresa: Mapped[Optional["Empresa"]] = relationship("Empresa", back_populates="usuarios")
     envios_formulario: Mapped[List["EnvioFormulario"]] = relationship("EnvioFormulario", back_populates="usuario")
@@ -238,6 +257,10 @@ class TipoRespuesta(db.Model):
 
 class Formulario(db.Model):
     __tablename__ = 'formularios'
+    # Índice para el listado de formularios ordenado por fecha de creación (paginación por cursor)
+    __table_args__ = (
+        db.Index('ix_formularios_fecha_creacion', 'fecha_creacion', 'id_formulario'),
+    )
 
     id_formulario: Mapped[int] = mapped_column(Integer, primary_key=True)
     id_empresa: Mapped[int] = mapped_column(Integer, ForeignKey('empresas.id_empresa'), nullable=False)
@@ -263,10 +286,15 @@ class Formulario(db.Model):
     automatizacion_activa: Mapped[bool] = mapped_column(Boolean, default=False)
     scheduled_automation_time: Mapped[Optional[time]] = mapped_column(Time, nullable=True) # Hora programada (solo hora)
     last_automated_run_date: Mapped[Optional[date]] = mapped_column(Date, nullable=True) # Última fecha de ejecución de la automatización
+    # NUEVO: Próxima ejecución de la automatización (UTC). None si está desactivada; el worker solo lee las vencidas por este índice
+    next_automation_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, index=True)
 
     # NUEVO CAMPO: Cantidad de envíos a generar automáticamente
     automation_submissions_count: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
 
+    # NUEVO: Versión de la definición (formulario + preguntas). Se incrementa en cada cambio; base de los ETag
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default='1')
+
     empresa: Mapped["Empresa"] = relationship("Empresa", back_populates="formularios")
     preguntas: Mapped[List["Pregunta"]] = relationship("Pregunta", back_populates="formulario")
     envios_formulario: Mapped[List["EnvioFormulario"]] = relationship("EnvioFormulario", back_populates="formulario")
@@ -278,6 +306,9 @@ class Formulario(db.Model):
     # NUEVA RELACIÓN: muchos a muchos con TipoRespuesta
     tipos_respuesta_disponibles: Mapped[List["TipoRespuesta"]] = relationship("TipoRespuesta", secondary=formulario_tipo_respuesta, back_populates="formularios")
 
+    # NUEVA RELACIÓN: empresas con las que se comparte la plantilla (se mantiene sincronizada con compartir_con_empresas_ids)
+    empresas_compartidas: Mapped[List["Empresa"]] = relationship("Empresa", secondary=formulario_empresa_compartida)
+
 
     def serialize(self):
         tipos_respuesta_data = [tr.serialize() for tr in self.tipos_respuesta_disponibles] if self.tipos_respuesta_disponibles else []
@@ -299,7 +330,9 @@ class Formulario(db.Model):
             "automatizacion_activa": self.automatizacion_activa, # Incluir en la serialización
             "scheduled_automation_time": self.scheduled_automation_time.strftime('%H:%M') if self.scheduled_automation_time else None, # Formato HH:MM
             "last_automated_run_date": self.last_automated_run_date.isoformat() if self.last_automated_run_date else None, # Formato YYYY-MM-DD
+            "next_automation_at": self.next_automation_at.isoformat() if self.next_automation_at else None,
             "automation_submissions_count": self.automation_submissions_count, # Incluir el nuevo campo en la serialización
+            "version": self.version,
             "tipos_respuesta_disponibles": tipos_respuesta_data
         }
 
@@ -332,6 +365,12 @@ class Pregunta(db.Model):
 
 class EnvioFormulario(db.Model):
     __tablename__ = 'envios_formulario'
+    # Índices para la paginación por cursor (fecha_hora_envio, id_envio) de los listados de envíos
+    __table_args__ = (
+        db.Index('ix_envios_formulario_fecha_envio', 'fecha_hora_envio', 'id_envio'),
+        db.Index('ix_envios_formulario_formulario_fecha', 'id_formulario', 'fecha_hora_envio', 'id_envio'),
+        db.Index('ix_envios_formulario_usuario_fecha', 'id_usuario', 'fecha_hora_envio', 'id_envio'),
+    )
 
     id_envio: Mapped[int] = mapped_column(Integer, primary_key=True)
     id_formulario: Mapped[int] = mapped_column(Integer, ForeignKey('formularios.id_formulario'), nullable=False)
@@ -375,6 +414,9 @@ class Respuesta(db.Model):
     # MODIFICADO: Ahora puede almacenar una lista de URLs de firmas (JSON)
     valor_firma_url: Mapped[Optional[List[str]]] = mapped_column(JSON, nullable=True) 
 
+    # NUEVO: Firmas/dibujos en formato vectorial compacto (lista de {"v","w","h","s"}, ver api/strokes.py)
+    valor_trazos: Mapped[Optional[list]] = mapped_column(JSON, nullable=True)
+
     envio: Mapped["EnvioFormulario"] = relationship("EnvioFormulario", back_populates="respuestas")
     pregunta: Mapped["Pregunta"] = relationship("Pregunta", back_populates="respuestas")
 
@@ -387,7 +429,8 @@ class Respuesta(db.Model):
             "valor_booleano": self.valor_booleano,
             "valor_numerico": self.valor_numerico,
             "valores_multiples_json": self.valores_multiples_json,
-            "valor_firma_url": self.valor_firma_url
+            "valor_firma_url": self.valor_firma_url,
+            "valor_trazos": self.valor_trazos
         }
 
 class Observacion(db.Model):
@@ -422,6 +465,10 @@ class Observacion(db.Model):
 
 class Notificacion(db.Model):
     __tablename__ = 'notificaciones'
+    __table_args__ = (
+        # El despachador reclama las vencidas (estado='pendiente' AND fecha_hora_programada <= ahora) por este índice
+        db.Index('ix_notificaciones_estado_programada', 'estado', 'fecha_hora_programada'),
+    )
 
     id_notificacion: Mapped[int] = mapped_column(Integer, primary_key=True)
     id_formulario: Mapped[int] = mapped_column(Integer, ForeignKey('formularios.id_formulario'), nullable=False)
@@ -565,6 +612,10 @@ class Grado(db.Model):
 
 class Estudiante(db.Model):
     __tablename__ = 'estudiantes'
+    # Índice para listar estudiantes activos por empresa con paginación por cursor
+    __table_args__ = (
+        db.Index('ix_estudiantes_empresa_activo', 'id_empresa', 'activo', 'id_estudiante'),
+    )
 
     id_estudiante: Mapped[int] = mapped_column(Integer, primary_key=True)
     id_empresa: Mapped[int] = mapped_column(Integer, ForeignKey('empresas.id_empresa'), nullable=False)
@@ -649,4 +700,220 @@ class DetalleRecibo(db.Model):
             "id_concepto": self.id_concepto,
             "valor_cobrado": self.valor_cobrado,
             "cantidad": self.cantidad
-        }
\ No newline at end of file
+        }
+
+# NUEVO: Cola de imágenes pendientes de subir a Cloudinary (modo de subida diferida).
+# Guarda los bytes de la imagen y a qué registro hay que asignarle la URL cuando se suba:
+#   - destino 'respuesta': Respuesta (id_envio, id_pregunta), posición `posicion` en valor_firma_url
+#   - destino 'firma_usuario': Usuario.firma_digital_url del usuario id_usuario
+class MediaPendiente(db.Model):
+    __tablename__ = 'media_pendiente'
+    # El worker busca los elementos listos para (re)intentar por estado y fecha del próximo intento
+    __table_args__ = (
+        db.Index('ix_media_pendiente_estado_proximo', 'estado', 'proximo_intento'),
+        db.Index('ix_media_pendiente_envio_pregunta', 'id_envio', 'id_pregunta'),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    destino: Mapped[str] = mapped_column(String(30), nullable=False)  # 'respuesta' o 'firma_usuario'
+    # Sin llaves foráneas a propósito: borrar un envío o usuario no debe fallar por imágenes en cola;
+    # si el registro destino ya no existe, el worker cancela el elemento
+    id_envio: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    id_pregunta: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    id_usuario: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    posicion: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    contenido: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)  # Se borra al subir
+    content_type: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, default='pendiente')  # pendiente, procesando, subido, fallido, cancelado
+    intentos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    proximo_intento: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    url_resultado: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "destino": self.destino,
+            "id_envio": self.id_envio,
+            "id_pregunta": self.id_pregunta,
+            "id_usuario": self.id_usuario,
+            "posicion": self.posicion,
+            "estado": self.estado,
+            "intentos": self.intentos,
+            "proximo_intento": self.proximo_intento.isoformat() if self.proximo_intento else None,
+            "ultimo_error": self.ultimo_error,
+            "url_resultado": self.url_resultado,
+            "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None
+        }
+
+
+# NUEVO: Índice de imágenes por contenido (SHA-256 de los bytes decodificados) -> URL en Cloudinary.
+# Permite reutilizar la URL de una imagen idéntica (firma guardada, lienzo en blanco) sin volver a subirla.
+# `referencias` cuenta cuántas respuestas/usuarios apuntan a la URL, para poder limpiar las que queden en 0.
+class MediaHash(db.Model):
+    __tablename__ = 'media_hash'
+
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    url: Mapped[str] = mapped_column(String(500), nullable=False, index=True)
+    tamano_bytes: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    referencias: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def serialize(self):
+        return {
+            "sha256": self.sha256,
+            "url": self.url,
+            "tamano_bytes": self.tamano_bytes,
+            "referencias": self.referencias,
+            "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None
+        }
+
+
+# NUEVO: Bandeja de salida de correos. Las rutas solo insertan aquí (en la misma transacción que
+# el dato que origina el correo) y un worker los envía con reintentos.
+class CorreoPendiente(db.Model):
+    __tablename__ = 'correos_pendientes'
+    __table_args__ = (
+        db.Index('ix_correos_pendientes_estado_proximo', 'estado', 'proximo_intento'),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    tipo: Mapped[Optional[str]] = mapped_column(String(30), nullable=True)  # recibo, anulacion_recibo, recuperacion_password, contacto
+    id_empresa: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)  # Sin llave foránea, como media_pendiente
+    referencia: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)  # ej. id del recibo
+
+    asunto: Mapped[str] = mapped_column(String(255), nullable=False)
+    remitente_nombre: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    remitente_email: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    destinatarios: Mapped[list] = mapped_column(JSON, nullable=False)
+    cuerpo_texto: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    cuerpo_html: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # NUEVO: Correos por plantilla (email_templates): el worker renderiza los cuerpos antes de enviar
+    plantilla: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    contexto: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
+    # NUEVO: Modo resumen de recibos: "<id_empresa>:<email>"; los retenidos con la misma clave se envían juntos
+    clave_resumen: Mapped[Optional[str]] = mapped_column(String(320), nullable=True, index=True)
+
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, default='pendiente')  # pendiente, procesando, enviado, fallido, cancelado
+    intentos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    proximo_intento: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # NUEVO: Destinatarios que el servidor SMTP rechazó, {email: "550 ..."}; el resto sí recibió el correo
+    destinatarios_rechazados: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    fecha_envio: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "tipo": self.tipo,
+            "id_empresa": self.id_empresa,
+            "referencia": self.referencia,
+            "asunto": self.asunto,
+            "plantilla": self.plantilla,
+            "destinatarios": self.destinatarios,
+            "estado": self.estado,
+            "intentos": self.intentos,
+            "proximo_intento": self.proximo_intento.isoformat() if self.proximo_intento else None,
+            "ultimo_error": self.ultimo_error,
+            "destinatarios_rechazados": self.destinatarios_rechazados,
+            "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            "fecha_envio": self.fecha_envio.isoformat() if self.fecha_envio else None
+        }
+
+
+# NUEVO: Subidas reanudables por partes (PDFs de documentos e imágenes grandes).
+# Las partes se escriben en un archivo temporal local; al finalizar, una tarea en segundo
+# plano verifica el archivo, lo sube y aplica el resultado según el propósito.
+class SubidaReanudable(db.Model):
+    __tablename__ = 'subidas_reanudables'
+    __table_args__ = (
+        db.Index('ix_subidas_reanudables_estado_actualizacion', 'estado', 'fecha_actualizacion'),
+    )
+
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)  # uuid4 hex
+    # Sin llave foránea, como en media_pendiente: borrar un usuario no debe fallar por una subida a medias
+    id_usuario: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    proposito: Mapped[str] = mapped_column(String(30), nullable=False)  # 'documento_pdf', 'imagen_perfil' o 'firma_digital'
+    nombre_archivo: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    content_type: Mapped[str] = mapped_column(String(100), nullable=False)
+    tamano_total: Mapped[int] = mapped_column(Integer, nullable=False)
+    recibidos: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # Bytes contiguos ya escritos desde el inicio
+    sha256: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # Opcional: se verifica al finalizar
+    metadatos: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)  # ej. titulo y categoria_id del documento
+
+    estado: Mapped[str] = mapped_column(String(20), nullable=False, default='recibiendo')  # recibiendo, ensamblando, completado, fallido, cancelado
+    ultimo_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    url_resultado: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
+    resultado: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
+
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    fecha_actualizacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "proposito": self.proposito,
+            "nombre_archivo": self.nombre_archivo,
+            "content_type": self.content_type,
+            "tamano_total": self.tamano_total,
+            "offset": self.recibidos,
+            "estado": self.estado,
+            "ultimo_error": self.ultimo_error,
+            "url_resultado": self.url_resultado,
+            "resultado": self.resultado,
+            "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            "fecha_actualizacion": self.fecha_actualizacion.isoformat() if self.fecha_actualizacion else None
+        }
+
+
+# NUEVO: Tokens revocados por /logout (jti). Cada proceso los relee periódicamente (token_registry).
+class TokenRevocado(db.Model):
+    __tablename__ = 'tokens_revocados'
+
+    jti: Mapped[str] = mapped_column(String(64), primary_key=True)
+    expira: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+
+# NUEVO: Liderazgo de los workers en segundo plano (un solo líder por nombre). El líder renueva su
+# concesión antes de que `expira`; si muere, otro proceso la toma cuando vence.
+class BloqueoWorker(db.Model):
+    __tablename__ = 'bloqueos_worker'
+
+    nombre: Mapped[str] = mapped_column(String(100), primary_key=True)  # ej. 'automatizacion'
+    titular: Mapped[str] = mapped_column(String(255), nullable=False)  # "<host>:<pid>"
+    expira: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    fecha_adquisicion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+# NUEVO: Una ejecución de la automatización por formulario y día. La restricción única hace que,
+# aunque dos procesos lo intenten a la vez, solo uno genere el envío automático del día.
+class EjecucionAutomatizacion(db.Model):
+    __tablename__ = 'ejecuciones_automatizacion'
+    __table_args__ = (
+        db.UniqueConstraint('id_formulario', 'fecha', name='uq_ejecuciones_automatizacion_formulario_fecha'),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Las rutas de borrado (formulario, envío, empresa, usuario) no tocan esta tabla: la BD elimina el
+    # registro con su formulario y deja en NULL el envío o el actor borrados
+    id_formulario: Mapped[int] = mapped_column(Integer, ForeignKey('formularios.id_formulario', ondelete='CASCADE'), nullable=False)
+    fecha: Mapped[date] = mapped_column(Date, nullable=False)  # Día (UTC) de la ejecución
+    id_envio: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('envios_formulario.id_envio', ondelete='SET NULL'), nullable=True)
+    id_usuario_actor: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('usuarios.id_usuario', ondelete='SET NULL'), nullable=True)
+    origen: Mapped[str] = mapped_column(String(20), nullable=False, default='worker')  # worker, manual
+    fecha_creacion: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "id_formulario": self.id_formulario,
+            "fecha": self.fecha.isoformat() if self.fecha else None,
+            "id_envio": self.id_envio,
+            "id_usuario_actor": self.id_usuario_actor,
+            "origen": self.origen,
+            "fecha_creacion": self.fecha_creacion.isoformat() if self.fecha_creacion else None
+        }
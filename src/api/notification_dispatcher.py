@@ -0,0 +1,284 @@
+# src/api/notification_dispatcher.py
+
+# Despachador de las notificaciones programadas (tabla notificaciones). Cada ciclo reclama por lotes
+# las vencidas con la consulta indexada (estado, fecha_hora_programada) y, en Postgres,
+# SELECT ... FOR UPDATE SKIP LOCKED: varios workers pueden despachar a la vez sin tomar la misma fila
+# ni esperarse entre sí, y nunca se recorre la tabla completa.
+# Dentro de la misma transacción del lote:
+#   - se encolan los correos en la bandeja de salida (mail_outbox), así que enviar no ocurre con filas
+#     bloqueadas y un fallo no deja notificaciones marcadas como enviadas sin su correo;
+#   - las recurrentes se reprograman a su siguiente ocurrencia y las de una sola vez quedan 'enviada',
+#     todo con un UPDATE masivo por llave primaria.
+# Las notificaciones de formularios con notificaciones_activas = False no se envían: las recurrentes
+# avanzan a su siguiente ocurrencia y las únicas quedan 'omitida'.
+#
+# frecuencia_notificacion: 'unica', 'por_hora', 'diaria', 'semanal', 'mensual'. Con
+# horas_especificas_envio (["08:00", "14:30"]) las diarias y semanales salen a esas horas (UTC).
+
+import calendar
+import os
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from sqlalchemy import select, update, func
+
+from api.models import db, Notificacion, Formulario, Usuario
+from api.mail_outbox import encolar_plantilla, correos_encolados
+
+
+NOTIFICACION_LOTE = int(os.getenv('NOTIFICACION_LOTE', 500))
+NOTIFICACION_WORKER_INTERVALO = int(os.getenv('NOTIFICACION_WORKER_INTERVALO', 60))  # espera máxima entre ciclos
+# Espera mínima cuando un ciclo no reclamó nada: la vencida más antigua puede estar bloqueada por otro
+# despachador (SKIP LOCKED) y sin esta pausa se repetirían las consultas sin descanso
+NOTIFICACION_ESPERA_MINIMA = float(os.getenv('NOTIFICACION_ESPERA_MINIMA', 2))
+# Con '0' el proceso web no despacha; lo hace `flask notification-worker`
+NOTIFICACION_WORKER_EN_WEB = os.getenv('NOTIFICACION_WORKER_EN_WEB', '1') == '1'
+
+FRECUENCIAS = ('unica', 'por_hora', 'diaria', 'semanal', 'mensual')
+_MAX_AVANCES = 1000  # tope al saltar ocurrencias atrasadas
+
+
+def _horas(horas_especificas):
+    """
+    Lista ordenada de (hora, minuto) válidos a partir de ["HH:MM", ...].
+    """
+    horas = set()
+    for valor in horas_especificas or []:
+        try:
+            momento = datetime.strptime(str(valor).strip(), '%H:%M')
+        except ValueError:
+            continue
+        horas.add((momento.hour, momento.minute))
+    return sorted(horas)
+
+
+def _sumar_mes(fecha):
+    anio, mes = (fecha.year + 1, 1) if fecha.month == 12 else (fecha.year, fecha.month + 1)
+    dia = min(fecha.day, calendar.monthrange(anio, mes)[1])
+    return fecha.replace(year=anio, month=mes, day=dia)
+
+
+def _siguiente(programada, frecuencia, horas):
+    if frecuencia == 'por_hora':
+        return programada + timedelta(hours=1)
+    if frecuencia == 'mensual':
+        return _sumar_mes(programada)
+    if frecuencia in ('diaria', 'semanal'):
+        if horas:
+            # Siguiente hora de la lista en el mismo día; si no queda ninguna, la primera del día (o semana) siguiente
+            actual = (programada.hour, programada.minute)
+            for hora, minuto in horas:
+                if (hora, minuto) > actual:
+                    return programada.replace(hour=hora, minute=minuto, second=0, microsecond=0)
+            dias = 1 if frecuencia == 'diaria' else 7
+            hora, minuto = horas[0]
+            return (programada + timedelta(days=dias)).replace(hour=hora, minute=minuto, second=0, microsecond=0)
+        return programada + timedelta(days=1 if frecuencia == 'diaria' else 7)
+    return None
+
+
+def siguiente_ocurrencia(programada, frecuencia, horas_especificas=None, ahora=None):
+    """
+    Próxima fecha_hora_programada posterior a `ahora`, o None si la notificación no se repite.
+    Las ocurrencias atrasadas (p. ej. el worker estuvo detenido) se saltan: se envía una sola vez.
+    """
+    frecuencia = (frecuencia or '').strip().lower()
+    if frecuencia not in FRECUENCIAS or frecuencia == 'unica':
+        return None
+    ahora = ahora or datetime.utcnow()
+    horas = _horas(horas_especificas)
+    siguiente = _siguiente(programada, frecuencia, horas)
+    for _ in range(_MAX_AVANCES):
+        if siguiente is None or siguiente > ahora:
+            return siguiente
+        siguiente = _siguiente(siguiente, frecuencia, horas)
+    # Demasiado atrasada: se reanuda desde ahora
+    return _siguiente(ahora, frecuencia, horas)
+
+
+def _reclamar_vencidas(ahora, limite):
+    """
+    Filas vencidas del lote, bloqueadas hasta el commit (las que otro worker ya tiene se saltan).
+    """
+    consulta = (
+        select(Notificacion.id_notificacion, Notificacion.id_formulario, Notificacion.id_usuario_destinatario,
+               Notificacion.tipo_notificacion, Notificacion.mensaje, Notificacion.fecha_hora_programada,
+               Notificacion.frecuencia_notificacion, Notificacion.horas_especificas_envio)
+        .where(Notificacion.estado == 'pendiente', Notificacion.fecha_hora_programada <= ahora)
+        .order_by(Notificacion.fecha_hora_programada)
+        .limit(limite)
+        .with_for_update(skip_locked=True, of=Notificacion)  # SQLite no lo soporta y lo omite
+    )
+    return db.session.execute(consulta).all()
+
+
+def _destinatarios(filas, formularios):
+    """
+    {id_notificacion: [emails]}. Sin destinatario explícito se avisa a los admin_empresa de la empresa del formulario.
+    """
+    ids_usuarios = {f.id_usuario_destinatario for f in filas if f.id_usuario_destinatario}
+    empresas_sin_destinatario = {formularios[f.id_formulario].id_empresa for f in filas
+                                 if not f.id_usuario_destinatario and f.id_formulario in formularios}
+
+    correos_usuario = {}
+    if ids_usuarios:
+        correos_usuario = dict(db.session.execute(
+            select(Usuario.id_usuario, Usuario.email)
+            .where(Usuario.id_usuario.in_(ids_usuarios), Usuario.activo == True)
+        ).all())
+    admins = {}
+    if empresas_sin_destinatario:
+        for id_empresa, email in db.session.execute(
+            select(Usuario.id_empresa, Usuario.email)
+            .where(Usuario.id_empresa.in_(empresas_sin_destinatario),
+                   Usuario.rol == 'admin_empresa', Usuario.activo == True)
+        ).all():
+            admins.setdefault(id_empresa, []).append(email)
+
+    destinatarios = {}
+    for fila in filas:
+        if fila.id_usuario_destinatario:
+            email = correos_usuario.get(fila.id_usuario_destinatario)
+            destinatarios[fila.id_notificacion] = [email] if email else []
+        else:
+            formulario = formularios.get(fila.id_formulario)
+            destinatarios[fila.id_notificacion] = admins.get(formulario.id_empresa, []) if formulario else []
+    return destinatarios
+
+
+def despachar_lote(ahora=None, limite=NOTIFICACION_LOTE):
+    """
+    Despacha un lote de notificaciones vencidas en una sola transacción. Devuelve
+    {"reclamadas", "encoladas", "omitidas"}. Debe ejecutarse dentro de un app context.
+    """
+    ahora = ahora or datetime.utcnow()
+    filas = _reclamar_vencidas(ahora, limite)
+    if not filas:
+        db.session.commit()
+        return {"reclamadas": 0, "encoladas": 0, "omitidas": 0}
+
+    formularios = {f.id_formulario: f for f in db.session.execute(
+        select(Formulario.id_formulario, Formulario.id_empresa, Formulario.nombre_formulario,
+               Formulario.notificaciones_activas)
+        .where(Formulario.id_formulario.in_({fila.id_formulario for fila in filas}))
+    ).all()}
+    destinatarios = _destinatarios(filas, formularios)
+
+    cambios = []
+    encoladas = omitidas = 0
+    for fila in filas:
+        formulario = formularios.get(fila.id_formulario)
+        correos = destinatarios.get(fila.id_notificacion) or []
+        enviar = bool(formulario and formulario.notificaciones_activas and correos)
+        if enviar:
+            encolar_plantilla('notificacion', {
+                "id_empresa": formulario.id_empresa,
+                "tipo_notificacion": fila.tipo_notificacion,
+                "nombre_formulario": formulario.nombre_formulario,
+                "mensaje": fila.mensaje,
+                "fecha_programada": fila.fecha_hora_programada.strftime('%d/%m/%Y %H:%M')
+            }, correos, id_empresa=formulario.id_empresa, referencia=f"notificacion:{fila.id_notificacion}")
+            encoladas += 1
+        else:
+            omitidas += 1
+
+        siguiente = siguiente_ocurrencia(fila.fecha_hora_programada, fila.frecuencia_notificacion,
+                                         fila.horas_especificas_envio, ahora)
+        cambio = {"id_notificacion": fila.id_notificacion}
+        if enviar:
+            cambio["fecha_hora_enviada"] = ahora
+        if siguiente:
+            cambio.update(estado='pendiente', fecha_hora_programada=siguiente)
+        else:
+            cambio["estado"] = 'enviada' if enviar else 'omitida'
+        cambios.append(cambio)
+
+    # UPDATE masivo por llave primaria (executemany), en la misma transacción que los correos encolados
+    db.session.execute(update(Notificacion), cambios)
+    db.session.commit()
+    return {"reclamadas": len(filas), "encoladas": encoladas, "omitidas": omitidas}
+
+
+def proxima_notificacion():
+    """
+    fecha_hora_programada de la próxima notificación pendiente (usa el mismo índice), o None.
+    """
+    return db.session.execute(
+        select(func.min(Notificacion.fecha_hora_programada)).where(Notificacion.estado == 'pendiente')
+    ).scalar()
+
+
+def procesar_notificaciones(app, limite=NOTIFICACION_LOTE):
+    """
+    Despacha lotes hasta vaciar las vencidas. Devuelve el total de notificaciones procesadas.
+    """
+    total = {"reclamadas": 0, "encoladas": 0, "omitidas": 0}
+    while True:
+        resultado = despachar_lote(limite=limite)
+        for clave in total:
+            total[clave] += resultado[clave]
+        if resultado["reclamadas"] < limite:
+            break
+    if total["encoladas"]:
+        correos_encolados(app)
+    if total["reclamadas"]:
+        print(f"🔔 Notificaciones: {total['encoladas']} encolada(s), {total['omitidas']} omitida(s).")
+    return total["reclamadas"]
+
+
+# --- Worker en segundo plano ---
+
+_worker = None
+_worker_lock = Lock()
+_despertar = Event()
+
+
+def _segundos_hasta_proxima(reclamadas):
+    proxima = proxima_notificacion()
+    if proxima is None:
+        return NOTIFICACION_WORKER_INTERVALO
+    minima = 0.0 if reclamadas else NOTIFICACION_ESPERA_MINIMA
+    return max(minima, min(NOTIFICACION_WORKER_INTERVALO, (proxima - datetime.utcnow()).total_seconds()))
+
+
+def _ciclo_worker(app):
+    while True:
+        espera = NOTIFICACION_WORKER_INTERVALO
+        with app.app_context():
+            try:
+                reclamadas = procesar_notificaciones(app)
+                espera = _segundos_hasta_proxima(reclamadas)
+            except Exception as e:
+                db.session.rollback()
+                print(f"ERROR BACKEND: Error en el despachador de notificaciones: {e}")
+            finally:
+                db.session.remove()
+        if espera > 0:
+            _despertar.wait(espera)
+            _despertar.clear()
+
+
+def asegurar_worker_notificaciones(app):
+    """
+    Inicia (una sola vez por proceso) el hilo que despacha las notificaciones.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_ciclo_worker, args=(app,), name='notificacion-worker', daemon=True)
+            _worker.start()
+
+
+def despertar_worker_notificaciones():
+    """
+    Pide al despachador que revise de inmediato (p. ej. tras programar una notificación próxima).
+    """
+    _despertar.set()
+
+
+def ejecutar_worker_notificaciones(app):
+    """
+    Ejecuta el despachador en primer plano (comando `flask notification-worker`).
+    """
+    print("Despachador de notificaciones iniciado.")
+    _ciclo_worker(app)
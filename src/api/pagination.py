@@ -0,0 +1,149 @@
+# src/api/pagination.py
+
+# Paginación por cursor (keyset) para los listados grandes.
+# En lugar de OFFSET, cada página continúa desde los valores de ordenamiento del último
+# elemento devuelto, así que el costo de obtener una página no depende de cuántas
+# filas haya antes. El cursor es opaco para el frontend (base64 de los valores).
+# Para exportaciones completas existe además un modo de streaming NDJSON (una línea JSON
+# por elemento) que recorre la query con yield_per, manteniendo la memoria constante.
+
+import base64
+import json
+from datetime import datetime, date
+
+from flask import Response, request, stream_with_context
+from sqlalchemy import and_, or_
+
+
+PAGINATION_DEFAULT_LIMIT = 50
+PAGINATION_MAX_LIMIT = 500
+STREAM_YIELD_PER = 500
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def parse_limit(valor, default=PAGINATION_DEFAULT_LIMIT, maximo=PAGINATION_MAX_LIMIT):
+    """
+    Convierte el parámetro ?limit= en un entero entre 1 y `maximo`. Devuelve `default` si no es válido.
+    """
+    try:
+        limit = int(valor)
+    except (TypeError, ValueError):
+        return default
+    if limit <= 0:
+        return default
+    return min(limit, maximo)
+
+
+def _a_json(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return valor
+
+
+def _desde_json(valor, columna):
+    if valor is None:
+        return None
+    python_type = columna.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(valor)
+    if python_type is date:
+        return date.fromisoformat(valor)
+    return python_type(valor)
+
+
+def encode_cursor(valores):
+    """
+    Codifica los valores de ordenamiento del último elemento como un cursor opaco.
+    """
+    crudo = json.dumps([_a_json(v) for v in valores], separators=(',', ':'))
+    return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columnas):
+    """
+    Decodifica un cursor generado por encode_cursor según los tipos de `columnas`.
+    """
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + relleno).decode('utf-8'))
+        if not isinstance(valores, list) or len(valores) != len(columnas):
+            raise CursorInvalido("Cursor de paginación inválido.")
+        return [_desde_json(v, c) for v, c in zip(valores, columnas)]
+    except CursorInvalido:
+        raise
+    except Exception:
+        raise CursorInvalido("Cursor de paginación inválido.")
+
+
+def _condicion_despues_de(columnas, valores, descendente):
+    """
+    Condición "(c1, c2, ...) después de (v1, v2, ...)" expandida con OR/AND para que funcione en cualquier motor.
+    """
+    condiciones = []
+    for i, (columna, valor) in enumerate(zip(columnas, valores)):
+        iguales = [columnas[j] == valores[j] for j in range(i)]
+        comparacion = columna < valor if descendente else columna > valor
+        condiciones.append(and_(*iguales, comparacion))
+    return or_(*condiciones)
+
+
+def ordenar_keyset(query, columnas, descendente=True):
+    """
+    Ordena la query por `columnas` (la última debe ser única, normalmente la llave primaria).
+    """
+    return query.order_by(*[c.desc() if descendente else c.asc() for c in columnas])
+
+
+def filtrar_despues_de(query, columnas, after, descendente=True):
+    """
+    Aplica el cursor ?after= a una query. Lanza CursorInvalido si el cursor no es válido.
+    """
+    if not after:
+        return query
+    valores = decode_cursor(after, columnas)
+    return query.filter(_condicion_despues_de(columnas, valores, descendente))
+
+
+def paginar_keyset(query, columnas, after=None, limit=PAGINATION_DEFAULT_LIMIT, descendente=True):
+    """
+    Devuelve (items, next_cursor) para una página de `limit` elementos ordenados por `columnas`.
+    next_cursor es None cuando no hay más páginas.
+    """
+    query = filtrar_despues_de(ordenar_keyset(query, columnas, descendente), columnas, after, descendente)
+    items = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        ultimo = items[-1]
+        next_cursor = encode_cursor([getattr(ultimo, c.key) for c in columnas])
+    return items, next_cursor
+
+
+def pide_paginacion():
+    """
+    Indica si la petición usa paginación por cursor (?limit= o ?after=).
+    """
+    return bool(request.args.get('after') or request.args.get('limit'))
+
+
+def pide_stream():
+    """
+    Indica si la petición solicita el modo streaming NDJSON (?stream=ndjson o Accept: application/x-ndjson).
+    """
+    return request.args.get('stream') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+def stream_ndjson(query, serializar, yield_per=STREAM_YIELD_PER):
+    """
+    Respuesta en streaming con un objeto JSON por línea. La query se recorre por bloques de `yield_per`
+    filas, así que la memoria del worker no depende del tamaño del resultado.
+    """
+    def generar():
+        for item in query.yield_per(yield_per):
+            yield json.dumps(serializar(item), default=str, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generar()), mimetype='application/x-ndjson')
@@ -0,0 +1,364 @@
+# src/api/resumable_uploads.py
+
+# Subidas reanudables por partes para archivos grandes (PDFs de documentos, imagen de perfil, firma).
+# Protocolo:
+#   1) POST /subidas                     -> crea la subida (tamaño, tipo, propósito) y devuelve su id
+#   2) PUT  /subidas/<id>?offset=N        -> agrega una parte (cuerpo binario) a partir del byte N
+#   3) POST /subidas/<id>/finalizar       -> la tarea en segundo plano verifica, sube y aplica el archivo
+#   GET /subidas/<id> informa el offset y el estado: tras un corte de red el cliente sigue desde ahí.
+# Cada parte se copia por bloques del socket a un archivo en SUBIDAS_SPOOL_DIR, así que el worker
+# nunca tiene el archivo completo en memoria. El offset se reserva con un UPDATE condicional antes
+# de escribir, de modo que dos peticiones con la misma parte no pueden escribir a la vez.
+# Si el proceso muere a mitad de una parte (ej. timeout del worker de gunicorn), la reserva queda por
+# delante de lo escrito: reconciliar_offset la ajusta al tamaño real del archivo cuando la parte lleva
+# SUBIDAS_PARTE_TIMEOUT sin progreso, y escribir_parte nunca escribe más allá del final del archivo
+# (eso dejaría un hueco de ceros que la verificación por tamaño no detecta).
+# SUBIDAS_SPOOL_DIR debe ser un disco compartido por todas las instancias web (o enrutar cada subida
+# siempre a la misma instancia): una parte que llega a una instancia sin las anteriores se rechaza con 409.
+
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+
+from sqlalchemy import update
+
+from api.models import db, SubidaReanudable, DocumentosMinisterio, Usuario
+from api.catalog_cache import invalidar_catalogo, DOCUMENTOS
+from api.media_queue import cancelar_firma_usuario
+from api.storage import obtener_almacenamiento
+
+
+SUBIDAS_SPOOL_DIR = os.getenv('SUBIDAS_SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'auditease-subidas')
+SUBIDAS_TAMANO_MAX = int(os.getenv('SUBIDAS_TAMANO_MAX', 50 * 1024 * 1024))
+SUBIDAS_PARTE_MAX = int(os.getenv('SUBIDAS_PARTE_MAX', 8 * 1024 * 1024))
+SUBIDAS_EXPIRACION = int(os.getenv('SUBIDAS_EXPIRACION', 24 * 3600))  # segundos sin actividad antes de descartar
+SUBIDAS_LEASE = int(os.getenv('SUBIDAS_LEASE', 600))  # segundos antes de reintentar una finalización que no terminó
+SUBIDAS_WORKERS = int(os.getenv('SUBIDAS_WORKERS', 2))
+# Segundos sin progreso tras los cuales una parte reservada se da por abandonada (mayor que el timeout de gunicorn)
+SUBIDAS_PARTE_TIMEOUT = int(os.getenv('SUBIDAS_PARTE_TIMEOUT', 120))
+
+_BLOQUE = 64 * 1024
+_LATIDO = 15  # segundos entre actualizaciones de fecha_actualizacion mientras se escribe una parte
+
+# Propósito -> prefijo de content type aceptado
+PROPOSITOS = {
+    'documento_pdf': 'application/pdf',
+    'imagen_perfil': 'image/',
+    'firma_digital': 'image/',
+}
+
+_pool = None
+_pool_lock = Lock()
+
+
+class SubidaInvalida(ValueError):
+    pass
+
+
+class ConflictoOffset(Exception):
+    """
+    La parte no empieza donde termina lo ya recibido (o la subida ya no admite partes).
+    """
+    def __init__(self, offset, mensaje="El offset no coincide con los bytes recibidos."):
+        super().__init__(mensaje)
+        self.offset = offset
+
+
+def ruta_spool(subida_id):
+    return os.path.join(SUBIDAS_SPOOL_DIR, f"{subida_id}.part")
+
+
+def _borrar_spool(subida_id):
+    try:
+        os.remove(ruta_spool(subida_id))
+    except FileNotFoundError:
+        pass
+
+
+def crear_subida(id_usuario, proposito, tamano_total, content_type, nombre_archivo=None, sha256=None, metadatos=None):
+    """
+    Valida y agrega a la sesión una nueva subida. No hace commit.
+    """
+    if proposito not in PROPOSITOS:
+        raise SubidaInvalida(f"Propósito no válido. Opciones: {', '.join(PROPOSITOS)}.")
+    if not isinstance(content_type, str) or not content_type.startswith(PROPOSITOS[proposito]):
+        raise SubidaInvalida(f"Tipo de archivo no permitido para '{proposito}'.")
+    if isinstance(tamano_total, bool) or not isinstance(tamano_total, int) or not (0 < tamano_total <= SUBIDAS_TAMANO_MAX):
+        raise SubidaInvalida(f"El tamaño debe estar entre 1 y {SUBIDAS_TAMANO_MAX} bytes.")
+    if sha256 is not None and (not isinstance(sha256, str) or len(sha256) != 64):
+        raise SubidaInvalida("'sha256' debe ser el hash hexadecimal del archivo completo.")
+
+    subida = SubidaReanudable(
+        id=uuid.uuid4().hex,
+        id_usuario=id_usuario,
+        proposito=proposito,
+        nombre_archivo=(nombre_archivo or None) and str(nombre_archivo)[:255],
+        content_type=content_type,
+        tamano_total=tamano_total,
+        sha256=sha256.lower() if sha256 else None,
+        metadatos=metadatos
+    )
+    db.session.add(subida)
+    return subida
+
+
+def _tamano_en_disco(subida_id):
+    try:
+        return os.path.getsize(ruta_spool(subida_id))
+    except FileNotFoundError:
+        return 0
+
+
+def _liberar(subida_id, reservado, recibidos):
+    # Devuelve el offset reservado a los bytes que realmente están en el archivo
+    db.session.execute(
+        update(SubidaReanudable)
+        .where(SubidaReanudable.id == subida_id, SubidaReanudable.recibidos == reservado)
+        .values(recibidos=recibidos, fecha_actualizacion=datetime.utcnow())
+    )
+    db.session.commit()
+
+
+def reconciliar_offset(subida):
+    """
+    Ajusta `recibidos` al tamaño real del archivo si quedó por delante de él por una parte abandonada
+    (sin progreso durante SUBIDAS_PARTE_TIMEOUT). Devuelve el offset vigente. Hace commit si lo cambia.
+    """
+    if subida.estado != 'recibiendo':
+        return subida.recibidos
+    en_disco = _tamano_en_disco(subida.id)
+    if en_disco >= subida.recibidos:
+        return subida.recibidos
+    limite = datetime.utcnow() - timedelta(seconds=SUBIDAS_PARTE_TIMEOUT)
+    if subida.fecha_actualizacion and subida.fecha_actualizacion > limite:
+        return subida.recibidos  # La parte aún puede estar escribiéndose
+    print(f"ADVERTENCIA: La subida {subida.id} tenía reservados {subida.recibidos} bytes pero solo {en_disco} en disco; se reanuda desde ahí.")
+    subida_id = subida.id
+    _liberar(subida_id, subida.recibidos, en_disco)
+    return db.session.get(SubidaReanudable, subida_id, populate_existing=True).recibidos
+
+
+def _reservar(subida_id, desde, hasta):
+    resultado = db.session.execute(
+        update(SubidaReanudable)
+        .where(SubidaReanudable.id == subida_id,
+               SubidaReanudable.estado == 'recibiendo',
+               SubidaReanudable.recibidos == desde)
+        .values(recibidos=hasta, fecha_actualizacion=datetime.utcnow())
+    )
+    db.session.commit()
+    return resultado.rowcount == 1
+
+
+def escribir_parte(subida, offset, flujo, longitud):
+    """
+    Copia `longitud` bytes de `flujo` al archivo de la subida a partir de `offset` y devuelve el
+    nuevo offset. Si la conexión se corta a mitad de la parte se conserva lo que alcanzó a llegar.
+    """
+    if subida.estado != 'recibiendo':
+        raise ConflictoOffset(subida.recibidos, "La subida ya no admite más partes.")
+    reconciliar_offset(subida)
+    if offset != subida.recibidos:
+        raise ConflictoOffset(subida.recibidos)
+    if not longitud or longitud <= 0 or longitud > SUBIDAS_PARTE_MAX:
+        raise SubidaInvalida(f"Cada parte debe tener entre 1 y {SUBIDAS_PARTE_MAX} bytes (Content-Length).")
+    if offset + longitud > subida.tamano_total:
+        raise SubidaInvalida("La parte excede el tamaño declarado del archivo.")
+
+    subida_id = subida.id
+    if not _reservar(subida_id, offset, offset + longitud):
+        raise ConflictoOffset(db.session.get(SubidaReanudable, subida_id, populate_existing=True).recibidos)
+
+    # Las partes anteriores deben estar en este disco: si faltan bytes (una parte abandonada, o el
+    # spool no es compartido entre instancias) escribir en `offset` dejaría un hueco
+    en_disco = _tamano_en_disco(subida_id)
+    if en_disco < offset:
+        print(f"ADVERTENCIA: La subida {subida_id} tiene {en_disco} bytes en {SUBIDAS_SPOOL_DIR} y se esperaban {offset}. "
+              f"¿SUBIDAS_SPOOL_DIR no es compartido por todas las instancias?")
+        _liberar(subida_id, offset + longitud, en_disco)
+        raise ConflictoOffset(en_disco, "Faltan bytes de partes anteriores; continúa desde el offset indicado.")
+
+    escritos = 0
+    try:
+        os.makedirs(SUBIDAS_SPOOL_DIR, exist_ok=True)
+        ruta = ruta_spool(subida_id)
+        ultimo_latido = time.monotonic()
+        with open(ruta, 'r+b' if os.path.exists(ruta) else 'wb') as archivo:
+            archivo.seek(offset)
+            while escritos < longitud:
+                if time.monotonic() - ultimo_latido > _LATIDO:
+                    # Una parte lenta no es una parte abandonada (ver reconciliar_offset)
+                    db.session.execute(
+                        update(SubidaReanudable).where(SubidaReanudable.id == subida_id)
+                        .values(fecha_actualizacion=datetime.utcnow())
+                    )
+                    db.session.commit()
+                    ultimo_latido = time.monotonic()
+                try:
+                    bloque = flujo.read(min(_BLOQUE, longitud - escritos))
+                except Exception as e:  # El cliente cortó la conexión a mitad de la parte
+                    print(f"ADVERTENCIA: Parte incompleta en la subida {subida_id}: {e}")
+                    bloque = b''
+                if not bloque:
+                    break
+                archivo.write(bloque)
+                escritos += len(bloque)
+            archivo.truncate(offset + escritos)
+    finally:
+        if escritos < longitud:
+            # Parte incompleta: el offset vuelve a lo que realmente quedó escrito
+            _liberar(subida_id, offset + longitud, offset + escritos)
+    if escritos < longitud:
+        raise ConflictoOffset(offset + escritos, "La parte llegó incompleta; continúa desde el offset indicado.")
+    return offset + escritos
+
+
+def cancelar_subida(subida):
+    """
+    Cancela la subida y borra su archivo temporal. No hace commit.
+    """
+    subida.estado = 'cancelado'
+    _borrar_spool(subida.id)
+
+
+def limpiar_expiradas():
+    """
+    Descarta las subidas sin actividad durante SUBIDAS_EXPIRACION y sus archivos temporales.
+    """
+    limite = datetime.utcnow() - timedelta(seconds=SUBIDAS_EXPIRACION)
+    expiradas = SubidaReanudable.query.filter(
+        SubidaReanudable.estado.in_(('recibiendo', 'fallido')),
+        SubidaReanudable.fecha_actualizacion < limite
+    ).all()
+    for subida in expiradas:
+        cancelar_subida(subida)
+    if expiradas:
+        db.session.commit()
+    return len(expiradas)
+
+
+# --- Finalización en segundo plano ---
+
+def _obtener_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=SUBIDAS_WORKERS, thread_name_prefix='subidas')
+        return _pool
+
+
+def iniciar_finalizacion(app, subida):
+    """
+    Marca la subida como 'ensamblando' y encola su procesamiento. Devuelve False si otro proceso
+    ya la está finalizando. También permite reintentar una finalización fallida o abandonada.
+    """
+    if reconciliar_offset(subida) != subida.tamano_total:
+        raise ConflictoOffset(subida.recibidos, "Aún faltan partes por recibir.")
+    abandonada = datetime.utcnow() - timedelta(seconds=SUBIDAS_LEASE)
+    subida_id = subida.id
+    resultado = db.session.execute(
+        update(SubidaReanudable)
+        .where(SubidaReanudable.id == subida_id,
+               SubidaReanudable.recibidos == SubidaReanudable.tamano_total,
+               (SubidaReanudable.estado.in_(('recibiendo', 'fallido'))) |
+               ((SubidaReanudable.estado == 'ensamblando') & (SubidaReanudable.fecha_actualizacion < abandonada)))
+        .values(estado='ensamblando', ultimo_error=None, fecha_actualizacion=datetime.utcnow())
+    )
+    db.session.commit()
+    if resultado.rowcount != 1:
+        return False
+    _obtener_pool().submit(_procesar, app, subida_id)
+    return True
+
+
+def _verificar(subida, ruta):
+    if os.path.getsize(ruta) != subida.tamano_total:
+        raise SubidaInvalida("El archivo ensamblado no tiene el tamaño declarado.")
+    resumen = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        cabecera = archivo.read(5)
+        if subida.proposito == 'documento_pdf' and cabecera != b'%PDF-':
+            raise SubidaInvalida("El archivo no es un PDF válido.")
+        if subida.sha256:
+            resumen.update(cabecera)
+            for bloque in iter(lambda: archivo.read(_BLOQUE), b''):
+                resumen.update(bloque)
+    if subida.sha256 and resumen.hexdigest() != subida.sha256:
+        raise SubidaInvalida("El hash SHA-256 del archivo no coincide.")
+
+
+def almacenar_archivo(ruta, subida):
+    """
+    Sube el archivo ensamblado al almacenamiento configurado (en Cloudinary, por partes) y devuelve su URL.
+    """
+    tipo_recurso = 'raw' if subida.proposito == 'documento_pdf' else 'image'
+    return obtener_almacenamiento().guardar_ruta(ruta, tipo_recurso, subida.content_type)
+
+
+def _aplicar(subida, url):
+    """
+    Crea o actualiza el registro destino según el propósito. Devuelve el resultado a guardar.
+    """
+    if subida.proposito == 'documento_pdf':
+        metadatos = subida.metadatos or {}
+        documento = DocumentosMinisterio(
+            nombre=metadatos.get('titulo'),
+            url_archivo=url,
+            fecha_subida=datetime.utcnow(),
+            user_id=subida.id_usuario,
+            categoria_id=int(metadatos.get('categoria_id')),
+            tipo_contenido='pdf'
+        )
+        db.session.add(documento)
+        db.session.flush()
+        return {"documento": documento.serialize()}
+
+    usuario = db.session.get(Usuario, subida.id_usuario)
+    if not usuario:
+        raise SubidaInvalida("El usuario de la subida ya no existe.")
+    if subida.proposito == 'imagen_perfil':
+        usuario.imagen_perfil_url = url
+        return {"imagen_perfil_url": url}
+    usuario.firma_digital_url = url
+    return {"firma_url": url}
+
+
+def _procesar(app, subida_id):
+    with app.app_context():
+        try:
+            subida = db.session.get(SubidaReanudable, subida_id)
+            if not subida or subida.estado != 'ensamblando':
+                return
+            ruta = ruta_spool(subida_id)
+            _verificar(subida, ruta)
+            db.session.commit()  # Sin transacción abierta mientras se sube
+
+            url = almacenar_archivo(ruta, subida)
+            subida = db.session.get(SubidaReanudable, subida_id)
+            if subida.proposito == 'firma_digital':
+                # Evita que una firma en la cola de subida diferida reemplace a esta más tarde
+                cancelar_firma_usuario(subida.id_usuario)
+            subida.resultado = _aplicar(subida, url)
+            subida.url_resultado = url
+            subida.estado = 'completado'
+            db.session.commit()
+            if subida.proposito == 'documento_pdf':
+                invalidar_catalogo(DOCUMENTOS)
+            _borrar_spool(subida_id)
+            print(f"DEBUG BACKEND: Subida reanudable {subida_id} completada ({subida.tamano_total} bytes).")
+        except Exception as e:
+            db.session.rollback()
+            print(f"ERROR BACKEND: Error al finalizar la subida reanudable {subida_id}: {e}")
+            db.session.execute(
+                update(SubidaReanudable)
+                .where(SubidaReanudable.id == subida_id)
+                .values(estado='fallido', ultimo_error=str(e)[:1000], fecha_actualizacion=datetime.utcnow())
+            )
+            db.session.commit()
+        finally:
+            db.session.remove()
@@ -1,30 +1,43 @@
 # src/api/routes.py
 
 # ... (tus otras importaciones existentes)
-from flask import Flask, request, jsonify, url_for, Blueprint, redirect, current_app
-from api.models import db, Usuario, Empresa, Espacio, SubEspacio, Objeto, Formulario, Pregunta, TipoRespuesta, EnvioFormulario, Respuesta, Observacion, Notificacion, formulario_espacio, formulario_subespacio, formulario_objeto, formulario_tipo_respuesta, DocumentosMinisterio, DocumentoCategoria, formulario_espacio, formulario_subespacio, formulario_objeto, formulario_tipo_respuesta, Grado, Concepto, Estudiante, TransaccionRecibo, DetalleRecibo 
+from flask import Flask, request, jsonify, url_for, Blueprint, redirect, current_app, Response
+from api.models import db, Usuario, Empresa, Espacio, SubEspacio, Objeto, Formulario, Pregunta, TipoRespuesta, EnvioFormulario, Respuesta, Observacion, Notificacion, SubidaReanudable, formulario_espacio, formulario_subespacio, formulario_objeto, formulario_tipo_respuesta, DocumentosMinisterio, DocumentoCategoria, formulario_espacio, formulario_subespacio, formulario_objeto, formulario_tipo_respuesta, formulario_empresa_compartida, Grado, Concepto, Estudiante, TransaccionRecibo, DetalleRecibo 
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, JWTManager
-from datetime import datetime, timedelta, date, time # Importa date
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt, JWTManager
+from datetime import datetime, timedelta, time
 import re
-from sqlalchemy import func, and_, cast, Date, Time, or_
-from sqlalchemy.orm import joinedload
+from sqlalchemy import func, and_, Date, Time, or_, insert
+from sqlalchemy.orm import joinedload, selectinload
 
 from collections import Counter
 import json
-from sqlalchemy.dialects.postgresql import JSONB
 
 # *** IMPORTACIONES NECESARIAS PARA CLOUDINARY ***
-import cloudinary
-import cloudinary.uploader
 import base64 # Para decodificar base64 de firmas
 
-from threading import Thread
-from flask_mail import Message
 from itsdangerous import URLSafeTimedSerializer
 import os
 
+from api.auth_cache import get_current_principal, get_current_usuario, obtener_principal, obtener_usuario_serializado, invalidar_principal_usuario, invalidar_principal_empresa
+from api.form_access import puede_acceder_formulario, condicion_formularios_accesibles, condicion_plantillas_accesibles, registrar_formulario, quitar_formulario, reiniciar_indice_formularios
+from api.serializers import serializador_desde_request, CampoInvalido
+from api.http_cache import estado_formulario, etag_formulario, respuesta_no_modificada, con_etag
+from api.catalog_cache import obtener_catalogo, invalidar_catalogo, CATALOGO_MAX_AGE, TIPOS_RESPUESTA, DOCUMENTOS, GRADOS, CONCEPTOS
+from api.media_uploads import decodificar_imagen
+from api.storage import obtener_almacenamiento, eliminar_archivo, almacenamiento_local
+from api.cloudinary_client import ProveedorNoDisponible, metricas_cloudinary
+from api.media_dedup import subir_deduplicado, sumar_referencias
+from api.strokes import normalizar_lista_trazos, renderizar, TrazosInvalidos, FORMATOS_DISPONIBLES, CONTENT_TYPES
+from api.resumable_uploads import crear_subida, escribir_parte, reconciliar_offset, iniciar_finalizacion, cancelar_subida, limpiar_expiradas, SubidaInvalida, ConflictoOffset
+from api.mail_outbox import encolar_plantilla, encolar_recibo, cancelar_recibos_retenidos, correos_encolados
+from api.email_templates import marca_empresa, invalidar_marca
+from api.media_queue import subida_diferida, encolar_respuesta, encolar_firma_usuario, cancelar_firma_usuario, asegurar_worker_media, despertar_worker_media
+from api.pagination import paginar_keyset, ordenar_keyset, filtrar_despues_de, parse_limit, pide_paginacion, pide_stream, stream_ndjson, CursorInvalido
+from api.token_registry import claims_para_usuario, revocar_token, revocar_tokens_usuario, actualizar_version_empresa
+from api.form_automation import ejecutar_automatizacion, programar_automatizacion
+
 
 api = Blueprint('api', __name__)
 
@@ -47,14 +60,31 @@ def validate_password(password):
         return False, "La contraseña debe contener al menos un número."
     return True, "Contraseña válida"
 
+# NUEVO: Ventana del modo resumen de recibos (vacío = valor global, 0 = envío inmediato, máximo un día)
+def aplicar_resumen_recibos(empresa, valor):
+    """
+    Asigna empresa.recibos_resumen_minutos desde el formulario. Devuelve el mensaje de error o None.
+    """
+    if valor is None or str(valor).strip() == '':
+        empresa.recibos_resumen_minutos = None
+        return None
+    try:
+        minutos = int(valor)
+    except (TypeError, ValueError):
+        return "recibos_resumen_minutos debe ser un número entero de minutos."
+    if minutos < 0 or minutos > 1440:
+        return "recibos_resumen_minutos debe estar entre 0 y 1440."
+    empresa.recibos_resumen_minutos = minutos
+    return None
+
 # Decorador para verificar rol
 def role_required(allowed_roles):
     def decorator(fn):
         @jwt_required()
         def wrapper(*args, **kwargs):
-            current_user_id = get_jwt_identity()
-            usuario = Usuario.query.get(int(current_user_id))
-            if not usuario or usuario.rol not in allowed_roles:
+            # El principal se resuelve una vez por petición y queda disponible en g para el handler
+            principal = get_current_principal()
+            if not principal or principal.rol not in allowed_roles:
                 return jsonify({"error": "Acceso no autorizado: No tienes el rol requerido"}), 403
             return fn(*args, **kwargs)
         # Esto es necesario para que Flask reconozca la ruta correctamente
@@ -89,32 +119,16 @@ def send_contact_email():
 
     # Lógica corregida para enviar el correo
     try:
-        # Creamos el mensaje de correo.
-        msg = Message(
-            subject=f"Nueva solicitud de empresa: {company_name}",
-            sender='sgsstflow@gmail.com',
-            recipients=['sgsstflow@gmail.com']
-        )
-        
-        # El cuerpo del mensaje contendrá los datos del formulario.
-        msg.body = (
-            f"Hola equipo SGSST Flow,\n\n"
-            f"¡Tienes una nueva solicitud de registro de empresa!\n\n"
-            f"Detalles:\n"
-            f"- Nombre de la empresa: {company_name}\n"
-            f"- Nombre del responsable: {responsible_name}\n"
-            f"- Correo electrónico: {email}\n"
-            f"- WhatsApp: {whatsapp if whatsapp else 'No proporcionado'}\n\n"
-            f"Por favor, ponte en contacto con ellos lo antes posible."
-        )
-
-        # Accedemos a la instancia de Flask-Mail usando `current_app`
-        # Este es el cambio clave que soluciona el error.
-        mail_instance = current_app.extensions.get('mail')
-        if mail_instance:
-            mail_instance.send(msg)
-        else:
-            raise RuntimeError("Flask-Mail no se ha inicializado correctamente en la aplicación.")
+        # NUEVO: El correo queda en la bandeja de salida con su plantilla (correos/contacto.txt);
+        # el worker genera el cuerpo y lo envía, se responde sin esperar al SMTP
+        encolar_plantilla('contacto', {
+            "company_name": company_name,
+            "responsible_name": responsible_name,
+            "email": email,
+            "whatsapp": whatsapp
+        }, ['sgsstflow@gmail.com'], remitente='sgsstflow@gmail.com')
+        db.session.commit()
+        correos_encolados(current_app._get_current_object())
 
         # Responde con un mensaje de éxito si el envío es exitoso.
         return jsonify({
@@ -122,6 +136,7 @@ def send_contact_email():
         }), 200
     except Exception as e:
         # Si hay un error, responde con un error 500 y un mensaje útil.
+        db.session.rollback()
         print(f"Error al enviar el correo: {e}")
         return jsonify({"message": f"Error del servidor al enviar el correo: {str(e)}"}), 500
 
@@ -257,10 +272,10 @@ def login():
             return jsonify({"error": "Usuario inactivo. Contacta al administrador."}), 403
         
         # NUEVO: Bloquear login si la empresa del usuario está inactiva (excepto para el owner)
-        if usuario.id_empresa: # Solo si el usuario está asociado a una empresa
-            empresa = Empresa.query.get(usuario.id_empresa)
-            if empresa and not empresa.activo and usuario.rol != 'owner':
-                return jsonify({"error": "La empresa a la que perteneces está inactiva. Contacta al administrador."}), 403
+        # Se usa la caché de principal, que además queda precargada para las peticiones siguientes
+        principal = obtener_principal(usuario.id_usuario)
+        if principal and not principal.empresa_activo and usuario.rol != 'owner':
+            return jsonify({"error": "La empresa a la que perteneces está inactiva. Contacta al administrador."}), 403
 
 
         if not check_password_hash(usuario.contrasena_hash, password):
@@ -269,8 +284,10 @@ def login():
         usuario.ultimo_login = datetime.utcnow()
         db.session.commit()
 
+        # NUEVO: El token lleva rol, empresa y versión de estado de la empresa para no consultar la BD en cada petición
         access_token = create_access_token(
             identity=str(usuario.id_usuario),
+            additional_claims=claims_para_usuario(usuario),
             expires_delta=timedelta(hours=24)
         )
 
@@ -287,25 +304,27 @@ def login():
 @jwt_required()
 def verificar_token():
     try:
-        current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        principal = get_current_principal()
 
-        if not usuario:
+        if not principal:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
         # MODIFICADO: Verificar si el usuario está activo
-        if not usuario.activo:
+        if not principal.usuario_activo:
             return jsonify({"valid": False, "error": "Usuario inactivo"}), 403
-        
+
         # NUEVO: Verificar si la empresa del usuario está activa (excepto para el owner)
-        if usuario.id_empresa:
-            empresa = Empresa.query.get(usuario.id_empresa)
-            if empresa and not empresa.activo and usuario.rol != 'owner':
-                return jsonify({"valid": False, "error": "La empresa a la que perteneces está inactiva."}), 403
+        if not principal.empresa_activo and principal.rol != 'owner':
+            return jsonify({"valid": False, "error": "La empresa a la que perteneces está inactiva."}), 403
+
+        # La revocación ya se comprobó contra el principal en caché al validar el token; el perfil sale de la caché
+        usuario_data = obtener_usuario_serializado(principal.id_usuario)
+        if not usuario_data:
+            return jsonify({"error": "Usuario no encontrado"}), 404
 
         return jsonify({
             "valid": True,
-            "usuario": usuario.serialize()
+            "usuario": usuario_data
         }), 200
 
     except Exception as e:
@@ -322,7 +341,7 @@ def gestionar_perfil():
     disponibles en el método serialize() del modelo Usuario.
     """
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -384,7 +403,7 @@ def upload_user_profile_image():
     Espera un archivo de imagen (FormData) o un JSON con 'clear_image: true' para borrar.
     """
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -411,8 +430,7 @@ def upload_user_profile_image():
             elif not imagen_perfil_file.content_type.startswith('image/'):
                 return jsonify({"error": "El archivo de imagen de perfil debe ser una imagen."}), 400
             
-            upload_result = cloudinary.uploader.upload(imagen_perfil_file)
-            usuario.imagen_perfil_url = upload_result['secure_url']
+            usuario.imagen_perfil_url = obtener_almacenamiento().guardar(imagen_perfil_file, 'image', imagen_perfil_file.content_type)
             
         else:
             return jsonify({"error": "No se proporcionó ninguna imagen de perfil (ni archivo ni bandera de borrado)."}), 400
@@ -420,6 +438,9 @@ def upload_user_profile_image():
         db.session.commit()
         return jsonify({"message": "Imagen de perfil actualizada exitosamente", "imagen_perfil_url": usuario.imagen_perfil_url}), 200
 
+    except ProveedorNoDisponible as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         db.session.rollback()
         print(f"Error al subir la imagen de perfil del usuario: {str(e)}")
@@ -435,7 +456,7 @@ def upload_user_signature():
     Espera un archivo de imagen (FormData), base64, o un JSON con 'clear_signature: true' para borrar.
     """
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -451,27 +472,50 @@ def upload_user_signature():
 
         if clear_signature_flag:
             usuario.firma_digital_url = None # Establecer a None para borrar
+            cancelar_firma_usuario(usuario.id_usuario) # Una firma en cola no debe reaparecer después de borrarla
             db.session.commit()
             return jsonify({"message": "Firma digital eliminada exitosamente", "firma_url": None}), 200
 
         if firma_file:
             if firma_file.filename == '': # Si se envía un archivo vacío, se interpreta como una solicitud de borrado
                 usuario.firma_digital_url = None
+                cancelar_firma_usuario(usuario.id_usuario)
                 db.session.commit()
                 return jsonify({"message": "Firma digital eliminada exitosamente", "firma_url": None}), 200
             elif not firma_file.content_type.startswith('image/'):
                 return jsonify({"error": "El archivo de firma debe ser una imagen."}), 400
-            
-            upload_result = cloudinary.uploader.upload(firma_file)
-            usuario.firma_digital_url = upload_result['secure_url']
-            
-        elif firma_base64:
-            # Cloudinary puede subir directamente desde base64
-            upload_result = cloudinary.uploader.upload(firma_base64)
-            usuario.firma_digital_url = upload_result['secure_url']
+
+        # NUEVO: Modo diferido: se guarda la imagen en cola y se responde sin esperar a Cloudinary
+        if subida_diferida() and (firma_file or firma_base64):
+            if firma_file:
+                contenido, content_type = firma_file.read(), firma_file.content_type
+            else:
+                try:
+                    contenido, content_type = decodificar_imagen(firma_base64)
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+            encolar_firma_usuario(usuario.id_usuario, contenido, content_type)
+            db.session.commit()
+            asegurar_worker_media(current_app._get_current_object())
+            despertar_worker_media()
+            return jsonify({
+                "message": "Firma digital recibida. Se procesará en segundo plano.",
+                "firma_url": usuario.firma_digital_url,
+                "pendiente": True
+            }), 202
+
+        if firma_file or firma_base64:
+            # Si la misma imagen ya se subió antes (mismo SHA-256) se reutiliza su URL
+            firma = firma_file.read() if firma_file else firma_base64
+            firma_url = subir_deduplicado([('firma_digital', firma)]).get('firma_digital')
+            if not firma_url:
+                return jsonify({"error": "No se pudo subir la firma digital. Intenta nuevamente."}), 500
+            usuario.firma_digital_url = firma_url
         else:
             return jsonify({"error": "No se proporcionó ninguna imagen de firma (ni archivo, ni base64, ni bandera de borrado)."}), 400
 
+        # Una subida inmediata reemplaza cualquier firma que siguiera en cola
+        cancelar_firma_usuario(usuario.id_usuario)
         db.session.commit()
         return jsonify({"message": "Firma digital actualizada exitosamente", "firma_url": usuario.firma_digital_url}), 200
 
@@ -507,20 +551,18 @@ def solicitar_recuperacion_password():
         frontend_url = os.environ.get("FRONTEND_URL", "http://localhost:5173")
         link_recuperacion = f"{frontend_url}/restablecer-password/{token}"
         
-        # Acceder a la instancia de mail inicializada en app.py
-        mail_sender = current_app.extensions.get('mail')
-        if not mail_sender:
-            return jsonify({"error": "El servicio de correo no está configurado correctamente."}), 500
-        
-        msg = Message("Recuperación de Contraseña",
-                      sender=current_app.config['MAIL_USERNAME'],
-                      recipients=[usuario.email])
-        msg.body = f"Hola {usuario.nombre_completo},\n\nHaz clic en el siguiente enlace para restablecer tu contraseña:\n\n{link_recuperacion}\n\nEste enlace expirará en una hora."
-        mail_sender.send(msg)
+        # NUEVO: Se encola en la bandeja de salida (el tiempo de respuesta ya no revela si el email existe)
+        encolar_plantilla('recuperacion_password', {
+            "nombre": usuario.nombre_completo,
+            "link_recuperacion": link_recuperacion
+        }, [usuario.email], remitente=current_app.config['MAIL_USERNAME'], id_empresa=usuario.id_empresa)
+        db.session.commit()
+        correos_encolados(current_app._get_current_object())
 
         return jsonify({"message": "Si tu correo está en nuestro sistema, recibirás un enlace para restablecer tu contraseña."}), 200
 
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
 
@@ -574,7 +616,7 @@ def restablecer_password():
 def cambiar_password():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -635,30 +677,32 @@ def recuperar_password():
 @jwt_required()
 def logout():
     try:
+        # NUEVO: Revocar el token actual para que no pueda reutilizarse hasta su expiración
+        jwt_data = get_jwt()
+        revocar_token(jwt_data.get('jti'), jwt_data.get('exp'))
         return jsonify({"message": "Logout exitoso"}), 200
 
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
 @api.route('/dashboard', methods=['GET'])
 @jwt_required()
 def dashboard():
     try:
-        current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        principal = get_current_principal()
 
-        if not usuario:
+        if not principal:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
-        if not usuario.activo:
+        if not principal.usuario_activo:
             return jsonify({"error": "Usuario inactivo. Contacta al administrador."}), 403
 
         # NUEVO: Verificar si la empresa del usuario está activa (excepto para el owner)
-        if usuario.id_empresa:
-            empresa = Empresa.query.get(usuario.id_empresa)
-            if empresa and not empresa.activo and usuario.rol != 'owner':
-                return jsonify({"error": "La empresa a la que perteneces está inactiva."}), 403
+        if not principal.empresa_activo and principal.rol != 'owner':
+            return jsonify({"error": "La empresa a la que perteneces está inactiva."}), 403
 
+        usuario = get_current_usuario()
         return jsonify({
             "message": f"Bienvenido al dashboard, {usuario.nombre_completo}!",
             "usuario": usuario.serialize()
@@ -672,7 +716,7 @@ def dashboard():
 def listar_empresas():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if usuario.rol == 'owner':
             empresas = Empresa.query.all()
@@ -693,7 +737,7 @@ def listar_empresas():
 @jwt_required()
 def gestionar_mi_empresa():
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -742,7 +786,13 @@ def gestionar_mi_empresa():
                         return jsonify({"error": "El formato del email de contacto de la empresa no es válido."}), 400
                     empresa.email_contacto = new_email_contacto
 
+                if 'recibos_resumen_minutos' in data:
+                    error_resumen = aplicar_resumen_recibos(empresa, data.get('recibos_resumen_minutos'))
+                    if error_resumen:
+                        return jsonify({"error": error_resumen}), 400
+
                 # Solo el owner puede cambiar el estado 'activo' de una empresa
+                activo_anterior = empresa.activo
                 if usuario.rol == 'owner' and activo_str is not None:
                     empresa.activo = activo_str.lower() == 'true'
                     print(f"DEBUG_OWNER_UPDATE: Activo recibido '{activo_str}', convertido a {empresa.activo}")
@@ -756,13 +806,18 @@ def gestionar_mi_empresa():
                         return jsonify({"error": "El archivo del logo de la empresa debe ser una imagen."}), 400
                     else:
                         try:
-                            upload_result = cloudinary.uploader.upload(logo_empresa)
-                            empresa.logo_url = upload_result['secure_url']
+                            empresa.logo_url = obtener_almacenamiento().guardar(logo_empresa, 'image', logo_empresa.content_type)
+                        except ProveedorNoDisponible as e:
+                            return jsonify({"error": str(e)}), 503
                         except Exception as e:
                             print(f"Error al subir el logo de la empresa a Cloudinary: {str(e)}")
                             return jsonify({"error": f"Error al subir el logo de la empresa a Cloudinary: {str(e)}"}), 500
 
                 db.session.commit()
+                invalidar_principal_empresa(empresa.id_empresa)
+                invalidar_marca(empresa.id_empresa)
+                if empresa.activo != activo_anterior:
+                    actualizar_version_empresa(empresa.id_empresa)
                 return jsonify({"message": "Datos de la empresa actualizados exitosamente", "empresa": empresa.serialize()}), 200
 
             except Exception as e:
@@ -867,6 +922,11 @@ def actualizar_empresa_por_owner(empresa_id):
                 return jsonify({"error": "El formato del email de contacto de la empresa no es válido."}), 400
             empresa.email_contacto = email_contacto if email_contacto else None
 
+        if 'recibos_resumen_minutos' in data:
+            error_resumen = aplicar_resumen_recibos(empresa, data.get('recibos_resumen_minutos'))
+            if error_resumen:
+                return jsonify({"error": error_resumen}), 400
+
         if activo_str is not None:
             empresa.activo = activo_str.lower() == 'true'
             print(f"DEBUG_OWNER_UPDATE: Activo recibido '{activo_str}', convertido a {empresa.activo}")
@@ -889,14 +949,19 @@ def actualizar_empresa_por_owner(empresa_id):
                 return jsonify({"error": "El archivo del logo de la empresa debe ser una imagen."}), 400
             else:
                 try:
-                    upload_result = cloudinary.uploader.upload(logo_empresa)
-                    empresa.logo_url = upload_result['secure_url']
-                    print(f"DEBUG_OWNER_UPDATE: Logo subido a Cloudinary: {empresa.logo_url}")
+                    empresa.logo_url = obtener_almacenamiento().guardar(logo_empresa, 'image', logo_empresa.content_type)
+                    print(f"DEBUG_OWNER_UPDATE: Logo subido al almacenamiento: {empresa.logo_url}")
+                except ProveedorNoDisponible as e:
+                    return jsonify({"error": str(e)}), 503
                 except Exception as e:
                     print(f"Error al subir el logo de la empresa a Cloudinary: {str(e)}")
                     return jsonify({"error": f"Error al subir el logo de la empresa a Cloudinary: {str(e)}"}), 500
 
         db.session.commit()
+        invalidar_principal_empresa(empresa_id)
+        invalidar_marca(empresa_id)
+        if empresa.activo != activo_anterior:
+            actualizar_version_empresa(empresa_id)
         return jsonify({"message": "Empresa actualizada exitosamente.", "empresa": empresa.serialize()}), 200
 
     except Exception as e:
@@ -926,6 +991,8 @@ def desactivar_empresa(empresa_id):
             user.activo = False
         
         db.session.commit()
+        invalidar_principal_empresa(empresa_id)
+        actualizar_version_empresa(empresa_id)
         return jsonify({"message": f"Empresa '{empresa.nombre_empresa}' y sus usuarios han sido desactivados.", "empresa_id": empresa_id}), 200
 
     except Exception as e:
@@ -958,6 +1025,8 @@ def reactivar_empresa(empresa_id):
             user.activo = True
         
         db.session.commit()
+        invalidar_principal_empresa(empresa_id)
+        actualizar_version_empresa(empresa_id)
         return jsonify({"message": f"Empresa '{empresa.nombre_empresa}' y sus usuarios han sido reactivados."}), 200
 
     except Exception as e:
@@ -977,7 +1046,7 @@ def eliminar_empresa_por_owner(empresa_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        owner_user = Usuario.query.get(int(current_user_id))
+        owner_user = get_current_usuario()
 
         empresa_a_desactivar = Empresa.query.get(empresa_id)
         if not empresa_a_desactivar:
@@ -1001,6 +1070,8 @@ def eliminar_empresa_por_owner(empresa_id):
                 db.session.add(user)
 
         db.session.commit()
+        invalidar_principal_empresa(empresa_id)
+        actualizar_version_empresa(empresa_id)
         return jsonify({"message": f"Empresa '{empresa_a_desactivar.nombre_empresa}' y sus usuarios asociados han sido desactivados exitosamente."}), 200
 
     except Exception as e:
@@ -1020,7 +1091,7 @@ def eliminar_empresa_permanentemente(empresa_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        owner_user = Usuario.query.get(int(current_user_id))
+        owner_user = get_current_usuario()
 
         empresa_a_eliminar = Empresa.query.get(empresa_id)
         if not empresa_a_eliminar:
@@ -1074,6 +1145,8 @@ def eliminar_empresa_permanentemente(empresa_id):
         #    se manejan automáticamente por SQLAlchemy si las relaciones están configuradas con `cascade="all, delete-orphan"`
         #    o si se eliminan las filas de las tablas intermedias manualmente.
         #    Para mayor seguridad, eliminaremos las entradas en las tablas intermedias explícitamente.
+        # Quitar a la empresa de las plantillas que otras empresas compartían con ella
+        db.session.execute(formulario_empresa_compartida.delete().where(formulario_empresa_compartida.c.id_empresa == empresa_id))
         formularios_empresa = Formulario.query.filter_by(id_empresa=empresa_id).all()
         for form in formularios_empresa:
             # Eliminar entradas en tablas intermedias de muchos a muchos
@@ -1081,6 +1154,7 @@ def eliminar_empresa_permanentemente(empresa_id):
             db.session.execute(formulario_subespacio.delete().where(formulario_subespacio.c.id_formulario == form.id_formulario))
             db.session.execute(formulario_objeto.delete().where(formulario_objeto.c.id_formulario == form.id_formulario))
             db.session.execute(formulario_tipo_respuesta.delete().where(formulario_tipo_respuesta.c.id_formulario == form.id_formulario))
+            db.session.execute(formulario_empresa_compartida.delete().where(formulario_empresa_compartida.c.id_formulario == form.id_formulario))
             db.session.delete(form)
         db.session.flush()
 
@@ -1117,6 +1191,9 @@ def eliminar_empresa_permanentemente(empresa_id):
         # 10. Finalmente, eliminar la Empresa
         db.session.delete(empresa_a_eliminar)
         db.session.commit()
+        invalidar_principal_empresa(empresa_id)
+        actualizar_version_empresa(empresa_id)
+        reiniciar_indice_formularios()
 
         return jsonify({"message": f"Empresa '{empresa_a_eliminar.nombre_empresa}' y todos sus datos relacionados han sido eliminados permanentemente."}), 200
 
@@ -1255,6 +1332,7 @@ def editar_usuario_por_owner(user_id):
             usuario_a_editar.cargo = cargo.strip() if cargo else None
 
         db.session.commit()
+        invalidar_principal_usuario(user_id)
         return jsonify({
             "message": "Usuario actualizado exitosamente por el owner.",
             "usuario": usuario_a_editar.serialize()
@@ -1289,6 +1367,7 @@ def reactivate_user(user_id):
     try:
         user.activo = True
         db.session.commit()
+        invalidar_principal_usuario(user_id)
         return jsonify({'message': f'Usuario {user.nombre_completo} reactivado exitosamente.', 'user': user.serialize()}), 200
 
     except Exception as e:
@@ -1326,6 +1405,8 @@ def eliminar_usuario_por_owner(user_id):
         usuario_a_desactivar.activo = False
         db.session.add(usuario_a_desactivar)
         db.session.commit()
+        invalidar_principal_usuario(user_id)
+        revocar_tokens_usuario(user_id)
 
         return jsonify({"message": f"Usuario '{usuario_a_desactivar.nombre_completo}' ha sido desactivado exitosamente."}), 200
 
@@ -1400,6 +1481,8 @@ def permanently_delete_user(user_id):
         # 4. Eliminar el usuario
         db.session.delete(user_to_delete)
         db.session.commit()
+        invalidar_principal_usuario(user_id)
+        revocar_tokens_usuario(user_id)
 
         return jsonify({'message': f'El usuario con ID {user_id} y sus datos relacionados han sido eliminados permanentemente.'}), 200
 
@@ -1413,11 +1496,36 @@ def permanently_delete_user(user_id):
 def listar_todos_los_usuarios_por_owner():
     """
     Permite al OWNER listar todos los usuarios del sistema.
+    Paginación opcional por cursor (?limit=, ?after=) y exportación en streaming (?stream=ndjson).
+    Campos opcionales: ?fields=id_usuario,nombre_completo,email y ?expand=empresa.
     """
     try:
-        usuarios = Usuario.query.all()
+        try:
+            serializar, opciones = serializador_desde_request('usuario')
+        except CampoInvalido as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Solo se carga la empresa si se va a serializar, y en la misma consulta
+        query = Usuario.query.options(*opciones)
+        orden = [Usuario.id_usuario]
+
+        try:
+            if pide_stream():
+                query = filtrar_despues_de(ordenar_keyset(query, orden, descendente=False), orden, request.args.get('after'), descendente=False)
+                return stream_ndjson(query, serializar)
+
+            if pide_paginacion():
+                usuarios, next_cursor = paginar_keyset(query, orden, after=request.args.get('after'), limit=parse_limit(request.args.get('limit')), descendente=False)
+                return jsonify({
+                    "usuarios": [serializar(user) for user in usuarios],
+                    "next_cursor": next_cursor
+                }), 200
+        except CursorInvalido as e:
+            return jsonify({"error": str(e)}), 400
+
+        usuarios = query.all()
         return jsonify({
-            "usuarios": [user.serialize() for user in usuarios]
+            "usuarios": [serializar(user) for user in usuarios]
         }), 200
     except Exception as e:
         return jsonify({"error": f"Error interno del servidor al listar usuarios: {str(e)}"}), 500
@@ -1435,7 +1543,7 @@ def crear_usuario_por_admin_empresa():
     """
     try:
         current_user_id = get_jwt_identity()
-        admin_empresa = Usuario.query.get(int(current_user_id))
+        admin_empresa = get_current_usuario()
 
         if not admin_empresa or not admin_empresa.id_empresa:
             return jsonify({"error": "El administrador de empresa no está asociado a una empresa válida."}), 403
@@ -1510,7 +1618,7 @@ def editar_usuario_por_admin_empresa(user_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        admin_empresa = Usuario.query.get(int(current_user_id))
+        admin_empresa = get_current_usuario()
 
         if not admin_empresa or not admin_empresa.id_empresa:
             return jsonify({"error": "El administrador de empresa no está asociado a una empresa válida."}), 403
@@ -1534,6 +1642,7 @@ def editar_usuario_por_admin_empresa(user_id):
         telefono_personal = data.get('telefono_personal', '').strip()
         cargo = data.get('cargo', '').strip()
         activo = data.get('activo') # Nuevo campo para activar/desactivar
+        rol_anterior = usuario_a_editar.rol
 
         if nombre_completo:
             usuario_a_editar.nombre_completo = nombre_completo
@@ -1583,6 +1692,10 @@ def editar_usuario_por_admin_empresa(user_id):
             usuario_a_editar.activo = activo
 
         db.session.commit()
+        invalidar_principal_usuario(user_id)
+        # Los claims del token llevan el rol: un cambio de rol o una desactivación obliga a iniciar sesión de nuevo
+        if usuario_a_editar.rol != rol_anterior or not usuario_a_editar.activo:
+            revocar_tokens_usuario(user_id)
 
         return jsonify({
             "message": "Usuario actualizado exitosamente por el administrador de empresa.",
@@ -1604,14 +1717,19 @@ def listar_usuarios_por_empresa():
     """
     try:
         current_user_id = get_jwt_identity()
-        admin_empresa = Usuario.query.get(int(current_user_id))
+        admin_empresa = get_current_usuario()
 
         if not admin_empresa or not admin_empresa.id_empresa:
             return jsonify({"error": "El administrador de empresa no está asociado a una empresa válida."}), 403
 
-        usuarios_empresa = Usuario.query.filter_by(id_empresa=admin_empresa.id_empresa).all()
+        try:
+            serializar, opciones = serializador_desde_request('usuario')
+        except CampoInvalido as e:
+            return jsonify({"error": str(e)}), 400
+
+        usuarios_empresa = Usuario.query.filter_by(id_empresa=admin_empresa.id_empresa).options(*opciones).all()
         return jsonify({
-            "usuarios": [user.serialize() for user in usuarios_empresa]
+            "usuarios": [serializar(user) for user in usuarios_empresa]
         }), 200
 
     except Exception as e:
@@ -1628,7 +1746,7 @@ def eliminar_usuario_por_admin_empresa(user_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        admin_empresa = Usuario.query.get(int(current_user_id))
+        admin_empresa = get_current_usuario()
 
         usuario_a_eliminar = Usuario.query.get(user_id)
         if not usuario_a_eliminar:
@@ -1654,6 +1772,8 @@ def eliminar_usuario_por_admin_empresa(user_id):
         # Eliminar el usuario de la base de datos
         db.session.delete(usuario_a_eliminar)
         db.session.commit()
+        invalidar_principal_usuario(user_id)
+        revocar_tokens_usuario(user_id)
 
         return jsonify({"message": f"Usuario '{usuario_a_eliminar.nombre_completo}' ha sido eliminado permanentemente."}), 200
 
@@ -1673,7 +1793,7 @@ def cambiar_password_inicial():
     """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -1714,7 +1834,7 @@ def cambiar_password_inicial():
 def get_espacios():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if usuario.rol == 'owner':
             espacios = Espacio.query.all()
@@ -1734,7 +1854,7 @@ def get_espacios():
 def create_espacio():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -1790,7 +1910,7 @@ def create_espacio():
 def get_espacio(espacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         espacio = Espacio.query.get(espacio_id)
         if not espacio:
@@ -1811,7 +1931,7 @@ def get_espacio(espacio_id):
 def update_espacio(espacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         espacio = Espacio.query.get(espacio_id)
@@ -1851,7 +1971,7 @@ def update_espacio(espacio_id):
 def delete_espacio(espacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         espacio = Espacio.query.get(espacio_id)
         if not espacio:
@@ -1914,7 +2034,7 @@ def delete_espacio(espacio_id):
 def get_subespacios():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if usuario.rol == 'owner':
             sub_espacios = SubEspacio.query.all()
@@ -1935,7 +2055,7 @@ def get_subespacios():
 def create_subespacio():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -1981,7 +2101,7 @@ def create_subespacio():
 def get_subespacio(subespacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         subespacio = SubEspacio.query.get(subespacio_id)
         if not subespacio:
@@ -2004,7 +2124,7 @@ def get_subespacio(subespacio_id):
 def update_subespacio(subespacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         subespacio = SubEspacio.query.get(subespacio_id)
@@ -2057,7 +2177,7 @@ def update_subespacio(subespacio_id):
 def delete_subespacio(subespacio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         subespacio = SubEspacio.query.get(subespacio_id)
         if not subespacio:
@@ -2109,7 +2229,7 @@ def delete_subespacio(subespacio_id):
 def get_objetos():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if usuario.rol == 'owner':
             objetos = Objeto.query.all()
@@ -2130,7 +2250,7 @@ def get_objetos():
 def create_objeto():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -2178,7 +2298,7 @@ def create_objeto():
 def get_objeto(objeto_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         objeto = Objeto.query.get(objeto_id)
         if not objeto:
@@ -2202,7 +2322,7 @@ def get_objeto(objeto_id):
 def update_objeto(objeto_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         objeto = Objeto.query.get(objeto_id)
@@ -2258,7 +2378,7 @@ def update_objeto(objeto_id):
 def delete_objeto(objeto_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         objeto = Objeto.query.get(objeto_id)
         if not objeto:
@@ -2287,77 +2407,55 @@ def delete_objeto(objeto_id):
 @api.route('/formularios', methods=['GET'])
 @role_required(['owner', 'admin_empresa', 'usuario_formulario'])
 def get_all_formularios():
+    """
+    Lista los formularios visibles para el usuario en una sola consulta, ordenada por fecha de creación (más recientes primero).
+    Paginación opcional por cursor: ?limit=N y ?after=<next_cursor de la página anterior>.
+    Campos opcionales: ?fields=id_formulario,nombre_formulario y ?expand=tipos_respuesta_disponibles,empresa.
+    """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_principal()
+
+        try:
+            serializar, opciones = serializador_desde_request('formulario')
+        except CampoInvalido as e:
+            return jsonify({"error": str(e)}), 400
 
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
-        formularios_query = Formulario.query
-        formularios = []
-
         if usuario.rol == 'owner':
-            owner_company_id = usuario.id_empresa
-            
-            # Formularios creados por el owner
-            owner_created_forms = formularios_query.filter(Formulario.creado_por_usuario_id == usuario.id_usuario).all()
-            
-            # Plantillas globales
-            global_templates = formularios_query.filter(
-                Formulario.es_plantilla == True,
-                Formulario.es_plantilla_global == True
-            ).all()
-
-            # Plantillas no globales compartidas con la empresa del owner
-            shared_templates_with_owner_company = []
-            if owner_company_id:
-                # Corrección clave: Convertir a JSONB y usar el operador @>
-                # El ID de la empresa debe ser parte de un array JSON para el operador @>
-                shared_templates_with_owner_company = formularios_query.filter(
-                    Formulario.es_plantilla == True,
-                    Formulario.es_plantilla_global == False,
-                    cast(Formulario.compartir_con_empresas_ids, JSONB).op('@>')(f'[{owner_company_id}]')
-                ).all()
-            
-            all_owner_forms = set(owner_created_forms + global_templates + shared_templates_with_owner_company)
-            formularios = list(all_owner_forms)
+            # Formularios creados por el owner + plantillas globales + plantillas compartidas con su empresa
+            condicion = or_(
+                Formulario.creado_por_usuario_id == usuario.id_usuario,
+                condicion_plantillas_accesibles(usuario.id_empresa)
+            )
 
         else: # Roles: 'admin_empresa', 'usuario_formulario'
             if not usuario.id_empresa:
                 return jsonify({"error": "Usuario no asociado a una empresa."}), 400
-            
-            user_company_id = usuario.id_empresa
 
-            # Formularios que pertenecen a la empresa del usuario (creados por cualquier usuario de esa empresa)
-            forms_for_user_company = formularios_query.filter_by(id_empresa=user_company_id).all()
-            
-            # Plantillas globales
-            global_templates = formularios_query.filter(
-                Formulario.es_plantilla == True,
-                Formulario.es_plantilla_global == True
-            ).all()
-
-            # Plantillas compartidas específicamente con esta empresa
-            shared_templates_with_this_company = formularios_query.filter(
-                Formulario.es_plantilla == True,
-                Formulario.es_plantilla_global == False,
-                # Corrección clave: Convertir a JSONB y usar el operador @>
-                cast(Formulario.compartir_con_empresas_ids, JSONB).op('@>')(f'[{user_company_id}]')
-            ).all()
-
-            combined_forms = set(forms_for_user_company + global_templates + shared_templates_with_this_company)
-            formularios = list(combined_forms)
-
-        # Ordenar los formularios por fecha de creación (más recientes primero)
-        formularios.sort(key=lambda f: f.fecha_creacion, reverse=True)
-
-        formularios_data = []
-        for f in formularios:
-            f_data = f.serialize()
-            formularios_data.append(f_data)
+            # Formularios de la empresa + plantillas globales + compartidas (EXISTS sobre formulario_empresa_compartida)
+            condicion = condicion_formularios_accesibles(usuario.id_empresa)
 
-        return jsonify({"formularios": formularios_data}), 200
+        # Las relaciones que se van a serializar se cargan por adelantado (selectinload/joinedload)
+        query = Formulario.query.filter(condicion).options(*opciones)
+        orden = [Formulario.fecha_creacion, Formulario.id_formulario]
+
+        after = request.args.get('after')
+        if after or request.args.get('limit'):
+            try:
+                formularios, next_cursor = paginar_keyset(query, orden, after=after, limit=parse_limit(request.args.get('limit')))
+            except CursorInvalido as e:
+                return jsonify({"error": str(e)}), 400
+
+            return jsonify({
+                "formularios": [serializar(f) for f in formularios],
+                "next_cursor": next_cursor
+            }), 200
+
+        formularios = ordenar_keyset(query, orden).all()
+        return jsonify({"formularios": [serializar(f) for f in formularios]}), 200
 
     except Exception as e:
         db.session.rollback()
@@ -2374,26 +2472,31 @@ def get_formulario(form_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
-        formulario = Formulario.query.get(form_id)
-        if not formulario:
+        # Solo se lee la versión: si el cliente ya tiene esta versión se responde 304 sin cargar preguntas
+        estado = estado_formulario(form_id)
+        if not estado:
             return jsonify({"error": "Formulario no encontrado."}), 404
 
         # Control de acceso por empresa (MODIFICADO para incluir plantillas)
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, form_id):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+
+        etag = etag_formulario('formulario', form_id, estado.version)
+        no_modificado = respuesta_no_modificada(etag)
+        if no_modificado:
+            return no_modificado
+
+        formulario = Formulario.query.options(
+            selectinload(Formulario.tipos_respuesta_disponibles),
+            selectinload(Formulario.preguntas).joinedload(Pregunta.tipo_respuesta)
+        ).get(form_id)
+        if not formulario:
+            return jsonify({"error": "Formulario no encontrado."}), 404
 
         # Serializar el formulario. La serialización ya incluye los nuevos campos de frecuencia.
         formulario_data = formulario.serialize()
@@ -2407,7 +2510,7 @@ def get_formulario(form_id):
 
         formulario_data['preguntas'] = preguntas_data
 
-        return jsonify({"formulario": formulario_data}), 200
+        return con_etag(jsonify({"formulario": formulario_data}), etag), 200
 
     except Exception as e:
         db.session.rollback() # En caso de error en la base de datos
@@ -2420,7 +2523,7 @@ def get_formulario(form_id):
 def create_formulario():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -2465,6 +2568,7 @@ def create_formulario():
             return jsonify({"error": "No tienes permisos para crear formularios para esta empresa."}), 403
         
         # Validar lógica de plantillas: Owner solo puede crear plantillas para SU empresa registrada
+        empresas_compartidas = []
         if es_plantilla:
             if usuario.rol != 'owner' or id_empresa != usuario.id_empresa:
                 return jsonify({"error": "Solo el owner puede crear formularios plantilla y solo para su propia empresa registrada."}), 403
@@ -2474,11 +2578,15 @@ def create_formulario():
             if es_plantilla_global and compartir_con_empresas_ids:
                 return jsonify({"error": "Si es una plantilla global, no debe especificar empresas para compartir."}), 400
             
+            # IDs repetidos insertarían dos veces la misma fila en formulario_empresa_compartida
+            compartir_con_empresas_ids = list(dict.fromkeys(compartir_con_empresas_ids or []))
             # Asegurarse de que las empresas en compartir_con_empresas_ids existan y estén activas
             for empresa_id_to_share in compartir_con_empresas_ids:
                 empresa_to_share = Empresa.query.get(empresa_id_to_share)
                 if not empresa_to_share or not empresa_to_share.activo:
                     return jsonify({"error": f"La empresa con ID {empresa_id_to_share} para compartir no existe o no está activa."}), 400
+                if empresa_to_share not in empresas_compartidas:  # ej. 5 y "5"
+                    empresas_compartidas.append(empresa_to_share)
         
         # Validar y asociar espacios, sub-espacios y objetos
         # La validación de pertenencia a la empresa se omite si es una plantilla
@@ -2536,13 +2644,16 @@ def create_formulario():
             notificaciones_activas=notificaciones_activas,
             automatizacion_activa=automatizacion_activa
         )
+        programar_automatizacion(nuevo_formulario)
         nuevo_formulario.espacios = espacios_asociados
         nuevo_formulario.sub_espacios = subespacios_asociados
         nuevo_formulario.objetos = objetos_asociados
         nuevo_formulario.tipos_respuesta_disponibles = tipos_respuesta_asociados
+        nuevo_formulario.empresas_compartidas = empresas_compartidas # NUEVO: Tabla normalizada de empresas compartidas
 
         db.session.add(nuevo_formulario)
         db.session.commit()
+        registrar_formulario(nuevo_formulario)
 
         return jsonify({"message": "Formulario creado exitosamente.", "formulario": nuevo_formulario.serialize()}), 201
 
@@ -2558,7 +2669,7 @@ def create_formulario():
 def update_formulario(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         formulario = Formulario.query.get(form_id)
@@ -2614,6 +2725,7 @@ def update_formulario(form_id):
             formulario.tipos_respuesta_disponibles = []
 
         # Validar lógica de plantillas
+        empresas_compartidas = []
         if es_plantilla:
             if usuario.rol != 'owner' or formulario.id_empresa != usuario.id_empresa: # La plantilla debe pertenecer a la empresa del owner
                 return jsonify({"error": "Solo el owner puede gestionar formularios plantilla y solo para su propia empresa registrada."}), 403
@@ -2623,18 +2735,25 @@ def update_formulario(form_id):
             if es_plantilla_global and compartir_con_empresas_ids:
                 return jsonify({"error": "Si es una plantilla global, no debe especificar empresas para compartir."}), 400
             
+            # IDs repetidos insertarían dos veces la misma fila en formulario_empresa_compartida
+            compartir_con_empresas_ids = list(dict.fromkeys(compartir_con_empresas_ids or []))
             # Asegurarse de que las empresas en compartir_con_empresas_ids existan y estén activas
             for empresa_id_to_share in compartir_con_empresas_ids:
                 empresa_to_share = Empresa.query.get(empresa_id_to_share)
                 if not empresa_to_share or not empresa_to_share.activo:
                     return jsonify({"error": f"La empresa con ID {empresa_id_to_share} para compartir no existe o no está activa."}), 400
+                if empresa_to_share not in empresas_compartidas:  # ej. 5 y "5"
+                    empresas_compartidas.append(empresa_to_share)
 
 
         formulario.es_plantilla = es_plantilla
         formulario.es_plantilla_global = es_plantilla_global
         formulario.compartir_con_empresas_ids = compartir_con_empresas_ids
+        formulario.empresas_compartidas = empresas_compartidas # NUEVO: Tabla normalizada de empresas compartidas
         formulario.notificaciones_activas = notificaciones_activas
-        formulario.automatizacion_activa = automatizacion_activa
+        if formulario.automatizacion_activa != automatizacion_activa:
+            formulario.automatizacion_activa = automatizacion_activa
+            programar_automatizacion(formulario)
 
         # Actualizar espacios
         if espacios_ids is not None:
@@ -2685,6 +2804,7 @@ def update_formulario(form_id):
 
 
         db.session.commit()
+        registrar_formulario(formulario)
 
         return jsonify({"message": "Formulario actualizado exitosamente.", "formulario": formulario.serialize()}), 200
 
@@ -2698,7 +2818,7 @@ def update_formulario(form_id):
 def delete_formulario(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         formulario = Formulario.query.get(form_id)
         if not formulario:
@@ -2751,10 +2871,13 @@ def delete_formulario(form_id):
         db.session.execute(formulario_objeto.delete().where(formulario_objeto.c.id_formulario == form_id))
         # Desvincular formularios de tipos_respuesta
         db.session.execute(formulario_tipo_respuesta.delete().where(formulario_tipo_respuesta.c.id_formulario == form_id))
+        # Desvincular formularios de empresas compartidas
+        db.session.execute(formulario_empresa_compartida.delete().where(formulario_empresa_compartida.c.id_formulario == form_id))
 
         # 5. Finalmente, eliminar el Formulario
         db.session.delete(formulario)
         db.session.commit()
+        quitar_formulario(form_id)
         # --- FIN DE ELIMINACIÓN EN CASCADA MANUAL PARA FORMULARIO ---
 
         return jsonify({"message": "Formulario y todos sus datos asociados eliminados exitosamente."}), 200
@@ -2776,22 +2899,27 @@ def delete_formulario(form_id):
 def get_preguntas_by_formulario(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.options(joinedload(Usuario.empresa)).get(int(current_user_id))
+        usuario = get_current_principal()
         
-        formulario = Formulario.query.options(joinedload(Formulario.preguntas).joinedload(Pregunta.tipo_respuesta)).get(form_id)
-        if not formulario:
+        estado = estado_formulario(form_id)
+        if not estado:
             return jsonify({"error": "Formulario no encontrado."}), 404
 
-        if usuario.rol != 'owner':
-            if formulario.es_plantilla:
-                if not (formulario.es_plantilla_global or usuario.id_empresa in (formulario.compartir_con_empresas_ids or [])):
-                    return jsonify({"error": "No tienes permisos para acceder a las preguntas de este formulario."}), 403
-            elif formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a las preguntas de este formulario."}), 403
+        if not puede_acceder_formulario(usuario, form_id):
+            return jsonify({"error": "No tienes permisos para acceder a las preguntas de este formulario."}), 403
 
-        if formulario.es_plantilla:
+        if estado.es_plantilla:
             return redirect(url_for('api.get_preguntas_de_plantilla', form_id=form_id))
 
+        etag = etag_formulario('preguntas', form_id, estado.version)
+        no_modificado = respuesta_no_modificada(etag)
+        if no_modificado:
+            return no_modificado
+
+        formulario = Formulario.query.options(joinedload(Formulario.preguntas).joinedload(Pregunta.tipo_respuesta)).get(form_id)
+        if not formulario:
+            return jsonify({"error": "Formulario no encontrado."}), 404
+
         preguntas_data = []
         for p in formulario.preguntas:
             p_data = p.serialize()
@@ -2800,7 +2928,7 @@ def get_preguntas_by_formulario(form_id):
             # Nota: la serialización ya incluye esto si has actualizado el modelo.
             preguntas_data.append(p_data)
 
-        return jsonify({"preguntas": preguntas_data}), 200
+        return con_etag(jsonify({"preguntas": preguntas_data}), etag), 200
 
     except Exception as e:
         print(f"Error al obtener preguntas del formulario: {e}")
@@ -2812,24 +2940,27 @@ def get_preguntas_by_formulario(form_id):
 def get_preguntas_de_plantilla(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.options(joinedload(Usuario.empresa)).get(int(current_user_id))
+        usuario = get_current_principal()
         
-        formulario = Formulario.query.options(joinedload(Formulario.preguntas).joinedload(Pregunta.tipo_respuesta)).get(form_id)
-        if not formulario:
+        estado = estado_formulario(form_id)
+        if not estado:
             return jsonify({"error": "Formulario no encontrado."}), 404
         
-        if not formulario.es_plantilla:
+        if not estado.es_plantilla:
             return redirect(url_for('api.get_preguntas_by_formulario', form_id=form_id))
 
-        is_allowed_template = False
-        if formulario.es_plantilla_global:
-            is_allowed_template = True
-        elif usuario.id_empresa in (formulario.compartir_con_empresas_ids or []):
-            is_allowed_template = True
-        
-        if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
+        if not puede_acceder_formulario(usuario, form_id):
             return jsonify({"error": "No tienes permisos para acceder a las preguntas de esta plantilla."}), 403
 
+        etag = etag_formulario('preguntas-plantilla', form_id, estado.version)
+        no_modificado = respuesta_no_modificada(etag)
+        if no_modificado:
+            return no_modificado
+
+        formulario = Formulario.query.options(joinedload(Formulario.preguntas).joinedload(Pregunta.tipo_respuesta)).get(form_id)
+        if not formulario:
+            return jsonify({"error": "Formulario no encontrado."}), 404
+
         preguntas_data = []
         for p in formulario.preguntas:
             p_data = p.serialize()
@@ -2868,7 +2999,7 @@ def get_preguntas_de_plantilla(form_id):
             
             preguntas_data.append(p_data)
 
-        return jsonify({"preguntas": preguntas_data}), 200
+        return con_etag(jsonify({"preguntas": preguntas_data}), etag), 200
 
     except Exception as e:
         print(f"Error al obtener preguntas de plantilla: {e}")
@@ -2880,7 +3011,7 @@ def get_preguntas_de_plantilla(form_id):
 def create_pregunta(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -2949,7 +3080,7 @@ def create_pregunta(form_id):
 def create_pregunta_plantilla(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         if not data:
@@ -3027,7 +3158,7 @@ def create_pregunta_plantilla(form_id):
 def get_pregunta(pregunta_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.options(joinedload(Usuario.empresa)).get(int(current_user_id))
+        usuario = get_current_principal()
 
         pregunta = Pregunta.query.options(joinedload(Pregunta.formulario).joinedload(Formulario.empresa), joinedload(Pregunta.tipo_respuesta)).get(pregunta_id)
         if not pregunta:
@@ -3037,16 +3168,8 @@ def get_pregunta(pregunta_id):
         if not formulario:
             return jsonify({"error": "Formulario asociado a la pregunta no encontrado."}), 404
         
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a esta pregunta."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a esta pregunta."}), 403
 
         pregunta_data = pregunta.serialize()
         pregunta_data['tipo_respuesta_nombre'] = pregunta.tipo_respuesta.nombre_tipo if pregunta.tipo_respuesta else None
@@ -3146,7 +3269,7 @@ def update_pregunta_admin(pregunta_id):
     """Permite al admin_empresa actualizar preguntas en formularios de su empresa que no sean plantillas."""
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
         if not data:
             return jsonify({"error": "No se recibieron datos"}), 400
@@ -3210,7 +3333,7 @@ def update_pregunta_admin(pregunta_id):
 def delete_pregunta(pregunta_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         pregunta = Pregunta.query.get(pregunta_id)
         if not pregunta:
@@ -3251,7 +3374,7 @@ def delete_pregunta(pregunta_id):
 def get_user_submissions_in_period_count(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -3260,16 +3383,8 @@ def get_user_submissions_in_period_count(form_id):
             return jsonify({"error": "Formulario no encontrado."}), 404
 
         # Control de acceso para el formulario (igual que otros GETs para formularios/preguntas)
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
 
         # Calcular el inicio del período dinámicamente
         # Si submission_period_days es 1, se comporta como "por día"
@@ -3295,8 +3410,14 @@ def get_tipos_respuesta():
     No requiere autenticación especial, ya que son datos estáticos.
     """
     try:
-        tipos = TipoRespuesta.query.all()
-        return jsonify({"tipos_respuesta": [t.serialize() for t in tipos]}), 200
+        payload, etag = obtener_catalogo(
+            TIPOS_RESPUESTA,
+            lambda: {"tipos_respuesta": [t.serialize() for t in TipoRespuesta.query.all()]}
+        )
+        no_modificado = respuesta_no_modificada(etag, CATALOGO_MAX_AGE)
+        if no_modificado:
+            return no_modificado
+        return con_etag(jsonify(payload), etag, CATALOGO_MAX_AGE), 200
     except Exception as e:
         print(f"Error al obtener tipos de respuesta: {e}")
         return jsonify({"error": f"Error interno del servidor al obtener tipos de respuesta: {str(e)}"}), 500
@@ -3318,6 +3439,7 @@ def create_tipo_respuesta():
         new_tipo = TipoRespuesta(nombre_tipo=nombre_tipo, descripcion=descripcion)
         db.session.add(new_tipo)
         db.session.commit()
+        invalidar_catalogo(TIPOS_RESPUESTA)
         return jsonify({"message": "Tipo de respuesta creado exitosamente.", "tipo_respuesta": new_tipo.serialize()}), 201
     except Exception as e:
         db.session.rollback()
@@ -3356,6 +3478,7 @@ def seed_tipos_respuesta():
             db.session.add(new_type)
         
         db.session.commit()
+        invalidar_catalogo(TIPOS_RESPUESTA)
         return jsonify({"message": "Tipos de respuesta sembrados exitosamente."}), 201
 
     except Exception as e:
@@ -3367,29 +3490,54 @@ def seed_tipos_respuesta():
 
 # --- INICIO DE RUTAS PARA ENVÍOS DE FORMULARIO (RESPUESTAS) ---
 
+def serializar_envio_para_lista(envio):
+    """Serializa un envío con el nombre del formulario y del usuario para los listados."""
+    envio_data = envio.serialize()
+    # Opcional: añadir nombre del formulario y usuario para mejor contexto en la lista
+    envio_data['nombre_formulario'] = envio.formulario.nombre_formulario if envio.formulario else 'N/A'
+    envio_data['nombre_usuario'] = envio.usuario.nombre_completo if envio.usuario else 'N/A'
+    return envio_data
+
 @api.route('/envios-formulario', methods=['GET'])
 @role_required(['owner', 'admin_empresa', 'usuario_formulario'])
 def get_envios_formulario():
+    """
+    Lista los envíos visibles para el usuario, del más reciente al más antiguo.
+    Paginación opcional por cursor (?limit=, ?after=) y exportación en streaming (?stream=ndjson).
+    """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_principal()
 
         if usuario.rol == 'owner':
-            envios = EnvioFormulario.query.all()
+            query = EnvioFormulario.query
         elif usuario.rol == 'admin_empresa':
             # Un admin de empresa ve los envíos de formularios de su empresa
-            envios = EnvioFormulario.query.join(Formulario).filter(Formulario.id_empresa == usuario.id_empresa).all()
+            query = EnvioFormulario.query.join(Formulario).filter(Formulario.id_empresa == usuario.id_empresa)
         else: # usuario_formulario
             # Un usuario de formulario solo ve sus propios envíos
-            envios = EnvioFormulario.query.filter_by(id_usuario=usuario.id_usuario).all()
+            query = EnvioFormulario.query.filter_by(id_usuario=usuario.id_usuario)
 
-        envios_data = []
-        for envio in envios:
-            envio_data = envio.serialize()
-            # Opcional: añadir nombre del formulario y usuario para mejor contexto en la lista
-            envio_data['nombre_formulario'] = envio.formulario.nombre_formulario if envio.formulario else 'N/A'
-            envio_data['nombre_usuario'] = envio.usuario.nombre_completo if envio.usuario else 'N/A'
-            envios_data.append(envio_data)
+        # Formulario y usuario se cargan en la misma consulta (antes: dos consultas perezosas por envío)
+        query = query.options(joinedload(EnvioFormulario.formulario), joinedload(EnvioFormulario.usuario))
+        orden = [EnvioFormulario.fecha_hora_envio, EnvioFormulario.id_envio]
+
+        try:
+            if pide_stream():
+                query = filtrar_despues_de(ordenar_keyset(query, orden), orden, request.args.get('after'))
+                return stream_ndjson(query, serializar_envio_para_lista)
+
+            if pide_paginacion():
+                envios, next_cursor = paginar_keyset(query, orden, after=request.args.get('after'), limit=parse_limit(request.args.get('limit')))
+                return jsonify({
+                    "envios_formulario": [serializar_envio_para_lista(envio) for envio in envios],
+                    "next_cursor": next_cursor
+                }), 200
+        except CursorInvalido as e:
+            return jsonify({"error": str(e)}), 400
+
+        envios = query.all()
+        envios_data = [serializar_envio_para_lista(envio) for envio in envios]
 
         return jsonify({"envios_formulario": envios_data}), 200
 
@@ -3402,17 +3550,28 @@ def get_envios_formulario():
 def submit_formulario():
     """
     Permite a un usuario enviar un formulario completo con sus respuestas.
+    Acepta JSON (imágenes en base64) o multipart/form-data: la parte 'datos' lleva el mismo JSON
+    y cada imagen va como parte binaria, referenciada por nombre en 'archivos' de su respuesta.
+    Werkzeug vuelca a disco las partes grandes a medida que llegan, así que el cuerpo no se
+    carga completo en memoria ni se infla un 33% por el base64.
     """
     print("DEBUG BACKEND: Entrando a la función submit_formulario (POST /envios-formulario)")
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         if not usuario:
             print(f"DEBUG BACKEND: Usuario no encontrado para ID: {current_user_id}")
             return jsonify({"error": "Usuario no encontrado o sesión inválida."}), 404
         
-        data = request.get_json()
+        es_multipart = request.mimetype == 'multipart/form-data'
+        if es_multipart:
+            try:
+                data = json.loads(request.form.get('datos') or 'null')
+            except json.JSONDecodeError:
+                return jsonify({"error": "La parte 'datos' no es un JSON válido."}), 400
+        else:
+            data = request.get_json()
         if not data:
             print("DEBUG BACKEND: No se recibieron datos en la solicitud.")
             return jsonify({"error": "No se recibieron datos"}), 400
@@ -3436,17 +3595,9 @@ def submit_formulario():
             print(f"DEBUG BACKEND: Formulario {id_formulario} no encontrado.")
             return jsonify({"error": "Formulario no encontrado."}), 404
 
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                print(f"DEBUG BACKEND: Permisos insuficientes para usuario {usuario.id_usuario} en formulario {id_formulario}.")
-                return jsonify({"error": "No tienes permisos para enviar respuestas a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            print(f"DEBUG BACKEND: Permisos insuficientes para usuario {usuario.id_usuario} en formulario {id_formulario}.")
+            return jsonify({"error": "No tienes permisos para enviar respuestas a este formulario."}), 403
 
         period_start = datetime.utcnow() - timedelta(days=formulario.submission_period_days)
         current_submissions_in_period = EnvioFormulario.query.filter(
@@ -3458,6 +3609,105 @@ def submit_formulario():
         if current_submissions_in_period >= formulario.max_submissions_per_period:
             return jsonify({"error": f"Ya has alcanzado el límite de {formulario.max_submissions_per_period} diligencia(s) para este formulario en los últimos {formulario.submission_period_days} día(s)."}), 400
 
+        # Todas las preguntas del formulario con su tipo de respuesta en una sola consulta
+        # (antes: Pregunta.query.get + TipoRespuesta.query.get por cada respuesta)
+        tipos_por_pregunta = dict(
+            db.session.query(Pregunta.id_pregunta, TipoRespuesta.nombre_tipo)
+            .outerjoin(TipoRespuesta, TipoRespuesta.id_tipo_respuesta == Pregunta.tipo_respuesta_id)
+            .filter(Pregunta.id_formulario == formulario.id_formulario)
+            .all()
+        )
+
+        # Validar todo el payload contra ese mapa antes de crear el envío o subir firmas
+        trazos_por_respuesta = {}
+        for idx, respuesta_item in enumerate(respuestas_data):
+            pregunta_id = respuesta_item.get('pregunta_id')
+            
+            if pregunta_id is None:
+                print("ERROR BACKEND: pregunta_id es None para una respuesta. Abortando envío.")
+                return jsonify({"error": "Pregunta con ID None no encontrada o no pertenece a este formulario."}), 400
+
+            try:
+                pregunta_valida = int(pregunta_id) in tipos_por_pregunta
+            except (TypeError, ValueError):
+                pregunta_valida = False
+            if not pregunta_valida:
+                print(f"ERROR BACKEND: Pregunta con ID {pregunta_id} no encontrada o no pertenece al formulario {id_formulario}. Abortando envío.")
+                return jsonify({"error": f"Pregunta con ID {pregunta_id} no encontrada o no pertenece a este formulario."}), 400
+
+            # NUEVO: Firmas/dibujos en formato de trazos: se guardan en la respuesta, sin subida externa
+            if respuesta_item.get('trazos') is not None:
+                if tipos_por_pregunta[int(pregunta_id)] not in ('firma', 'dibujo'):
+                    return jsonify({"error": f"La pregunta {pregunta_id} no admite trazos."}), 400
+                try:
+                    trazos_por_respuesta[idx] = normalizar_lista_trazos(respuesta_item.get('trazos'))
+                except TrazosInvalidos as e:
+                    return jsonify({"error": f"Trazos no válidos en la pregunta {pregunta_id}: {str(e)}"}), 400
+
+            # NUEVO: Imágenes enviadas como partes binarias del multipart
+            nombres_archivos = respuesta_item.get('archivos')
+            if nombres_archivos is not None:
+                if not es_multipart or not isinstance(nombres_archivos, list):
+                    return jsonify({"error": "'archivos' debe ser una lista de nombres de partes de un envío multipart."}), 400
+                if tipos_por_pregunta[int(pregunta_id)] not in ('firma', 'dibujo'):
+                    return jsonify({"error": f"La pregunta {pregunta_id} no admite imágenes."}), 400
+                if tipos_por_pregunta[int(pregunta_id)] == 'firma' and len(nombres_archivos) != 1:
+                    return jsonify({"error": f"La pregunta {pregunta_id} es de firma y admite exactamente una imagen."}), 400
+                for nombre in nombres_archivos:
+                    archivo = request.files.get(nombre) if isinstance(nombre, str) else None
+                    if archivo is None:
+                        return jsonify({"error": f"Falta la parte '{nombre}' referenciada por la pregunta {pregunta_id}."}), 400
+                    if not (archivo.mimetype or '').startswith('image/'):
+                        return jsonify({"error": f"La parte '{nombre}' no es una imagen."}), 400
+
+        # La firma de perfil se lee antes de cerrar la transacción de lectura
+        firma_perfil_url = usuario.firma_digital_url
+
+        # 1) Extraer todas las imágenes del payload (base64 o partes binarias). Clave: (índice de la respuesta, posición)
+        imagenes = []
+        for idx, respuesta_item in enumerate(respuestas_data):
+            nombre_tipo = tipos_por_pregunta[int(respuesta_item.get('pregunta_id'))]
+            firma_base64_list = respuesta_item.get('firma_base64_list')
+            firma_base64_single = respuesta_item.get('firma_base64')
+            if respuesta_item.get('archivos'):
+                # Los archivos ocupan el lugar del base64: una imagen para 'firma', varias para 'dibujo'
+                archivos_respuesta = [request.files[nombre] for nombre in respuesta_item['archivos']]
+                firma_base64_list = archivos_respuesta
+                firma_base64_single = archivos_respuesta[0]
+
+            if nombre_tipo == 'firma':
+                # Si el usuario tiene firma digital de perfil, se usa esa y no se sube nada
+                if not firma_perfil_url and firma_base64_single:
+                    imagenes.append(((idx, 0), firma_base64_single))
+            elif nombre_tipo == 'dibujo':
+                if firma_base64_list and isinstance(firma_base64_list, list):
+                    imagenes.extend(((idx, pos), b64_signature) for pos, b64_signature in enumerate(firma_base64_list))
+                elif firma_base64_single:
+                    imagenes.append(((idx, 0), firma_base64_single))
+
+        # 2) Subir todas las imágenes en paralelo sin transacción abierta: el commit cierra la
+        #    transacción de lectura y devuelve la conexión al pool mientras dura la subida.
+        #    En modo diferido solo se decodifican; se guardan en media_pendiente junto con el envío.
+        diferido = subida_diferida()
+        urls_por_respuesta = {}
+        imagenes_diferidas = []
+        if diferido:
+            for clave, imagen in imagenes:
+                try:
+                    contenido, content_type = decodificar_imagen(imagen)
+                except ValueError as e:
+                    print(f"ERROR BACKEND: Imagen {clave} descartada: {str(e)}")
+                    continue
+                imagenes_diferidas.append((clave, contenido, content_type))
+        else:
+            # Las imágenes ya conocidas por su SHA-256 reutilizan la URL sin subirse de nuevo
+            urls_subidas = subir_deduplicado(imagenes)
+            for clave, _ in imagenes:
+                if urls_subidas.get(clave):
+                    urls_por_respuesta.setdefault(clave[0], []).append(urls_subidas[clave])
+            print(f"DEBUG BACKEND: {len(imagenes)} imágenes subidas para el formulario {id_formulario}.")
+
+        # 3) Transacción corta: envío y respuestas
         nuevo_envio = EnvioFormulario(
             id_formulario=id_formulario,
             id_usuario=int(current_user_id),
@@ -3471,13 +3721,9 @@ def submit_formulario():
 
         print(f"DEBUG BACKEND: Nuevo envío creado con ID: {nuevo_envio.id_envio}")
 
-        for respuesta_item in respuestas_data:
-            pregunta_id = respuesta_item.get('pregunta_id')
-            
-            if pregunta_id is None:
-                db.session.rollback()
-                print("ERROR BACKEND: pregunta_id es None para una respuesta. Abortando envío.")
-                return jsonify({"error": "Pregunta con ID None no encontrada o no pertenece a este formulario."}), 400
+        filas_respuestas = []
+        for idx, respuesta_item in enumerate(respuestas_data):
+            pregunta_id = int(respuesta_item.get('pregunta_id'))
 
             valor_texto = respuesta_item.get('valor_texto')
             
@@ -3494,64 +3740,43 @@ def submit_formulario():
             
             valor_numerico = respuesta_item.get('valor_numerico')
             valores_multiples_json = respuesta_item.get('valores_multiples_json')
-            
-            firma_base64_list = respuesta_item.get('firma_base64_list')
-            firma_base64_single = respuesta_item.get('firma_base64')
 
-            pregunta = Pregunta.query.get(pregunta_id)
-            if not pregunta or pregunta.id_formulario != id_formulario:
-                db.session.rollback()
-                print(f"ERROR BACKEND: Pregunta con ID {pregunta_id} no encontrada o no pertenece al formulario {id_formulario}. Abortando envío.")
-                return jsonify({"error": f"Pregunta con ID {pregunta_id} no encontrada o no pertenece a este formulario."}), 400
+            if tipos_por_pregunta[pregunta_id] == 'firma' and firma_perfil_url:
+                valor_firma_url_list = [firma_perfil_url]
+            else:
+                valor_firma_url_list = urls_por_respuesta.get(idx, [])
+
+            filas_respuestas.append({
+                "id_envio": nuevo_envio.id_envio,
+                "id_pregunta": pregunta_id,
+                "valor_texto": valor_texto,
+                "valor_booleano": valor_booleano,  # <--- SE ASIGNA EL VALOR YA CONVERTIDO
+                "valor_numerico": valor_numerico,
+                "valores_multiples_json": valores_multiples_json,
+                "valor_firma_url": valor_firma_url_list if valor_firma_url_list else None,
+                "valor_trazos": trazos_por_respuesta.get(idx)
+            })
 
-            tipo_respuesta_obj = TipoRespuesta.query.get(pregunta.tipo_respuesta_id)
-            valor_firma_url_list = []
+        # Un solo INSERT (executemany) para todas las respuestas
+        if filas_respuestas:
+            db.session.execute(insert(Respuesta), filas_respuestas)
+            # El INSERT masivo no dispara eventos de mapper: las referencias a imágenes se cuentan aquí
+            sumar_referencias(url for fila in filas_respuestas for url in (fila["valor_firma_url"] or []))
+        print(f"DEBUG BACKEND: {len(filas_respuestas)} respuestas añadidas al envío {nuevo_envio.id_envio}.")
 
-            if tipo_respuesta_obj:
-                if tipo_respuesta_obj.nombre_tipo == 'firma':
-                    if usuario.firma_digital_url:
-                        valor_firma_url_list.append(usuario.firma_digital_url)
-                        print(f"DEBUG BACKEND: Usando firma digital de perfil para pregunta {pregunta_id}: {usuario.firma_digital_url}")
-                    elif firma_base64_single:
-                        try:
-                            upload_result = cloudinary.uploader.upload(firma_base64_single)
-                            valor_firma_url_list.append(upload_result['secure_url'])
-                            print(f"DEBUG BACKEND: Firma subida para pregunta {pregunta_id}: {upload_result['secure_url']}")
-                        except Exception as e:
-                            print(f"ERROR BACKEND: Error al subir firma individual a Cloudinary para pregunta {pregunta_id}: {str(e)}")
-                
-                elif tipo_respuesta_obj.nombre_tipo == 'dibujo':
-                    if firma_base64_list and isinstance(firma_base64_list, list):
-                        for b64_signature in firma_base64_list:
-                            try:
-                                upload_result = cloudinary.uploader.upload(b64_signature)
-                                valor_firma_url_list.append(upload_result['secure_url'])
-                                print(f"DEBUG BACKEND: Dibujo/firma múltiple subida para pregunta {pregunta_id}: {upload_result['secure_url']}")
-                            except Exception as e:
-                                print(f"ERROR BACKEND: Error al subir dibujo/firma múltiple a Cloudinary para pregunta {pregunta_id}: {str(e)}")
-                    elif firma_base64_single:
-                         try:
-                            upload_result = cloudinary.uploader.upload(firma_base64_single)
-                            valor_firma_url_list.append(upload_result['secure_url'])
-                            print(f"DEBUG BACKEND: Dibujo/firma única subida para pregunta {pregunta_id}: {upload_result['secure_url']}")
-                         except Exception as e:
-                            print(f"ERROR BACKEND: Error al subir dibujo/firma única a Cloudinary para pregunta {pregunta_id}: {str(e)}")
-
-            nueva_respuesta = Respuesta(
-                id_envio=nuevo_envio.id_envio,
-                id_pregunta=pregunta_id,
-                valor_texto=valor_texto,
-                valor_booleano=valor_booleano,  # <--- SE ASIGNA EL VALOR YA CONVERTIDO
-                valor_numerico=valor_numerico,
-                valores_multiples_json=valores_multiples_json,
-                valor_firma_url=valor_firma_url_list if valor_firma_url_list else None
-            )
-            db.session.add(nueva_respuesta)
-            print(f"DEBUG BACKEND: Respuesta para pregunta {pregunta_id} añadida.")
+        # Modo diferido: las imágenes quedan en cola en la misma transacción que el envío
+        for (idx, posicion), contenido, content_type in imagenes_diferidas:
+            encolar_respuesta(nuevo_envio.id_envio, filas_respuestas[idx]["id_pregunta"], posicion, contenido, content_type)
 
         db.session.commit()
         print("DEBUG BACKEND: Formulario y respuestas guardados exitosamente.")
-        return jsonify({"message": "Formulario enviado exitosamente.", "envio": nuevo_envio.serialize()}), 201
+
+        respuesta_envio = {"message": "Formulario enviado exitosamente.", "envio": nuevo_envio.serialize()}
+        if diferido:
+            asegurar_worker_media(current_app._get_current_object())
+            despertar_worker_media()
+            respuesta_envio["media_pendiente"] = len(imagenes_diferidas)
+        return jsonify(respuesta_envio), 201
 
     except Exception as e:
         db.session.rollback()
@@ -3563,7 +3788,7 @@ def submit_formulario():
 def get_envio_formulario(envio_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario_acceso = Usuario.query.get(int(current_user_id))
+        usuario_acceso = get_current_usuario()
         if not usuario_acceso:
             return jsonify({"error": "Usuario de acceso no encontrado."}), 404
 
@@ -3580,20 +3805,12 @@ def get_envio_formulario(envio_id):
             return jsonify({"error": "Formulario asociado al envío no encontrado."}), 404
 
         # Control de acceso para el usuario que intenta ver el envío
-        if usuario_acceso.rol != 'owner':
-            is_allowed_template = False
-            if formulario_asociado.es_plantilla:
-                if formulario_asociado.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario_acceso.id_empresa in formulario_asociado.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario_asociado.id_empresa != usuario_acceso.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este envío de formulario."}), 403
+        if not puede_acceder_formulario(usuario_acceso, formulario_asociado.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este envío de formulario."}), 403
 
-            # Si es usuario_formulario, solo puede ver sus propios envíos, incluso si es plantilla.
-            if usuario_acceso.rol == 'usuario_formulario' and envio.id_usuario != usuario_acceso.id_usuario:
-                return jsonify({"error": "No tienes permisos para acceder a este envío de formulario."}), 403
+        # Si es usuario_formulario, solo puede ver sus propios envíos, incluso si es plantilla.
+        if usuario_acceso.rol == 'usuario_formulario' and envio.id_usuario != usuario_acceso.id_usuario:
+            return jsonify({"error": "No tienes permisos para acceder a este envío de formulario."}), 403
 
         envio_data = envio.serialize()
         envio_data['respuestas'] = []
@@ -3631,6 +3848,9 @@ def get_envio_formulario(envio_id):
                     except (json.JSONDecodeError, TypeError) as e:
                         print(f"Error parsing valores_multiples_json for resource names in get_envio_formulario: {res_data['valores_multiples_json']} - {e}")
                         res_data['valor_recursos_nombres'] = ["Error al cargar recursos"]
+            # NUEVO: URLs firmadas para mostrar las firmas/dibujos guardados como trazos
+            if respuesta.valor_trazos:
+                res_data['valor_trazos_urls'] = [url_trazos(respuesta.id_respuesta, i) for i in range(len(respuesta.valor_trazos))]
             envio_data['respuestas'].append(res_data)
 
         # Opcional: añadir detalles del formulario y usuario que lo envió
@@ -3644,6 +3864,77 @@ def get_envio_formulario(envio_id):
         return jsonify({"error": f"Error interno del servidor al obtener envío de formulario: {str(e)}"}), 500
 
 
+# NUEVO: Render de firmas/dibujos guardados como trazos vectoriales (api/strokes.py).
+# Un <img> no puede mandar el JWT, así que también se acepta una URL firmada (?firma=) con vencimiento.
+TRAZOS_URL_MAX_AGE = int(os.getenv('TRAZOS_URL_MAX_AGE', 86400))
+TRAZOS_ANCHO_MAX = 2000
+
+
+def _serializador_trazos():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='trazos-salt')
+
+
+def url_trazos(respuesta_id, indice, formato='svg', ancho=None):
+    """
+    URL firmada para ver el dibujo `indice` de una respuesta sin token de acceso.
+    """
+    firma = _serializador_trazos().dumps(respuesta_id)
+    return url_for('api.get_trazos_respuesta', respuesta_id=respuesta_id, indice=indice, formato=formato,
+                   ancho=ancho, firma=firma, _external=True)
+
+
+@api.route('/respuestas/<int:respuesta_id>/trazos/<int:indice>.<formato>', methods=['GET'])
+@jwt_required(optional=True)
+def get_trazos_respuesta(respuesta_id, indice, formato):
+    """
+    Devuelve el dibujo `indice` de una respuesta como SVG o PNG (?ancho= para miniaturas).
+    El render se cachea y el ETag es el hash de los trazos, que no cambian.
+    """
+    if formato not in FORMATOS_DISPONIBLES:
+        return jsonify({"error": f"Formato no soportado. Opciones: {', '.join(FORMATOS_DISPONIBLES)}."}), 400
+    ancho = request.args.get('ancho', type=int)
+    if ancho is not None and not (0 < ancho <= TRAZOS_ANCHO_MAX):
+        return jsonify({"error": f"'ancho' debe estar entre 1 y {TRAZOS_ANCHO_MAX}."}), 400
+
+    try:
+        firma = request.args.get('firma')
+        if firma:
+            try:
+                firma_valida = _serializador_trazos().loads(firma, max_age=TRAZOS_URL_MAX_AGE) == respuesta_id
+            except Exception:
+                firma_valida = False
+            if not firma_valida:
+                return jsonify({"error": "El enlace no es válido o ha expirado."}), 403
+
+        respuesta = Respuesta.query.get(respuesta_id)
+        if not respuesta or not respuesta.valor_trazos or not (0 <= indice < len(respuesta.valor_trazos)):
+            return jsonify({"error": "Dibujo no encontrado."}), 404
+
+        if not firma:
+            usuario_acceso = get_current_usuario() if get_jwt_identity() else None
+            if not usuario_acceso:
+                return jsonify({"error": "Se requiere autenticación o un enlace firmado."}), 401
+            envio = EnvioFormulario.query.get(respuesta.id_envio)
+            if not envio or not puede_acceder_formulario(usuario_acceso, envio.id_formulario):
+                return jsonify({"error": "No tienes permisos para acceder a este dibujo."}), 403
+            if usuario_acceso.rol == 'usuario_formulario' and envio.id_usuario != usuario_acceso.id_usuario:
+                return jsonify({"error": "No tienes permisos para acceder a este dibujo."}), 403
+
+        dibujo = respuesta.valor_trazos[indice]
+        contenido, huella = renderizar(dibujo, formato, ancho)
+        etag = f"trazos-{huella}-{formato}-{ancho or 0}"
+        no_modificado = respuesta_no_modificada(etag, TRAZOS_URL_MAX_AGE)
+        if no_modificado:
+            return no_modificado
+        return con_etag(Response(contenido, mimetype=CONTENT_TYPES[formato]), etag, TRAZOS_URL_MAX_AGE), 200
+
+    except TrazosInvalidos as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error al renderizar trazos de la respuesta {respuesta_id}: {e}")
+        return jsonify({"error": f"Error interno del servidor al renderizar el dibujo: {str(e)}"}), 500
+
+
 
 @api.route('/envios-formulario/<int:envio_id>', methods=['PUT'])
 @role_required(['owner', 'admin_empresa'])
@@ -3654,7 +3945,7 @@ def update_envio_formulario(envio_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         envio = EnvioFormulario.query.get(envio_id)
@@ -3667,16 +3958,8 @@ def update_envio_formulario(envio_id):
 
         # Control de acceso: owner puede todo, admin_empresa solo los de su empresa
         # MODIFICADO: Control de acceso para plantillas
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario_asociado.es_plantilla:
-                if formulario_asociado.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario_asociado.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario_asociado.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para actualizar este envío de formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario_asociado.id_formulario):
+            return jsonify({"error": "No tienes permisos para actualizar este envío de formulario."}), 403
 
         if not data:
             return jsonify({"error": "No se recibieron datos para actualizar."}), 400
@@ -3730,7 +4013,7 @@ def delete_envio_formulario(envio_id):
     """
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         envio = EnvioFormulario.query.get(envio_id)
         if not envio:
@@ -3742,16 +4025,8 @@ def delete_envio_formulario(envio_id):
 
         # Control de acceso: owner puede todo, admin_empresa solo los de su empresa
         # También permite eliminar si es una plantilla compartida (si el admin_empresa es de la empresa destino)
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario_asociado.es_plantilla:
-                if formulario_asociado.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario_asociado.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario_asociado.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para eliminar este envío de formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario_asociado.id_formulario):
+            return jsonify({"error": "No tienes permisos para eliminar este envío de formulario."}), 403
 
         # --- INICIO DE ELIMINACIÓN EN CASCADA MANUAL PARA ENVIOFORMULARIO ---
 
@@ -3783,7 +4058,7 @@ def delete_envio_formulario(envio_id):
 @jwt_required()
 def get_user_favorites():
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -3797,7 +4072,7 @@ def get_user_favorites():
 @jwt_required()
 def add_favorite_form(form_id):
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -3824,7 +4099,7 @@ def add_favorite_form(form_id):
 @jwt_required()
 def remove_favorite_form(form_id):
     current_user_id = get_jwt_identity()
-    usuario = Usuario.query.get(int(current_user_id))
+    usuario = get_current_usuario()
 
     if not usuario:
         return jsonify({"error": "Usuario no encontrado"}), 404
@@ -3847,7 +4122,7 @@ def remove_favorite_form(form_id):
 def toggle_formulario_notificaciones(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         formulario = Formulario.query.get(form_id)
         if not formulario:
@@ -3878,7 +4153,7 @@ def toggle_formulario_notificaciones(form_id):
 def toggle_formulario_automatizacion(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
 
         formulario = Formulario.query.get(form_id)
         if not formulario:
@@ -3893,6 +4168,7 @@ def toggle_formulario_automatizacion(form_id):
             return jsonify({"error": "Como owner, solo puedes modificar la automatización para formularios de tu empresa principal."}), 403
 
         formulario.automatizacion_activa = not formulario.automatizacion_activa
+        programar_automatizacion(formulario)
         db.session.commit()
 
         status = "activada" if formulario.automatizacion_activa else "desactivada"
@@ -3910,79 +4186,20 @@ def toggle_formulario_automatizacion(form_id):
 @jwt_required()
 def ejecutar_automatizacion_formularios():
     """
-    Ejecuta el proceso de automatización para todos los formularios activos.
-    Este endpoint es llamado por la interfaz de usuario para una ejecución manual de prueba.
+    Ejecución manual de prueba de la automatización desde la interfaz. La ejecución periódica la hace
+    `flask automation-worker`; ambas comparten el registro diario, así que no se duplican envíos.
     """
     try:
-        current_user_id = get_jwt_identity()
-        usuario_actual = Usuario.query.get(int(current_user_id))
+        usuario_actual = get_current_usuario()
 
         if not usuario_actual:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
         print("Iniciando ejecución de automatización...")
-        
-        # Filtramos los formularios que tienen la automatización activa
-        formularios_a_automatizar = Formulario.query.filter_by(automatizacion_activa=True).all()
-        
-        formularios_procesados = []
-
-        for formulario in formularios_a_automatizar:
-            # Lógica para verificar si se debe ejecutar la automatización hoy
-            today = date.today()
-            if formulario.last_automated_run_date and formulario.last_automated_run_date == today:
-                print(f"La automatización para el formulario {formulario.nombre_formulario} ya se ejecutó hoy. Saltando.")
-                continue
-
-            # Obtener el conteo de envíos manuales
-            # CORREGIDO: Se usa el campo 'completado_automaticamente' del modelo EnvioFormulario
-            manual_submissions_count = EnvioFormulario.query.join(Usuario).\
-                filter(EnvioFormulario.id_formulario == formulario.id_formulario,
-                       EnvioFormulario.completado_automaticamente == False,
-                       Usuario.id_empresa == usuario_actual.id_empresa).count()
-            
-            # Verificar si se cumplen las condiciones para la automatización (ej. 5 envíos manuales)
-            if manual_submissions_count < 5:
-                print(f"El formulario '{formulario.nombre_formulario}' no tiene suficientes envíos manuales para automatizar ({manual_submissions_count}/5).")
-                continue
-
-            # Calcular el promedio o la moda de los datos existentes
-            valores_calculados = calcular_valores_automatizados(formulario.id_formulario, usuario_actual.id_empresa)
-
-            if not valores_calculados:
-                print(f"No se pudieron calcular valores para el formulario '{formulario.nombre_formulario}'. Saltando.")
-                continue
-
-            # Crear un nuevo envío de formulario (EnvioFormulario)
-            nuevo_envio = EnvioFormulario(
-                id_formulario=formulario.id_formulario,
-                id_usuario=usuario_actual.id_usuario,
-                fecha_hora_envio=datetime.utcnow(),
-                # CORREGIDO: Se establece el valor del campo 'completado_automaticamente'
-                completado_automaticamente=True
-            )
-            db.session.add(nuevo_envio)
-            db.session.flush() # Esto asigna un id_envio al nuevo objeto
-
-            # Crear las respuestas basadas en los valores calculados
-            for id_pregunta, valor_calculado in valores_calculados.items():
-                nueva_respuesta = Respuesta(
-                    id_envio=nuevo_envio.id_envio,
-                    id_pregunta=id_pregunta,
-                    valor_texto=valor_calculado.get('valor_texto'),
-                    valor_numerico=valor_calculado.get('valor_numerico'),
-                    valor_booleano=valor_calculado.get('valor_booleano'),
-                    valores_multiples_json=valor_calculado.get('valores_multiples_json')
-                )
-                db.session.add(nueva_respuesta)
 
-            # Actualizar la fecha de la última ejecución
-            formulario.last_automated_run_date = today
-            db.session.add(formulario)
-            db.session.commit()
-            
-            formularios_procesados.append(formulario.nombre_formulario)
-            print(f"Automatización exitosa para el formulario '{formulario.nombre_formulario}'.")
+        # Un owner ejecuta la de todas las empresas; los demás, solo la de su empresa
+        id_empresa = None if usuario_actual.rol == 'owner' else usuario_actual.id_empresa
+        formularios_procesados = ejecutar_automatizacion(actor=usuario_actual, id_empresa=id_empresa, origen='manual')
 
         if not formularios_procesados:
             return jsonify({"message": "No hay formularios listos para ser automatizados."}), 200
@@ -3997,94 +4214,6 @@ def ejecutar_automatizacion_formularios():
         print(f"Error al ejecutar la automatización: {str(e)}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
-def calcular_valores_automatizados(form_id, empresa_id):
-    """
-    Calcula los valores (moda o promedio) para las respuestas de un formulario.
-    """
-    from collections import Counter
-    
-    valores_por_pregunta = {}
-    
-    # Obtener todas las preguntas del formulario
-    preguntas = Pregunta.query.filter_by(id_formulario=form_id).all()
-    
-    for pregunta in preguntas:
-        # Obtener todas las respuestas manuales para esta pregunta
-        # CORREGIDO: Ahora se obtienen los últimos 3 envíos manuales
-        respuestas_manuales = Respuesta.query.join(EnvioFormulario).\
-            filter(Respuesta.id_pregunta == pregunta.id_pregunta,
-                   EnvioFormulario.completado_automaticamente == False,
-                   EnvioFormulario.id_formulario == form_id).\
-            join(Usuario).filter(Usuario.id_empresa == empresa_id).\
-            order_by(EnvioFormulario.fecha_hora_envio.desc()).limit(3).all()
-            
-        if not respuestas_manuales:
-            continue
-
-        tipo_respuesta = pregunta.tipo_respuesta.nombre_tipo
-        valor_calculado = {}
-
-        if tipo_respuesta == 'numerico':
-            valores_numericos = [r.valor_numerico for r in respuestas_manuales if r.valor_numerico is not None]
-            if valores_numericos:
-                promedio = sum(valores_numericos) / len(valores_numericos)
-                valor_calculado = {'valor_numerico': promedio}
-        elif tipo_respuesta in ['seleccion_unica', 'booleano', 'texto_corto']:
-            valores_texto = [r.valor_texto for r in respuestas_manuales if r.valor_texto is not None]
-            if valores_texto:
-                moda = Counter(valores_texto).most_common(1)[0][0]
-                valor_calculado = {'valor_texto': moda}
-        elif tipo_respuesta == 'seleccion_multiple':
-            valores_multiples = []
-            for r in respuestas_manuales:
-                if r.valores_multiples_json:
-                    try:
-                        selected_options = json.loads(r.valores_multiples_json)
-                        valores_multiples.extend(selected_options)
-                    except json.JSONDecodeError:
-                        continue
-            if valores_multiples:
-                moda_multiple = Counter(valores_multiples).most_common(1)[0][0]
-                valor_calculado = {'valores_multiples_json': json.dumps([moda_multiple])}
-        elif tipo_respuesta == 'seleccion_recursos':
-            # CORREGIDO: Se recolectan todos los recursos únicos de los últimos 3 envíos
-            recursos_unicos = set()
-            for r in respuestas_manuales:
-                if r.valores_multiples_json:
-                    try:
-                        selected_options = json.loads(r.valores_multiples_json)
-                        if isinstance(selected_options, list):
-                            recursos_unicos.update(selected_options)
-                        else:
-                            recursos_unicos.add(selected_options)
-                    except json.JSONDecodeError:
-                        continue
-            
-            if recursos_unicos:
-                valor_calculado = {'valores_multiples_json': json.dumps(list(recursos_unicos))}
-
-        elif tipo_respuesta in ['firma', 'dibujo']:
-            # Obtener el valor de la última respuesta
-            ultima_respuesta = Respuesta.query.join(EnvioFormulario).\
-                filter(Respuesta.id_pregunta == pregunta.id_pregunta,
-                       # CORREGIDO: Se usa el campo 'completado_automaticamente' del modelo EnvioFormulario
-                       EnvioFormulario.completado_automaticamente == False,
-                       EnvioFormulario.id_formulario == form_id).\
-                join(Usuario).filter(Usuario.id_empresa == empresa_id).\
-                order_by(EnvioFormulario.fecha_hora_envio.desc()).first()
-            
-            if ultima_respuesta and ultima_respuesta.valor_texto:
-                valor_calculado = {'valor_texto': ultima_respuesta.valor_texto}
-        
-        # Tipos de respuesta que se dejan vacíos
-        elif tipo_respuesta in ['texto', 'texto_largo', 'fecha', 'hora']:
-            pass
-
-        if valor_calculado:
-            valores_por_pregunta[pregunta.id_pregunta] = valor_calculado
-            
-    return valores_por_pregunta
-
 
     
 # NUEVA RUTA: Para obtener el conteo de envíos manuales de un usuario para un formulario
@@ -4093,7 +4222,7 @@ def calcular_valores_automatizados(form_id, empresa_id):
 def get_manual_submissions_count(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -4102,16 +4231,8 @@ def get_manual_submissions_count(form_id):
             return jsonify({"error": "Formulario no encontrado."}), 404
 
         # Control de acceso (similar a otras rutas de formulario)
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
 
         # Contar solo envíos manuales (completado_automaticamente = False)
         count = EnvioFormulario.query.filter(
@@ -4134,7 +4255,7 @@ def get_manual_submissions_count(form_id):
 def set_formulario_automation_schedule(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         data = request.get_json()
 
         # No es necesario que existan datos, pero si los hay, deben ser un diccionario
@@ -4168,14 +4289,18 @@ def set_formulario_automation_schedule(form_id):
             if not isinstance(automation_submissions_count, int) or automation_submissions_count <= 0:
                 return jsonify({"error": "La cantidad de envíos automáticos debe ser un número entero positivo."}), 400
             formulario.automation_submissions_count = automation_submissions_count
-        
+
+        # NUEVO: La nueva hora aplica desde la próxima ejecución
+        programar_automatizacion(formulario)
+
         # Guardar los cambios en la base de datos
         db.session.commit()
 
         return jsonify({
             "message": f"Configuración de automatización para '{formulario.nombre_formulario}' actualizada exitosamente.",
             "scheduled_automation_time": formulario.scheduled_automation_time.strftime('%H:%M') if formulario.scheduled_automation_time else None,
-            "automation_submissions_count": formulario.automation_submissions_count
+            "automation_submissions_count": formulario.automation_submissions_count,
+            "next_automation_at": formulario.next_automation_at.isoformat() if formulario.next_automation_at else None
         }), 200
 
     except Exception as e:
@@ -4189,7 +4314,7 @@ def set_formulario_automation_schedule(form_id):
 def get_forms_for_analytics():
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -4201,20 +4326,9 @@ def get_forms_for_analytics():
             ]
             return jsonify({"formularios": formularios_data}), 200
 
-        formularios_accesibles = []
-        
-        formularios_empresa = Formulario.query.filter_by(id_empresa=usuario.id_empresa).all()
-        formularios_accesibles.extend(formularios_empresa)
-        
-        plantillas_globales = Formulario.query.filter_by(es_plantilla_global=True).all()
-        formularios_accesibles.extend(plantillas_globales)
-        
-        plantillas_compartidas = Formulario.query.filter(
-            Formulario.compartir_con_empresas_ids.cast(db.String).ilike(f'%"{usuario.id_empresa}"%')
+        formularios_finales = Formulario.query.filter(
+            condicion_formularios_accesibles(usuario.id_empresa)
         ).all()
-        formularios_accesibles.extend(plantillas_compartidas)
-
-        formularios_finales = list({f.id_formulario: f for f in formularios_accesibles}.values())
 
         formularios_data = [
             {"id_formulario": f.id_formulario, "nombre_formulario": f.nombre_formulario, "es_plantilla": f.es_plantilla}
@@ -4232,7 +4346,7 @@ def get_forms_for_analytics():
 def get_questions_for_analytics(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -4240,16 +4354,8 @@ def get_questions_for_analytics(form_id):
         if not formulario:
             return jsonify({"error": "Formulario no encontrado."}), 404
 
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
 
         preguntas = Pregunta.query.filter_by(id_formulario=form_id).options(joinedload(Pregunta.tipo_respuesta)).all()
 
@@ -4273,7 +4379,7 @@ def get_questions_for_analytics(form_id):
 def get_responses_for_analytics(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -4281,16 +4387,8 @@ def get_responses_for_analytics(form_id):
         if not formulario:
             return jsonify({"error": "Formulario no encontrado."}), 404
 
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
 
         question_id = request.args.get('question_id', type=int)
         start_date_str = request.args.get('start_date')
@@ -4421,10 +4519,19 @@ def get_responses_for_analytics(form_id):
             ]
             chart_type = "table_text"
         elif selected_question_type in ['firma', 'dibujo']:
-            chart_data = [
-                {"id": r.id_respuesta, "value": r.valor_texto}
-                for r in results if r.valor_texto
-            ]
+            # La imagen está en valor_firma_url (o en valor_texto en datos antiguos); si se guardó
+            # como trazos se entrega una miniatura renderizada bajo demanda
+            chart_data = []
+            for r in results:
+                if r.valor_texto:
+                    valor = r.valor_texto
+                elif r.valor_firma_url:
+                    valor = r.valor_firma_url[0]
+                elif r.valor_trazos:
+                    valor = url_trazos(r.id_respuesta, 0, ancho=200)
+                else:
+                    continue
+                chart_data.append({"id": r.id_respuesta, "value": valor})
             chart_type = "table_image"
         
         return jsonify({"data": chart_data, "chart_type": chart_type, "message": "Datos de gráfico generados exitosamente."}), 200
@@ -4433,14 +4540,29 @@ def get_responses_for_analytics(form_id):
         print(f"Error al obtener datos de análisis: {e}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
-# Función auxiliar para extraer el public_id de la URL de Cloudinary
-def get_public_id_from_url(url):
-    """Extrae el public_id de una URL de Cloudinary."""
-    # La URL completa es algo como: https://res.cloudinary.com/.../raw/upload/v12345678/mi_archivo.pdf
-    # El public_id es 'mi_archivo'
-    if '/upload/' in url:
-        return url.split('/')[-1].split('.')[0]
-    return None
+# NUEVO: Métricas del cliente de Cloudinary (latencia, fallos, estado del circuito)
+@api.route('/metricas/almacenamiento', methods=['GET'])
+@role_required(['owner'])
+def get_metricas_almacenamiento():
+    return jsonify({"almacenamiento": obtener_almacenamiento().nombre, "cloudinary": metricas_cloudinary()}), 200
+
+
+# NUEVO: Archivos del almacenamiento local (api/storage.py). La ruta deriva del SHA-256 del contenido,
+# así que es pública como una URL de Cloudinary y se puede cachear para siempre.
+@api.route('/archivos/<path:ruta>', methods=['GET'])
+def get_archivo_almacenado(ruta):
+    return almacenamiento_local().servir(ruta)
+
+
+def _eliminar_pdf_si_no_se_usa(documento):
+    # En el almacenamiento local dos documentos con el mismo PDF comparten archivo
+    en_uso = DocumentosMinisterio.query.filter(
+        DocumentosMinisterio.url_archivo == documento.url_archivo,
+        DocumentosMinisterio.id != documento.id
+    ).first()
+    if not en_uso:
+        # 'raw' es el tipo de recurso que usamos para los PDF
+        eliminar_archivo(documento.url_archivo, 'raw')
 
 # --- Rutas para la gestión de categorías ---
 
@@ -4468,6 +4590,7 @@ def create_documento_categoria():
         )
         db.session.add(nueva_categoria)
         db.session.commit()
+        invalidar_catalogo(DOCUMENTOS)
         return jsonify({
             "message": "Categoría creada exitosamente.",
             "categoria": nueva_categoria.serialize()
@@ -4494,11 +4617,8 @@ def delete_documento_categoria(categoria_id):
         # Eliminar los archivos de Cloudinary y los registros de los documentos
         for documento in categoria.documentos:
             try:
-                # Extraer el public_id del archivo para Cloudinary
-                public_id = get_public_id_from_url(documento.url_archivo)
-                if public_id:
-                    # 'raw' es el tipo de recurso que usamos para los PDF
-                    cloudinary.uploader.destroy(public_id, resource_type="raw")
+                if documento.tipo_contenido == 'pdf':
+                    _eliminar_pdf_si_no_se_usa(documento)
                 
                 db.session.delete(documento)
             except Exception as e:
@@ -4512,6 +4632,7 @@ def delete_documento_categoria(categoria_id):
         # Finalmente, eliminar la categoría de la base de datos
         db.session.delete(categoria)
         db.session.commit()
+        invalidar_catalogo(DOCUMENTOS)
         
         return jsonify({"message": f"Categoría '{categoria.nombre}' y todos sus documentos eliminados exitosamente."}), 200
 
@@ -4550,9 +4671,8 @@ def upload_pdf():
         if not categoria:
             return jsonify({"error": "La categoría seleccionada no existe."}), 404
 
-        # Subir el documento a Cloudinary
-        upload_result = cloudinary.uploader.upload(documento_pdf, resource_type="raw")
-        url_documento = upload_result['secure_url']
+        # Subir el documento al almacenamiento configurado
+        url_documento = obtener_almacenamiento().guardar(documento_pdf, 'raw', 'application/pdf')
 
         # Crear nuevo registro en la base de datos
         nuevo_documento = DocumentosMinisterio(
@@ -4565,12 +4685,16 @@ def upload_pdf():
         )
         db.session.add(nuevo_documento)
         db.session.commit()
+        invalidar_catalogo(DOCUMENTOS)
 
         return jsonify({
             "message": "PDF subido y card creada exitosamente.",
             "documento": nuevo_documento.serialize()
         }), 201
 
+    except ProveedorNoDisponible as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         db.session.rollback()
         print(f"Error al subir el PDF: {str(e)}")
@@ -4615,6 +4739,7 @@ def upload_link():
         )
         db.session.add(nuevo_documento)
         db.session.commit()
+        invalidar_catalogo(DOCUMENTOS)
 
         return jsonify({
             "message": "Link subido y card creada exitosamente.",
@@ -4625,6 +4750,178 @@ def upload_link():
         db.session.rollback()
         print(f"Error al subir el link: {str(e)}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+
+# --- NUEVO: SUBIDAS REANUDABLES POR PARTES (api/resumable_uploads.py) ---
+# Para PDFs grandes y para imagen de perfil / firma: el archivo llega en partes a un spool local
+# y la subida final se hace en segundo plano. Tras un corte, el cliente consulta el offset y sigue.
+
+def _subida_del_usuario(subida_id):
+    subida = db.session.get(SubidaReanudable, subida_id)
+    if not subida or subida.id_usuario != int(get_jwt_identity()):
+        return None, (jsonify({"error": "Subida no encontrada."}), 404)
+    return subida, None
+
+
+def _respuesta_subida(subida, status):
+    resp = jsonify({"subida": subida.serialize()})
+    resp.headers['Upload-Offset'] = str(subida.recibidos)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp, status
+
+
+@api.route('/subidas', methods=['POST'])
+@jwt_required()
+def iniciar_subida():
+    """
+    Crea una subida reanudable. JSON: proposito ('documento_pdf', 'imagen_perfil' o 'firma_digital'),
+    tamano (bytes), content_type, nombre_archivo y sha256 opcionales; para documento_pdf también titulo y categoria_id.
+    """
+    usuario = get_current_usuario()
+    if not usuario:
+        return jsonify({"error": "Usuario no encontrado"}), 404
+
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "No se proporcionaron datos JSON."}), 400
+
+    proposito = data.get('proposito')
+    metadatos = None
+    try:
+        if proposito == 'documento_pdf':
+            # Mismas reglas que /documentos-ministerio/upload-pdf
+            if usuario.rol not in ['owner', 'admin_empresa']:
+                return jsonify({"error": "Acceso no autorizado: No tienes el rol requerido"}), 403
+            titulo = data.get('titulo')
+            categoria_id = data.get('categoria_id')
+            if not titulo or titulo.strip() == "":
+                return jsonify({"error": "El título del documento es obligatorio."}), 400
+            if not categoria_id:
+                return jsonify({"error": "La categoría del documento es obligatoria."}), 400
+            if not DocumentoCategoria.query.get(int(categoria_id)):
+                return jsonify({"error": "La categoría seleccionada no existe."}), 404
+            metadatos = {"titulo": titulo, "categoria_id": int(categoria_id)}
+
+        limpiar_expiradas()
+        subida = crear_subida(
+            usuario.id_usuario,
+            proposito,
+            data.get('tamano'),
+            data.get('content_type'),
+            nombre_archivo=data.get('nombre_archivo'),
+            sha256=data.get('sha256'),
+            metadatos=metadatos
+        )
+        db.session.commit()
+        resp, status = _respuesta_subida(subida, 201)
+        resp.headers['Location'] = url_for('api.subir_parte', subida_id=subida.id)
+        return resp, status
+
+    except (SubidaInvalida, ValueError, TypeError) as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al iniciar la subida: {str(e)}")
+        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+
+
+@api.route('/subidas/<subida_id>', methods=['PUT'])
+@jwt_required()
+def subir_parte(subida_id):
+    """
+    Agrega una parte. Cuerpo: bytes del archivo desde ?offset= (o cabecera Upload-Offset); requiere Content-Length.
+    Responde 409 con el offset correcto si la parte no empieza donde termina lo recibido.
+    """
+    subida, error = _subida_del_usuario(subida_id)
+    if error:
+        return error
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({"error": "Se requiere el offset de la parte (?offset= o cabecera Upload-Offset)."}), 400
+
+    try:
+        nuevo_offset = escribir_parte(subida, offset, request.stream, request.content_length)
+        resp = jsonify({"offset": nuevo_offset, "completo": nuevo_offset == subida.tamano_total})
+        resp.headers['Upload-Offset'] = str(nuevo_offset)
+        return resp, 200
+    except ConflictoOffset as e:
+        resp = jsonify({"error": str(e), "offset": e.offset})
+        resp.headers['Upload-Offset'] = str(e.offset)
+        return resp, 409
+    except SubidaInvalida as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al recibir parte de la subida {subida_id}: {str(e)}")
+        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+
+
+@api.route('/subidas/<subida_id>', methods=['GET'])
+@jwt_required()
+def get_subida(subida_id):
+    """
+    Estado de la subida y offset desde el que se debe continuar.
+    """
+    subida, error = _subida_del_usuario(subida_id)
+    if error:
+        return error
+    try:
+        reconciliar_offset(subida)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al reconciliar el offset de la subida {subida_id}: {str(e)}")
+    return _respuesta_subida(subida, 200)
+
+
+@api.route('/subidas/<subida_id>/finalizar', methods=['POST'])
+@jwt_required()
+def finalizar_subida(subida_id):
+    """
+    Encola la verificación y subida final del archivo. Responde 202; el cliente consulta GET /subidas/<id>
+    hasta que el estado sea 'completado' (con url_resultado y resultado) o 'fallido' (puede volver a finalizar).
+    """
+    subida, error = _subida_del_usuario(subida_id)
+    if error:
+        return error
+    if subida.estado == 'completado':
+        return _respuesta_subida(subida, 200)
+    if subida.estado == 'cancelado':
+        return jsonify({"error": "La subida fue cancelada."}), 409
+
+    try:
+        iniciar_finalizacion(current_app._get_current_object(), subida)
+        db.session.refresh(subida)
+        return _respuesta_subida(subida, 202)
+    except ConflictoOffset as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al finalizar la subida {subida_id}: {str(e)}")
+        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+
+
+@api.route('/subidas/<subida_id>', methods=['DELETE'])
+@jwt_required()
+def cancelar_subida_route(subida_id):
+    """
+    Cancela una subida que aún no se ha finalizado y borra sus partes.
+    """
+    subida, error = _subida_del_usuario(subida_id)
+    if error:
+        return error
+    if subida.estado in ('ensamblando', 'completado'):
+        return jsonify({"error": "La subida ya fue finalizada."}), 409
+    try:
+        cancelar_subida(subida)
+        db.session.commit()
+        return jsonify({"message": "Subida cancelada."}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al cancelar la subida {subida_id}: {str(e)}")
+        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
     
 @api.route('/documentos-ministerio', methods=['GET'])
 @jwt_required()
@@ -4633,12 +4930,16 @@ def get_all_documentos_ministerio_with_categories():
     Devuelve la lista de todas las categorías, con sus documentos anidados.
     """
     try:
-        categorias = DocumentoCategoria.query.all()
-        lista_categorias = [cat.serialize() for cat in categorias]
-
-        return jsonify({
-            "categorias": lista_categorias
-        }), 200
+        def cargar():
+            # Los documentos de todas las categorías se cargan en una sola consulta adicional
+            categorias = DocumentoCategoria.query.options(selectinload(DocumentoCategoria.documentos)).all()
+            return {"categorias": [cat.serialize() for cat in categorias]}
+
+        payload, etag = obtener_catalogo(DOCUMENTOS, cargar)
+        no_modificado = respuesta_no_modificada(etag, CATALOGO_MAX_AGE)
+        if no_modificado:
+            return no_modificado
+        return con_etag(jsonify(payload), etag, CATALOGO_MAX_AGE), 200
     except Exception as e:
         print(f"Error al obtener las categorías y documentos: {str(e)}")
         return jsonify({"error": "Error interno del servidor."}), 500
@@ -4656,17 +4957,17 @@ def delete_documento_ministerio(documento_id):
         if not documento:
             return jsonify({"error": "Documento no encontrado."}), 404
 
-        # Eliminar el archivo de Cloudinary
-        public_id = get_public_id_from_url(documento.url_archivo)
-        if public_id:
+        # Eliminar el archivo del almacenamiento
+        if documento.tipo_contenido == 'pdf':
             try:
-                cloudinary.uploader.destroy(public_id, resource_type="raw")
+                _eliminar_pdf_si_no_se_usa(documento)
             except Exception as e:
-                print(f"Advertencia: No se pudo eliminar el archivo de Cloudinary. {str(e)}")
+                print(f"Advertencia: No se pudo eliminar el archivo del almacenamiento. {str(e)}")
 
         # Eliminar el registro de la base de datos
         db.session.delete(documento)
         db.session.commit()
+        invalidar_catalogo(DOCUMENTOS)
 
         return jsonify({"message": "Documento eliminado exitosamente."}), 200
 
@@ -4684,7 +4985,7 @@ def delete_documento_ministerio(documento_id):
 def get_envios_by_form(form_id):
     try:
         current_user_id = get_jwt_identity()
-        usuario = Usuario.query.get(int(current_user_id))
+        usuario = get_current_usuario()
         if not usuario:
             return jsonify({"error": "Usuario no encontrado."}), 404
 
@@ -4692,23 +4993,9 @@ def get_envios_by_form(form_id):
         if not formulario:
             return jsonify({"error": "Formulario no encontrado."}), 404
 
-        # Obtener el parámetro 'limit' de la URL, si no existe, usar un valor por defecto
-        # En este caso, el valor por defecto es None para obtener todos los envíos si no se especifica.
-        # Si se usa en el frontend, el valor debería ser 9.
-        limit_str = request.args.get('limit')
-        limit = int(limit_str) if limit_str and limit_str.isdigit() else None
-        
         # Control de acceso: el usuario debe tener permisos para ver este formulario
-        if usuario.rol != 'owner':
-            is_allowed_template = False
-            if formulario.es_plantilla:
-                if formulario.es_plantilla_global:
-                    is_allowed_template = True
-                elif usuario.id_empresa in formulario.compartir_con_empresas_ids:
-                    is_allowed_template = True
-            
-            if not is_allowed_template and formulario.id_empresa != usuario.id_empresa:
-                return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
+        if not puede_acceder_formulario(usuario, formulario.id_formulario):
+            return jsonify({"error": "No tienes permisos para acceder a este formulario."}), 403
 
         query = EnvioFormulario.query
 
@@ -4722,23 +5009,32 @@ def get_envios_by_form(form_id):
                 Usuario.id_empresa == usuario.id_empresa
             )
 
-        # Ordenar por fecha_hora_envio de forma descendente y aplicar el límite
-        query = query.order_by(db.desc(EnvioFormulario.fecha_hora_envio))
-        if limit is not None:
-            query = query.limit(limit)
+        # El usuario de cada envío se carga en la misma consulta (antes: un Usuario.query.get por fila)
+        query = query.options(joinedload(EnvioFormulario.usuario))
+        orden = [EnvioFormulario.fecha_hora_envio, EnvioFormulario.id_envio]
 
-        envios = query.all()
-
-        envios_data = []
-        for envio in envios:
-            usuario_envio = Usuario.query.get(envio.id_usuario)
-            envios_data.append({
+        def serializar(envio):
+            return {
                 "id_envio": envio.id_envio,
                 "fecha_hora_envio": envio.fecha_hora_envio.isoformat(),
-                "nombre_usuario": usuario_envio.nombre_completo if usuario_envio else 'N/A'
-            })
+                "nombre_usuario": envio.usuario.nombre_completo if envio.usuario else 'N/A'
+            }
+
+        try:
+            if pide_stream():
+                query = filtrar_despues_de(ordenar_keyset(query, orden), orden, request.args.get('after'))
+                return stream_ndjson(query, serializar)
+
+            # ?limit= (el frontend usa 9) devuelve la primera página; ?after= continúa desde next_cursor
+            if pide_paginacion():
+                envios, next_cursor = paginar_keyset(query, orden, after=request.args.get('after'), limit=parse_limit(request.args.get('limit')))
+                return jsonify({"envios": [serializar(envio) for envio in envios], "next_cursor": next_cursor}), 200
+        except CursorInvalido as e:
+            return jsonify({"error": str(e)}), 400
 
-        return jsonify({"envios": envios_data}), 200
+        # Sin límite: todos los envíos, ordenados por fecha_hora_envio de forma descendente
+        envios = ordenar_keyset(query, orden).all()
+        return jsonify({"envios": [serializar(envio) for envio in envios]}), 200
 
     except Exception as e:
         print(f"Error al obtener envíos para el formulario {form_id}: {e}")
@@ -4751,8 +5047,9 @@ def get_envios_by_form(form_id):
 def get_current_user_company_id(user_id):
     """Obtiene el ID de la empresa del usuario actual (Placeholder)."""
     # Lógica real: usuario = Usuario.query.get(user_id); return usuario.id_empresa
-    usuario = Usuario.query.get(user_id)
-    return usuario.id_empresa if usuario else None
+    # Usa la caché de principales en lugar de cargar el Usuario en cada petición
+    principal = obtener_principal(user_id)
+    return principal.id_empresa if principal else None
 
 # --- CRUD: Grados ---
 
@@ -4777,6 +5074,7 @@ def create_grado():
         )
         db.session.add(nuevo_grado)
         db.session.commit()
+        invalidar_catalogo(GRADOS, id_empresa)
         # Nota: La serialización debe usar el campo nombre_grado del modelo
         return jsonify({"message": "Grado creado exitosamente.", "grado": nuevo_grado.serialize()}), 201
     except Exception as e:
@@ -4794,8 +5092,15 @@ def get_all_grados():
         return jsonify({"error": "Empresa no asociada al usuario."}), 404
 
     # Filtra solo los grados activos
-    grados = Grado.query.filter_by(id_empresa=id_empresa, activo=True).order_by(Grado.orden).all()
-    return jsonify({"grados": [g.serialize() for g in grados]}), 200
+    payload, etag = obtener_catalogo(
+        GRADOS,
+        lambda: {"grados": [g.serialize() for g in Grado.query.filter_by(id_empresa=id_empresa, activo=True).order_by(Grado.orden).all()]},
+        id_empresa
+    )
+    no_modificado = respuesta_no_modificada(etag, CATALOGO_MAX_AGE)
+    if no_modificado:
+        return no_modificado
+    return con_etag(jsonify(payload), etag, CATALOGO_MAX_AGE), 200
 
 @api.route('/grados/<int:grado_id>', methods=['PUT'])
 @role_required(['owner', 'admin_empresa','usuario_formulario'])
@@ -4833,6 +5138,7 @@ def update_grado(grado_id):
              grado.activo = bool(activo)
         
         db.session.commit()
+        invalidar_catalogo(GRADOS, id_empresa)
         return jsonify({"message": "Grado actualizado exitosamente.", "grado": grado.serialize()}), 200
 
     except Exception as e:
@@ -4864,11 +5170,13 @@ def delete_grado(grado_id):
             # Si hay estudiantes activos, se recomienda solo desactivar el grado
             grado.activo = False
             db.session.commit()
+            invalidar_catalogo(GRADOS, id_empresa)
             return jsonify({"message": f"Grado '{grado.nombre_grado}' desactivado exitosamente (hay estudiantes activos asociados).", "grado": grado.serialize()}), 200
 
         # Si no hay dependencias activas, se puede eliminar (o desactivar si es la política)
         db.session.delete(grado)
         db.session.commit()
+        invalidar_catalogo(GRADOS, id_empresa)
         return jsonify({"message": f"Grado '{grado.nombre_grado}' eliminado exitosamente."}), 200
 
     except Exception as e:
@@ -4901,6 +5209,7 @@ def create_concepto():
         )
         db.session.add(nuevo_concepto)
         db.session.commit()
+        invalidar_catalogo(CONCEPTOS, id_empresa)
         # Nota: La serialización debe usar el campo nombre_concepto y valor_base
         return jsonify({"message": "Concepto creado exitosamente.", "concepto": nuevo_concepto.serialize()}), 201
     except ValueError:
@@ -4919,8 +5228,15 @@ def get_all_conceptos():
     if not id_empresa:
         return jsonify({"error": "Empresa no asociada al usuario."}), 404
 
-    conceptos = Concepto.query.filter_by(id_empresa=id_empresa, activo=True).all()
-    return jsonify({"conceptos": [c.serialize() for c in conceptos]}), 200
+    payload, etag = obtener_catalogo(
+        CONCEPTOS,
+        lambda: {"conceptos": [c.serialize() for c in Concepto.query.filter_by(id_empresa=id_empresa, activo=True).all()]},
+        id_empresa
+    )
+    no_modificado = respuesta_no_modificada(etag, CATALOGO_MAX_AGE)
+    if no_modificado:
+        return no_modificado
+    return con_etag(jsonify(payload), etag, CATALOGO_MAX_AGE), 200
 
 @api.route('/conceptos/<int:concepto_id>', methods=['PUT'])
 @role_required(['owner', 'admin_empresa', 'usuario_formulario'])
@@ -4958,6 +5274,7 @@ def update_concepto(concepto_id):
             concepto.activo = bool(activo)
         
         db.session.commit()
+        invalidar_catalogo(CONCEPTOS, id_empresa)
         return jsonify({"message": "Concepto actualizado exitosamente.", "concepto": concepto.serialize()}), 200
 
     except Exception as e:
@@ -4990,11 +5307,13 @@ def delete_concepto(concepto_id):
             # Si hay movimientos, solo se desactiva
             concepto.activo = False
             db.session.commit()
+            invalidar_catalogo(CONCEPTOS, id_empresa)
             return jsonify({"message": f"Concepto '{concepto.nombre_concepto}' desactivado exitosamente (tiene movimientos históricos).", "concepto": concepto.serialize()}), 200
 
         # Si no hay dependencias, se elimina
         db.session.delete(concepto)
         db.session.commit()
+        invalidar_catalogo(CONCEPTOS, id_empresa)
         return jsonify({"message": f"Concepto '{concepto.nombre_concepto}' eliminado exitosamente."}), 200
 
     except Exception as e:
@@ -5041,7 +5360,10 @@ def create_estudiante():
 @api.route('/estudiantes', methods=['GET'])
 @jwt_required()
 def get_all_estudiantes():
-    """Obtiene todos los estudiantes activos asociados a la empresa (con filtro opcional por grado)."""
+    """
+    Obtiene todos los estudiantes activos asociados a la empresa (con filtro opcional por grado).
+    Paginación opcional por cursor (?limit=, ?after=) y exportación en streaming (?stream=ndjson).
+    """
     current_user_id = get_jwt_identity()
     id_empresa = get_current_user_company_id(current_user_id)
     grado_id = request.args.get('grado_id', type=int)
@@ -5053,6 +5375,18 @@ def get_all_estudiantes():
     if grado_id:
         query = query.filter_by(id_grado=grado_id)
 
+    orden = [Estudiante.id_estudiante]
+    try:
+        if pide_stream():
+            query = filtrar_despues_de(ordenar_keyset(query, orden, descendente=False), orden, request.args.get('after'), descendente=False)
+            return stream_ndjson(query, lambda e: e.serialize())
+
+        if pide_paginacion():
+            estudiantes, next_cursor = paginar_keyset(query, orden, after=request.args.get('after'), limit=parse_limit(request.args.get('limit')), descendente=False)
+            return jsonify({"estudiantes": [e.serialize() for e in estudiantes], "next_cursor": next_cursor}), 200
+    except CursorInvalido as e:
+        return jsonify({"error": str(e)}), 400
+
     estudiantes = query.all()
     return jsonify({"estudiantes": [e.serialize() for e in estudiantes]}), 200
 
@@ -5143,26 +5477,7 @@ def delete_estudiante(student_id):
 
 # --- Proceso de Recibo (Venta) ---
 
-# --- FUNCIÓN AUXILIAR PARA EL ENVÍO ASÍNCRONO (DEBE ESTAR AL INICIO) ---
-
-def send_async_email(app, msg):
-    """
-    Envía correo dentro del contexto Flask-Mail.
-    Captura errores SMTP y los imprime para Render.
-    """
-    with app.app_context():
-        mail_sender = app.extensions.get('mail')
-        try:
-            mail_sender.send(msg)
-            print(f"✅ Correo ASÍNCRONO enviado con éxito a: {msg.recipients}")
-        except Exception as e:
-            import traceback
-            print(f"🛑 ERROR CRÍTICO DE CORREO (SMTP/RENDER): {type(e).__name__} | {str(e)}")
-            traceback.print_exc()  # <-- esto muestra la traza completa
-
 
-# URL del logo que solicitaste.
-LOGO_URL = "https://i.pinimg.com/736x/44/12/e9/4412e9bdd73724a178b18295e4ba921e.jpg"
 
 @api.route('/recibos/envio', methods=['POST'])
 @jwt_required()
@@ -5186,8 +5501,6 @@ def submit_recibo():
     # Asume que esta función y modelos están disponibles globalmente o importados
     id_empresa = get_current_user_company_id(current_user_id) 
     current_user = Usuario.query.get(current_user_id)
-    empresa_instance = Empresa.query.get(id_empresa)
-    empresa_nombre = empresa_instance.nombre_empresa
 
     if not detalles_data or not id_empresa:
         return jsonify({"error": "Detalles del recibo y empresa son requeridos."}), 400
@@ -5284,110 +5597,33 @@ def submit_recibo():
         if (tipo_pago == 'Total' or tipo_pago == 'Abono') and recipient_emails:
             try:
                 recibo_id = nueva_transaccion.id_transaccion
-                fecha_str = nueva_transaccion.fecha_transaccion.strftime('%d/%m/%Y %H:%M:%S')
-                
-                # Ajuste de títulos según el tipo de pago
-                asunto_tipo = "Recibo de Pago Total" if tipo_pago == 'Total' else "Recibo de Abono"
-                confirmacion_tipo = "el **pago total**" if tipo_pago == 'Total' else f"un **abono** de ${monto_pagado_ajustado:.2f}"
-
-                # Generar las filas de la tabla de detalles
-                tabla_filas = ""
-                for item in items_email:
-                    tabla_filas += f"""
-                    <tr>
-                        <td style="border: 1px solid #ddd; padding: 8px;">{item['estudiante']} ({item['grado']})</td>
-                        <td style="border: 1px solid #ddd; padding: 8px;">{item['concepto']}</td>
-                        <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{item['cantidad']}</td>
-                        <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">${item['valor_unitario']:.2f}</td>
-                        <td style="border: 1px solid #ddd; padding: 8px; text-align: right; font-weight: bold;">${item['subtotal']:.2f}</td>
-                    </tr>
-                    """
-
-                # Estructura HTML del correo con el logo y estilos
-                html_content = f"""
-                <html>
-                <body style="font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif; background-color: #f4f4f4; margin: 0; padding: 0;">
-                    <div style="max-width: 600px; margin: 20px auto; background: white; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.05); overflow: hidden;">
-                        
-                        <div style="text-align: center; padding: 20px 0; background-color: #f8f8f8; border-bottom: 3px solid #007bff;">
-                            <img src="{LOGO_URL}" 
-                                 alt="{empresa_nombre} Logo" 
-                                 style="max-width: 150px; height: auto; display: block; margin: 0 auto; border-radius: 5px;">
-                            <h1 style="color: #333; font-size: 24px; margin-top: 10px;">{asunto_tipo}</h1>
-                            <p style="color: #666; font-size: 14px;">{empresa_nombre}</p>
-                        </div>
-                        
-                        <div style="padding: 20px;">
-                            <p style="font-size: 16px; color: #333;">Hola estimado(a) responsable,</p>
-                            <p style="color: #555;">Confirmamos {confirmacion_tipo} del siguiente recibo registrado por **{current_user.nombre_completo}**.</p>
-                            
-                            <div style="background-color: #e9ecef; padding: 10px; border-radius: 4px; margin-bottom: 20px;">
-                                <p style="margin: 0; color: #333;"><strong>Transacción No:</strong> {recibo_id}</p>
-                                <p style="margin: 5px 0 0 0; color: #333;"><strong>Fecha:</strong> {fecha_str}</p>
-                            </div>
-
-                            <h3 style="color: #333; border-bottom: 1px solid #ddd; padding-bottom: 5px;">Detalles de Conceptos</h3>
-                            <table style="width: 100%; border-collapse: collapse; margin-bottom: 20px;">
-                                <thead style="background-color: #007bff; color: white;">
-                                    <tr>
-                                        <th style="border: 1px solid #007bff; padding: 8px; text-align: left;">Estudiante / Grado</th>
-                                        <th style="border: 1px solid #007bff; padding: 8px; text-align: left;">Concepto</th>
-                                        <th style="border: 1px solid #007bff; padding: 8px; text-align: right;">Cant.</th>
-                                        <th style="border: 1px solid #007bff; padding: 8px; text-align: right;">V. Unitario</th>
-                                        <th style="border: 1px solid #007bff; padding: 8px; text-align: right;">Subtotal</th>
-                                    </tr>
-                                </thead>
-                                <tbody>
-                                    {tabla_filas}
-                                    <tr>
-                                        <td colspan="4" style="border: 1px solid #ddd; padding: 10px; text-align: right; font-weight: bold; background-color: #f0f0f0;">MONTO PAGADO:</td>
-                                        <td style="border: 1px solid #ddd; padding: 10px; text-align: right; font-weight: bold; background-color: #f0f0f0; color: #28a745; font-size: 18px;">${monto_pagado_ajustado:.2f}</td>
-                                    </tr>
-                                    {f'''<tr>
-                                        <td colspan="4" style="border: 1px solid #ddd; padding: 10px; text-align: right; font-weight: bold; background-color: #fff1f0;">SALDO PENDIENTE:</td>
-                                        <td style="border: 1px solid #ddd; padding: 10px; text-align: right; font-weight: bold; background-color: #fff1f0; color: #cf1322; font-size: 18px;">${saldo_pendiente:.2f}</td>
-                                    </tr>''' if tipo_pago == 'Abono' else ''}
-                                </tbody>
-                            </table>
-                            
-                            <p style="color: #555;">**Observaciones:** {observaciones if observaciones else 'N/A'}</p>
-                        </div>
-                        
-                        <div style="background-color: #f8f8f8; padding: 15px; text-align: center; border-top: 1px solid #eee;">
-                            <p style="font-size: 12px; color: #999; margin: 0;">Este es un recibo generado automáticamente. Gracias por tu pronto pago.</p>
-                            <p style="font-size: 12px; color: #999; margin: 5px 0 0 0;">Por favor, no respondas a este correo.</p>
-                        </div>
-
-                    </div>
-                </body>
-                </html>
-                """
-                
-                # Crear el objeto Message
-                msg = Message(
-                    f"{asunto_tipo} #{recibo_id} - {empresa_nombre}",
-                    sender=(empresa_nombre, current_app.config['MAIL_USERNAME']), 
-                    recipients=list(recipient_emails)
-                )
-                
-                # Asignar el contenido HTML
-                msg.html = html_content 
-                
-                # Versión de texto plano de respaldo
-                msg.body = f"{asunto_tipo} #{recibo_id}.\nMonto Pagado: ${monto_pagado_ajustado:.2f}.\nConsulta la versión HTML para los detalles completos."
-
-                # --- EL CAMBIO CLAVE: INICIAR EL HILO ASÍNCRONO ---
-                app_context_object = current_app._get_current_object()
-                
-                Thread(
-                    target=send_async_email, 
-                    args=(app_context_object, msg)
-                ).start()
+                empresa_nombre = marca_empresa(id_empresa)["nombre"]
+
+                # NUEVO: Solo se encola el contexto; el worker renderiza la plantilla correos/recibo.html
+                # (con el nombre y logo de la empresa desde la caché de marca) por lotes, fuera de la petición.
+                # Con el modo resumen de la empresa queda retenido para agruparse con otros recibos del responsable
+                encolar_recibo({
+                    "id_empresa": id_empresa,
+                    "recibo_id": recibo_id,
+                    "fecha": nueva_transaccion.fecha_transaccion.strftime('%d/%m/%Y %H:%M:%S'),
+                    "tipo_pago": tipo_pago,
+                    # Ajuste de títulos según el tipo de pago
+                    "asunto_tipo": "Recibo de Pago Total" if tipo_pago == 'Total' else "Recibo de Abono",
+                    "registrado_por": current_user.nombre_completo,
+                    "items": items_email,
+                    "monto_pagado": monto_pagado_ajustado,
+                    "saldo_pendiente": saldo_pendiente,
+                    "observaciones": observaciones
+                }, list(recipient_emails), remitente=(empresa_nombre, current_app.config['MAIL_USERNAME']),
+                   id_empresa=id_empresa, referencia=recibo_id)
+                db.session.commit()
+                correos_encolados(current_app._get_current_object())
                 
-                print(f"✅ Hilo de correo iniciado para: {recipient_emails}. Respondiendo inmediatamente al cliente.")
+                print(f"✅ Correo de recibo encolado para: {recipient_emails}. Respondiendo inmediatamente al cliente.")
 
             except Exception as e:
-                print(f"⚠️ Error al intentar iniciar hilo de correo de recibo: {str(e)}")
+                db.session.rollback()
+                print(f"⚠️ Error al encolar el correo de recibo: {str(e)}")
         
         # 7. Respuesta Final
         return jsonify({
@@ -5498,7 +5734,6 @@ def anular_recibo(recibo_id):
 
         # --- LOGICA DE NOTIFICACIÓN (ANTES DE ELIMINAR) ---
         recipient_emails = set()
-        nombre_empresa = Empresa.query.get(id_empresa).nombre_empresa
         
         # Obtener los correos de los estudiantes involucrados en este recibo
         for detalle in transaccion.detalles:
@@ -5507,52 +5742,15 @@ def anular_recibo(recibo_id):
 
         if recipient_emails:
             try:
-                # Construir el mensaje de anulación
-                msg = Message(
-                    f"ANULACIÓN de Recibo #{recibo_id} - {nombre_empresa}",
-                    sender=(nombre_empresa, current_app.config['MAIL_USERNAME']),
-                    recipients=list(recipient_emails)
-                )
-                
-                html_content = f"""
-                <html>
-                <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px;">
-                    <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 8px; overflow: hidden; border: 1px solid #ddd;">
-                        <div style="text-align: center; padding: 20px; background-color: #dc3545; color: white;">
-                            <h1 style="margin: 0; font-size: 22px;">Aviso de Anulación de Recibo</h1>
-                        </div>
-                        <div style="padding: 20px; color: #333; line-height: 1.6;">
-                            <p>Estimado(a) responsable,</p>
-                            <p>Le informamos que el recibo con <strong>ID #{recibo_id}</strong>, emitido anteriormente por <strong>{nombre_empresa}</strong>, ha sido <strong>ANULADO</strong> en nuestro sistema.</p>
-                            
-                            <div style="background-color: #fff3cd; border-left: 5px solid #ffc107; padding: 15px; margin: 20px 0;">
-                                <p style="margin: 0;"><strong>Motivos posibles:</strong></p>
-                                <ul style="margin-top: 5px;">
-                                    <li>Error en la digitación de costos o conceptos.</li>
-                                    <li>Actualización de la información del estudiante.</li>
-                                </ul>
-                            </div>
-
-                            <p><strong>¿Qué debe hacer?</strong></p>
-                            <p>Si la anulación se debió a un error de costos, pronto recibirá un nuevo recibo corregido. En caso de dudas, por favor diríjase a la oficina administrativa para aclarar la situación.</p>
-                            
-                            <p style="font-size: 13px; color: #666; margin-top: 30px;">
-                                Fecha de anulación: {datetime.utcnow().strftime('%d/%m/%Y %H:%M:%S')} (UTC)
-                            </p>
-                        </div>
-                        <div style="background-color: #f8f8f8; padding: 15px; text-align: center; font-size: 12px; color: #999;">
-                            Este es un mensaje automático de {nombre_empresa}.
-                        </div>
-                    </div>
-                </body>
-                </html>
-                """
-                msg.html = html_content
-                msg.body = f"El recibo #{recibo_id} ha sido anulado. Por favor diríjase a la oficina para más información."
-
-                # Iniciar envío asíncrono
-                app_context_object = current_app._get_current_object()
-                Thread(target=send_async_email, args=(app_context_object, msg)).start()
+                # NUEVO: Se encola con la plantilla correos/anulacion_recibo.html; se confirma en la misma
+                # transacción que la eliminación del recibo
+                nombre_empresa = marca_empresa(id_empresa)["nombre"]
+                encolar_plantilla('anulacion_recibo', {
+                    "id_empresa": id_empresa,
+                    "recibo_id": recibo_id,
+                    "fecha_anulacion": datetime.utcnow().strftime('%d/%m/%Y %H:%M:%S')
+                }, list(recipient_emails), remitente=(nombre_empresa, current_app.config['MAIL_USERNAME']),
+                   id_empresa=id_empresa, referencia=recibo_id)
                 
             except Exception as email_err:
                 print(f"⚠️ No se pudo enviar el correo de anulación: {str(email_err)}")
@@ -5564,7 +5762,11 @@ def anular_recibo(recibo_id):
         
         # 3. Eliminación de la Transacción Principal
         db.session.delete(transaccion)
+        # NUEVO: Los correos del recibo aún retenidos en la ventana de resumen ya no se envían
+        cancelar_recibos_retenidos(id_empresa, recibo_id)
         db.session.commit()
+        if recipient_emails:
+            correos_encolados(current_app._get_current_object())
 
         return jsonify({
             "message": f"Recibo {recibo_id} anulado y notificación enviada.",
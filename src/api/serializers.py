@@ -0,0 +1,192 @@
+# src/api/serializers.py
+
+# Serializadores compilados por modelo, con soporte de ?fields= y ?expand=.
+# Cada esquema reproduce la forma del serialize() del modelo. Para cada combinación de
+# campos/relaciones pedida se arma una sola vez (y se cachea) una lista de getters con
+# su conversión de tipo ya resuelta, de modo que serializar una fila es solo recorrer
+# esa lista. El mismo esquema indica qué relaciones hay que cargar por adelantado
+# (joinedload / selectinload), así serializar un listado no dispara una consulta por fila.
+
+from datetime import datetime, date, time
+from functools import lru_cache
+from operator import attrgetter
+
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+from api.models import Empresa, Usuario, TipoRespuesta, Formulario, EnvioFormulario, Estudiante
+
+
+class CampoInvalido(ValueError):
+    pass
+
+
+_ESQUEMAS = {}
+
+
+def registrar_esquema(nombre, modelo, campos, relaciones=None, expand_default=()):
+    """
+    Registra un esquema: `campos` son columnas del modelo y `relaciones` mapea nombre de relación -> esquema destino.
+    `expand_default` son las relaciones que incluye la serialización por defecto (la de serialize()).
+    """
+    _ESQUEMAS[nombre] = {
+        "modelo": modelo,
+        "campos": tuple(campos),
+        "relaciones": dict(relaciones or {}),
+        "expand_default": tuple(expand_default)
+    }
+
+
+def _convertidor(modelo, campo):
+    """
+    Resuelve, al compilar, cómo convertir el valor de una columna a JSON.
+    """
+    python_type = modelo.__table__.c[campo].type.python_type
+    if python_type in (datetime, date):
+        return lambda v: v.isoformat() if v is not None else None
+    if python_type is time:
+        return lambda v: v.strftime('%H:%M') if v is not None else None
+    return None
+
+
+def _getter_lista(getter, serializar):
+    def obtener(obj):
+        return [serializar(x) for x in (getter(obj) or [])]
+    return obtener
+
+
+def _getter_objeto(getter, serializar):
+    def obtener(obj):
+        valor = getter(obj)
+        return serializar(valor) if valor is not None else None
+    return obtener
+
+
+@lru_cache(maxsize=256)
+def compilar_serializador(nombre, campos=None, expand=None):
+    """
+    Devuelve una función objeto -> dict para el esquema `nombre`.
+    `campos` y `expand` son tuplas (None = los del serialize() por defecto).
+    """
+    esquema = _ESQUEMAS[nombre]
+    modelo = esquema["modelo"]
+    campos = esquema["campos"] if campos is None else campos
+    expand = esquema["expand_default"] if expand is None else expand
+    uselist = {rel.key: rel.uselist for rel in inspect(modelo).relationships}
+
+    plan = []
+    for campo in campos:
+        getter = attrgetter(campo)
+        convertir = _convertidor(modelo, campo)
+        if convertir:
+            plan.append((campo, lambda o, g=getter, c=convertir: c(g(o))))
+        else:
+            plan.append((campo, getter))
+
+    for relacion in expand:
+        anidado = compilar_serializador(esquema["relaciones"][relacion])
+        if uselist[relacion]:
+            plan.append((relacion, _getter_lista(attrgetter(relacion), anidado)))
+        else:
+            plan.append((relacion, _getter_objeto(attrgetter(relacion), anidado)))
+
+    plan = tuple(plan)
+
+    def serializar(obj):
+        return {clave: getter(obj) for clave, getter in plan}
+
+    return serializar
+
+
+def opciones_carga(nombre, expand=None, padre=None):
+    """
+    Opciones de carga (eager loading) para las relaciones que se van a serializar, incluidas las
+    relaciones por defecto de los esquemas anidados (ej. usuario -> empresa).
+    Muchos-a-uno usa joinedload; colecciones usan selectinload.
+    """
+    esquema = _ESQUEMAS[nombre]
+    modelo = esquema["modelo"]
+    expand = esquema["expand_default"] if expand is None else expand
+    relaciones = inspect(modelo).relationships
+
+    opciones = []
+    for relacion in expand:
+        atributo = getattr(modelo, relacion)
+        if padre is None:
+            carga = selectinload(atributo) if relaciones[relacion].uselist else joinedload(atributo)
+        else:
+            carga = padre.selectinload(atributo) if relaciones[relacion].uselist else padre.joinedload(atributo)
+        anidadas = opciones_carga(esquema["relaciones"][relacion], padre=carga)
+        opciones.extend(anidadas if anidadas else [carga])
+    return opciones
+
+
+def _lista_param(nombre_param):
+    valor = request.args.get(nombre_param)
+    if valor is None:
+        return None
+    return tuple(v.strip() for v in valor.split(',') if v.strip())
+
+
+def serializador_desde_request(nombre):
+    """
+    Lee ?fields= y ?expand= y devuelve (serializar, opciones_de_carga).
+    - Sin parámetros: misma forma que serialize().
+    - ?fields=a,b: solo esas columnas; si se nombra una relación en fields, se expande.
+    - ?expand=r1,r2: relaciones anidadas a incluir (vacío = ninguna).
+    Lanza CampoInvalido si se pide un campo o relación inexistente.
+    """
+    esquema = _ESQUEMAS[nombre]
+    fields = _lista_param('fields')
+    expand = _lista_param('expand')
+
+    campos = None
+    if fields is not None:
+        desconocidos = [f for f in fields if f not in esquema["campos"] and f not in esquema["relaciones"]]
+        if desconocidos:
+            raise CampoInvalido(f"Campos no válidos en 'fields': {', '.join(desconocidos)}")
+        campos = tuple(f for f in fields if f in esquema["campos"])
+        relaciones_en_fields = tuple(f for f in fields if f in esquema["relaciones"])
+        expand = tuple(dict.fromkeys((expand or ()) + relaciones_en_fields))
+
+    if expand is not None:
+        desconocidas = [r for r in expand if r not in esquema["relaciones"]]
+        if desconocidas:
+            raise CampoInvalido(f"Relaciones no válidas en 'expand': {', '.join(desconocidas)}")
+
+    return compilar_serializador(nombre, campos, expand), opciones_carga(nombre, expand)
+
+
+# --- Esquemas (reflejan los serialize() de models.py) ---
+
+registrar_esquema('empresa', Empresa, [
+    'id_empresa', 'nombre_empresa', 'direccion', 'telefono', 'email_contacto',
+    'fecha_creacion', 'creado_por_admin_general_id', 'logo_url', 'activo',
+    'recibos_resumen_minutos'
+])
+
+registrar_esquema('usuario', Usuario, [
+    'id_usuario', 'id_empresa', 'nombre_completo', 'email', 'rol', 'fecha_creacion', 'ultimo_login',
+    'imagen_perfil_url', 'telefono_personal', 'cargo', 'cambio_password_requerido', 'activo',
+    'favoritos', 'firma_digital_url'
+], relaciones={'empresa': 'empresa'}, expand_default=('empresa',))
+
+registrar_esquema('tipo_respuesta', TipoRespuesta, ['id_tipo_respuesta', 'nombre_tipo', 'descripcion'])
+
+registrar_esquema('formulario', Formulario, [
+    'id_formulario', 'id_empresa', 'nombre_formulario', 'descripcion', 'max_submissions_per_period',
+    'submission_period_days', 'fecha_creacion', 'creado_por_usuario_id', 'es_plantilla', 'es_plantilla_global',
+    'compartir_con_empresas_ids', 'notificaciones_activas', 'automatizacion_activa', 'scheduled_automation_time',
+    'last_automated_run_date', 'next_automation_at', 'automation_submissions_count', 'version'
+], relaciones={'tipos_respuesta_disponibles': 'tipo_respuesta', 'empresa': 'empresa'},
+   expand_default=('tipos_respuesta_disponibles',))
+
+registrar_esquema('envio_formulario', EnvioFormulario, [
+    'id_envio', 'id_formulario', 'id_usuario', 'fecha_hora_envio', 'fechas_horas_actividad_reales',
+    'completado_automaticamente', 'espacios_cubiertos_ids', 'subespacios_cubiertos_ids', 'objetos_cubiertos_ids'
+], relaciones={'formulario': 'formulario', 'usuario': 'usuario'})
+
+registrar_esquema('estudiante', Estudiante, [
+    'id_estudiante', 'id_empresa', 'id_grado', 'nombre_completo', 'correo_responsable', 'activo'
+])
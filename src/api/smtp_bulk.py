@@ -0,0 +1,254 @@
+# src/api/smtp_bulk.py
+
+# Envío masivo de correos sobre sesiones SMTP reutilizadas. mail.send() abre una conexión SMTP_SSL,
+# se autentica, envía un mensaje y desconecta; con lotes grandes casi todo el tiempo se va en el
+# handshake TLS y el login. Aquí cada hilo del pool toma una sesión autenticada (mail.connect() de
+# Flask-Mail) que queda abierta entre lotes y envía por ella todos sus mensajes:
+#   - La sesión se recicla tras CORREO_MENSAJES_POR_SESION mensajes o CORREO_SESION_INACTIVA segundos
+#     sin uso (los servidores cierran las conexiones inactivas), y se reabre si el servidor desconecta.
+#   - CORREO_LIMITE_POR_MINUTO limita los destinatarios por minuto de este proceso (token bucket),
+#     para no superar el límite del proveedor (ej. Gmail). 0 = sin límite.
+#   - El resultado de cada mensaje incluye los destinatarios rechazados por el servidor y su código,
+#     aunque el resto del mensaje se haya entregado.
+
+import os
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import LifoQueue, Empty
+from threading import Lock
+
+from flask_mail import sanitize_address
+
+
+CORREO_SESIONES = int(os.getenv('CORREO_SESIONES', os.getenv('CORREO_WORKERS', 4)))  # sesiones SMTP abiertas por proceso
+CORREO_LIMITE_POR_MINUTO = int(os.getenv('CORREO_LIMITE_POR_MINUTO', 0))
+CORREO_MENSAJES_POR_SESION = int(os.getenv('CORREO_MENSAJES_POR_SESION', 100))
+CORREO_SESION_INACTIVA = int(os.getenv('CORREO_SESION_INACTIVA', 60))
+
+# Errores de conexión: la sesión ya no sirve, se reabre y se reintenta el mensaje una vez
+_ERRORES_CONEXION = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class LimitadorTasa:
+    """
+    Token bucket de `por_minuto` fichas compartido por todos los hilos del proceso.
+    """
+    def __init__(self, por_minuto):
+        self.por_minuto = por_minuto
+        self._fichas = float(por_minuto)
+        self._ultimo = time.monotonic()
+        self._lock = Lock()
+
+    def esperar(self, cantidad=1):
+        """
+        Bloquea hasta poder consumir `cantidad` fichas. Devuelve los segundos esperados.
+        """
+        if self.por_minuto <= 0:
+            return 0.0
+        cantidad = min(cantidad, self.por_minuto)  # un mensaje con más destinatarios que el límite igual debe salir
+        esperado = 0.0
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.por_minuto, self._fichas + (ahora - self._ultimo) * self.por_minuto / 60.0)
+                self._ultimo = ahora
+                if self._fichas >= cantidad:
+                    self._fichas -= cantidad
+                    return esperado
+                espera = (cantidad - self._fichas) * 60.0 / self.por_minuto
+            time.sleep(espera)
+            esperado += espera
+
+
+class SesionSMTP:
+    """
+    Una conexión autenticada de Flask-Mail (mail.connect()) que se mantiene abierta entre envíos.
+    """
+    def __init__(self, mail):
+        self.mail = mail
+        self._conexion = None
+        self._enviados = 0
+        self._ultimo_uso = 0.0
+
+    def _abrir(self):
+        conexion = self.mail.connect()
+        conexion.__enter__()  # SMTP_SSL / STARTTLS + login, según la configuración de Flask-Mail
+        self._conexion = conexion
+        self._enviados = 0
+
+    def cerrar(self):
+        conexion, self._conexion = self._conexion, None
+        if conexion is None or conexion.host is None:
+            return
+        try:
+            conexion.host.quit()
+        except Exception:
+            try:
+                conexion.host.close()
+            except Exception:
+                pass
+
+    @property
+    def conectada(self):
+        return self._conexion is not None
+
+    def _vigente(self):
+        if self._conexion is None:
+            return False
+        if self._enviados >= CORREO_MENSAJES_POR_SESION:
+            return False
+        return time.monotonic() - self._ultimo_uso < CORREO_SESION_INACTIVA
+
+    def _entregar(self, msg):
+        conexion = self._conexion
+        if conexion.host is None:
+            # MAIL_SUPPRESS_SEND / TESTING: Flask-Mail solo emite la señal email_dispatched
+            conexion.send(msg)
+            return {}
+        if not msg.send_to:
+            raise ValueError("El correo no tiene destinatarios.")
+        # Se llama a sendmail directamente porque Connection.send descarta los rechazos parciales
+        return conexion.host.sendmail(
+            sanitize_address(msg.sender),
+            [sanitize_address(d) for d in msg.send_to],
+            msg.as_bytes(),
+            msg.mail_options,
+            msg.rcpt_options
+        ) or {}
+
+    def enviar(self, msg):
+        """
+        Envía un mensaje. Devuelve {email: "código mensaje"} con los destinatarios rechazados.
+        Lanza SMTPRecipientsRefused si el servidor rechazó a todos.
+        """
+        if not self._vigente():
+            self.cerrar()
+            self._abrir()
+        try:
+            rechazados = self._entregar(msg)
+        except _ERRORES_CONEXION:
+            # El servidor cerró la sesión (inactividad, límite de mensajes por conexión): una vez más
+            self.cerrar()
+            self._abrir()
+            rechazados = self._entregar(msg)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            self._reiniciar_transaccion()
+            raise
+        self._enviados += 1
+        self._ultimo_uso = time.monotonic()
+        return {destinatario: _texto_respuesta(codigo, texto) for destinatario, (codigo, texto) in rechazados.items()}
+
+    def _reiniciar_transaccion(self):
+        # sendmail ya envía RSET en sus errores; si tampoco responde, la sesión se descarta
+        self._ultimo_uso = time.monotonic()
+        try:
+            self._conexion.host.noop()
+        except Exception:
+            self.cerrar()
+
+
+def _texto_respuesta(codigo, texto):
+    if isinstance(texto, bytes):
+        texto = texto.decode('utf-8', 'replace')
+    return f"{codigo} {texto}".strip()[:300]
+
+
+def _resultado(error=None, rechazados=None, permanente=False):
+    return {"error": error, "rechazados": rechazados or {}, "permanente": permanente}
+
+
+def _resultado_de_excepcion(e):
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        rechazados = {d: _texto_respuesta(c, t) for d, (c, t) in e.recipients.items()}
+        # Un 5xx para todos los destinatarios no se arregla reintentando (buzón inexistente, dominio inválido)
+        permanente = all(c >= 500 for c, _ in e.recipients.values())
+        return _resultado("Todos los destinatarios fueron rechazados.", rechazados, permanente)
+    return _resultado(f"{type(e).__name__}: {str(e)}"[:1000])
+
+
+class PoolSMTP:
+    """
+    Pool de `sesiones` conexiones SMTP autenticadas y un hilo por sesión para enviar lotes.
+    """
+    def __init__(self, app, mail=None, sesiones=CORREO_SESIONES, limite_por_minuto=CORREO_LIMITE_POR_MINUTO):
+        self.app = app
+        self.mail = mail or app.extensions['mail']
+        self.sesiones = max(1, sesiones)
+        self.limitador = LimitadorTasa(limite_por_minuto)
+        self._libres = LifoQueue()  # LIFO: se reutiliza la sesión usada más recientemente, la más probable de seguir viva
+        self._hilos = ThreadPoolExecutor(max_workers=self.sesiones, thread_name_prefix='smtp')
+
+    def _tomar(self):
+        try:
+            return self._libres.get_nowait()
+        except Empty:
+            return SesionSMTP(self.mail)
+
+    def _enviar_parte(self, mensajes):
+        resultados = []
+        sesion = self._tomar()
+        with self.app.app_context():
+            try:
+                for msg in mensajes:
+                    self.limitador.esperar(len(msg.send_to))
+                    try:
+                        resultados.append(_resultado(rechazados=sesion.enviar(msg)))
+                    except Exception as e:
+                        resultados.append(_resultado_de_excepcion(e))
+                        if not sesion.conectada:
+                            # Sin conexión el resto de la parte fallaría igual. El error de este mensaje
+                            # (ej. destinatarios rechazados) no es el de los demás: se reintentan.
+                            pendiente = _resultado("Conexión SMTP no disponible; se reintentará el envío.")
+                            resultados.extend([pendiente] * (len(mensajes) - len(resultados)))
+                            break
+            finally:
+                self._libres.put(sesion)
+        return resultados
+
+    def enviar_lote(self, mensajes):
+        """
+        Envía los flask_mail.Message repartidos entre las sesiones. Devuelve un resultado por mensaje,
+        en el mismo orden: {"error": str|None, "rechazados": {email: respuesta}, "permanente": bool}.
+        """
+        if not mensajes:
+            return []
+        partes = min(self.sesiones, len(mensajes))
+        indices = [list(range(i, len(mensajes), partes)) for i in range(partes)]
+        futuros = [self._hilos.submit(self._enviar_parte, [mensajes[i] for i in parte]) for parte in indices]
+
+        resultados = [None] * len(mensajes)
+        for parte, futuro in zip(indices, futuros):
+            for i, resultado in zip(parte, futuro.result()):
+                resultados[i] = resultado
+        return resultados
+
+    def cerrar(self):
+        self._hilos.shutdown(wait=True)
+        while True:
+            try:
+                self._libres.get_nowait().cerrar()
+            except Empty:
+                break
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def obtener_pool_smtp(app):
+    """
+    Pool compartido del proceso para el servidor SMTP configurado en la app.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PoolSMTP(app)
+        return _pool
+
+
+def enviar_masivo(app, mensajes):
+    """
+    Atajo para enviar una lista de mensajes por las sesiones compartidas.
+    """
+    return obtener_pool_smtp(app).enviar_lote(mensajes)
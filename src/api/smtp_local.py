@@ -0,0 +1,98 @@
+# src/api/smtp_local.py
+
+# Servidor SMTP local mínimo (sin TLS ni autenticación) para benchmarks y desarrollo sin red.
+# smtpd ya no existe desde Python 3.12 y aiosmtpd no está entre las dependencias, así que se
+# implementa lo justo del protocolo sobre socketserver: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT
+# (las respuestas SMTP deben ser ASCII).
+#   - `latencia_conexion` simula el costo de abrir una sesión (handshake TLS + login del proveedor real).
+#   - Los destinatarios cuya parte local empieza por 'rechazar' reciben un 550, para probar los
+#     rechazos por destinatario.
+# Uso: `flask smtp-local` y MAIL_SERVER=127.0.0.1 MAIL_PORT=<puerto> MAIL_USE_SSL=0.
+
+import socketserver
+import time
+from threading import Lock, Thread
+
+
+class _ManejadorSMTP(socketserver.StreamRequestHandler):
+    def _responder(self, linea):
+        self.wfile.write(linea.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        servidor = self.server
+        servidor.contar('conexiones')
+        if servidor.latencia_conexion:
+            time.sleep(servidor.latencia_conexion)
+        self._responder("220 smtp-local listo")
+        destinatarios = []
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            comando = linea.decode('utf-8', 'replace').strip()
+            verbo = comando[:4].upper()
+            if verbo == 'EHLO':
+                self.wfile.write(b"250-smtp-local\r\n250-8BITMIME\r\n250 SMTPUTF8\r\n")
+            elif verbo == 'HELO':
+                self._responder("250 smtp-local")
+            elif verbo == 'MAIL':
+                destinatarios = []
+                self._responder("250 OK")
+            elif verbo == 'RCPT':
+                direccion = comando.split(':', 1)[-1].strip().strip('<>').split('>')[0]
+                if direccion.lower().startswith('rechazar'):
+                    servidor.contar('rechazados')
+                    self._responder("550 5.1.1 Buzon inexistente")
+                else:
+                    destinatarios.append(direccion)
+                    self._responder("250 OK")
+            elif verbo == 'DATA':
+                self._responder("354 Termina con <CRLF>.<CRLF>")
+                while True:
+                    dato = self.rfile.readline()
+                    if not dato or dato in (b".\r\n", b".\n"):
+                        break
+                servidor.contar('mensajes')
+                servidor.contar('entregados', len(destinatarios))
+                self._responder("250 OK")
+            elif verbo == 'RSET':
+                destinatarios = []
+                self._responder("250 OK")
+            elif verbo == 'NOOP':
+                self._responder("250 OK")
+            elif verbo == 'QUIT':
+                self._responder("221 Adios")
+                return
+            else:
+                self._responder("502 Comando no implementado")
+
+
+class ServidorSMTPLocal(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', puerto=0, latencia_conexion=0.0):
+        super().__init__((host, puerto), _ManejadorSMTP)
+        self.latencia_conexion = latencia_conexion
+        self._lock = Lock()
+        self.contadores = {'conexiones': 0, 'mensajes': 0, 'entregados': 0, 'rechazados': 0}
+
+    @property
+    def puerto(self):
+        return self.server_address[1]
+
+    def contar(self, nombre, cantidad=1):
+        with self._lock:
+            self.contadores[nombre] += cantidad
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            for nombre in self.contadores:
+                self.contadores[nombre] = 0
+
+    def iniciar(self):
+        """
+        Atiende en un hilo en segundo plano. Detener con shutdown() + server_close().
+        """
+        Thread(target=self.serve_forever, name='smtp-local', daemon=True).start()
+        return self
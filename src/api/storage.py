@@ -0,0 +1,193 @@
+# src/api/storage.py
+
+# Almacenamiento de archivos (imágenes, firmas, dibujos, PDFs) detrás de una interfaz común:
+#   guardar(archivo, tipo, content_type)   -> URL pública del archivo
+#   guardar_ruta(ruta, tipo, content_type) -> igual, para archivos grandes ya escritos en disco
+#   eliminar(url, tipo)
+# ALMACENAMIENTO elige el backend: 'cloudinary' (por defecto) o 'local'. El backend local guarda
+# cada archivo en una ruta derivada de su SHA-256 (aa/bb/<sha256>.<ext>) dentro de
+# ALMACENAMIENTO_LOCAL_DIR y lo sirve la ruta /api/archivos/<ruta> con send_file: soporta Range,
+# ETag y X-Sendfile, y como el contenido de una ruta nunca cambia se marca como immutable.
+# Permite correr on-premise y en pruebas sin red, y evita el handshake HTTPS por cada subida.
+# Las llamadas a Cloudinary pasan por el cliente compartido (pool, timeouts, circuit breaker).
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+from io import BytesIO
+from threading import Lock
+
+from flask import send_from_directory, abort
+
+from api.cloudinary_client import obtener_cliente, cloudinary_disponible
+
+
+ALMACENAMIENTO = os.getenv('ALMACENAMIENTO', 'cloudinary')  # 'cloudinary' o 'local'
+ALMACENAMIENTO_LOCAL_DIR = os.getenv('ALMACENAMIENTO_LOCAL_DIR') or os.path.join(tempfile.gettempdir(), 'auditease-archivos')
+# URL pública del backend (ej. https://api.midominio.com). Obligatoria con ALMACENAMIENTO=local: la mayoría de
+# los archivos se guardan fuera de una petición (hilos de subida, cola diferida, subidas reanudables)
+ALMACENAMIENTO_URL_BASE = (os.getenv('ALMACENAMIENTO_URL_BASE') or '').rstrip('/')
+RUTA_ARCHIVOS = '/api/archivos/'
+ARCHIVOS_MAX_AGE = 365 * 24 * 3600
+
+_BLOQUE = 64 * 1024
+_CLOUDINARY_PARTE = 6 * 1024 * 1024  # upload_large envía los archivos grandes a Cloudinary en partes
+
+
+def get_public_id_from_url(url):
+    """Extrae el public_id de una URL de Cloudinary."""
+    # La URL completa es algo como: https://res.cloudinary.com/.../raw/upload/v12345678/mi_archivo.pdf
+    # El public_id es 'mi_archivo'
+    if '/upload/' in url:
+        return url.split('/')[-1].split('.')[0]
+    return None
+
+
+class AlmacenamientoCloudinary:
+    nombre = 'cloudinary'
+
+    def disponible(self):
+        return cloudinary_disponible()
+
+    def guardar(self, archivo, tipo='image', content_type=None):
+        # Cloudinary acepta bytes, archivos, base64 / data URIs y URLs remotas
+        if isinstance(archivo, (bytes, bytearray)):
+            archivo = BytesIO(archivo)
+        return obtener_cliente().upload(archivo, resource_type=tipo)['secure_url']
+
+    def guardar_ruta(self, ruta, tipo='image', content_type=None):
+        return obtener_cliente().upload_large(ruta, resource_type=tipo, chunk_size=_CLOUDINARY_PARTE)['secure_url']
+
+    def eliminar(self, url, tipo='image'):
+        public_id = get_public_id_from_url(url)
+        if public_id:
+            obtener_cliente().destroy(public_id, resource_type=tipo)
+
+
+class AlmacenamientoLocal:
+    nombre = 'local'
+
+    def __init__(self, raiz):
+        self.raiz = os.path.abspath(raiz)
+
+    def disponible(self):
+        return True
+
+    def _extension(self, content_type):
+        if not content_type:
+            return ''
+        return mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+
+    def _url(self, relativa):
+        return f"{ALMACENAMIENTO_URL_BASE}{RUTA_ARCHIVOS}{relativa}"
+
+    def _guardar_flujo(self, flujo, content_type):
+        """
+        Copia el flujo a un temporal calculando el SHA-256 y lo mueve a su ruta por contenido.
+        Si el archivo ya existe se descarta la copia: mismo contenido, misma URL.
+        """
+        temporales = os.path.join(self.raiz, '.tmp')
+        os.makedirs(temporales, exist_ok=True)
+        resumen = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=temporales, delete=False) as temporal:
+            for bloque in iter(lambda: flujo.read(_BLOQUE), b''):
+                resumen.update(bloque)
+                temporal.write(bloque)
+        sha = resumen.hexdigest()
+        relativa = f"{sha[:2]}/{sha[2:4]}/{sha}{self._extension(content_type)}"
+        destino = os.path.join(self.raiz, relativa)
+        if os.path.exists(destino):
+            os.remove(temporal.name)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(temporal.name, destino)
+        return self._url(relativa)
+
+    def guardar(self, archivo, tipo='image', content_type=None):
+        if isinstance(archivo, (bytes, bytearray)):
+            return self._guardar_flujo(BytesIO(archivo), content_type)
+        if not hasattr(archivo, 'read'):
+            raise ValueError("El almacenamiento local solo acepta bytes o archivos.")
+        content_type = content_type or getattr(archivo, 'mimetype', None)
+        if hasattr(archivo, 'seek'):
+            archivo.seek(0)
+        return self._guardar_flujo(archivo, content_type)
+
+    def guardar_ruta(self, ruta, tipo='image', content_type=None):
+        with open(ruta, 'rb') as archivo:
+            return self._guardar_flujo(archivo, content_type)
+
+    def ruta_relativa(self, url):
+        """
+        Ruta dentro de la raíz para una URL de este backend, o None si la URL no es local.
+        """
+        if not url or RUTA_ARCHIVOS not in url:
+            return None
+        return url.split(RUTA_ARCHIVOS, 1)[1].split('?', 1)[0]
+
+    def eliminar(self, url, tipo='image'):
+        relativa = self.ruta_relativa(url)
+        if not relativa:
+            return
+        ruta = os.path.abspath(os.path.join(self.raiz, relativa))
+        if ruta.startswith(self.raiz + os.sep) and os.path.isfile(ruta):
+            os.remove(ruta)
+
+    def servir(self, relativa):
+        """
+        Respuesta para GET /api/archivos/<relativa>: send_file con Range/ETag y caché inmutable.
+        """
+        if relativa.startswith('.tmp/'):
+            abort(404)
+        respuesta = send_from_directory(self.raiz, relativa, conditional=True, max_age=ARCHIVOS_MAX_AGE)
+        respuesta.headers['Cache-Control'] = f'public, max-age={ARCHIVOS_MAX_AGE}, immutable'
+        return respuesta
+
+
+_backends = {}
+_backends_lock = Lock()
+
+
+def _backend(nombre):
+    with _backends_lock:
+        if nombre not in _backends:
+            if nombre == 'local':
+                _backends[nombre] = AlmacenamientoLocal(ALMACENAMIENTO_LOCAL_DIR)
+            elif nombre == 'cloudinary':
+                _backends[nombre] = AlmacenamientoCloudinary()
+            else:
+                raise ValueError(f"Backend de almacenamiento desconocido: {nombre}")
+        return _backends[nombre]
+
+
+def verificar_configuracion():
+    """
+    Falla al arrancar si el backend configurado no puede generar URLs absolutas.
+    """
+    if ALMACENAMIENTO == 'local' and not ALMACENAMIENTO_URL_BASE:
+        raise RuntimeError("ALMACENAMIENTO=local requiere ALMACENAMIENTO_URL_BASE (URL pública del backend, "
+                           "ej. https://api.midominio.com) para generar las URLs de los archivos.")
+
+
+def obtener_almacenamiento():
+    """
+    Backend configurado para los archivos nuevos.
+    """
+    return _backend(ALMACENAMIENTO)
+
+
+def almacenamiento_local():
+    return _backend('local')
+
+
+def eliminar_archivo(url, tipo='image'):
+    """
+    Elimina un archivo según la URL con que se guardó (un cambio de backend no deja huérfanos los anteriores).
+    """
+    if not url:
+        return
+    if almacenamiento_local().ruta_relativa(url):
+        almacenamiento_local().eliminar(url, tipo)
+    else:
+        _backend('cloudinary').eliminar(url, tipo)
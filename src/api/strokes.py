@@ -0,0 +1,176 @@
+# src/api/strokes.py
+
+# Formato vectorial compacto para respuestas de tipo firma/dibujo.
+# En lugar de un PNG en base64 (cientos de KB) el cliente puede enviar los trazos:
+#
+#   {"v": 1, "w": 600, "h": 300, "s": [[x0, y0, dx1, dy1, dx2, dy2, ...], ...]}
+#
+# Cada trazo empieza con un punto absoluto en enteros y sigue con desplazamientos
+# (deltas) respecto al punto anterior, que casi siempre son números de 1-2 cifras.
+# Se guarda tal cual en Respuesta.valor_trazos (sin subida externa) y se renderiza bajo
+# demanda a SVG (los deltas se traducen directamente a comandos relativos "l" del path)
+# o a PNG si Pillow está instalado. Los renders se cachean en memoria.
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # Pillow es opcional: sin él solo se ofrece SVG
+    Image = None
+    ImageDraw = None
+
+
+TRAZOS_VERSION = 1
+TRAZOS_MAX_DIMENSION = 4000
+TRAZOS_MAX_TRAZOS = 1000
+TRAZOS_MAX_PUNTOS = 20000
+TRAZOS_CACHE_MAX = int(os.getenv('TRAZOS_CACHE_MAX', 512))
+TRAZOS_ANCHO_LINEA = 2
+
+FORMATOS_DISPONIBLES = ('svg', 'png') if Image is not None else ('svg',)
+CONTENT_TYPES = {'svg': 'image/svg+xml', 'png': 'image/png'}
+
+
+class TrazosInvalidos(ValueError):
+    pass
+
+
+def _entero(valor, nombre):
+    if isinstance(valor, bool) or not isinstance(valor, int):
+        raise TrazosInvalidos(f"'{nombre}' debe ser un número entero.")
+    return valor
+
+
+def validar_trazos(dibujo):
+    """
+    Valida un dibujo en formato de trazos y devuelve una copia normalizada.
+    Lanza TrazosInvalidos si el formato no es válido o excede los límites.
+    """
+    if not isinstance(dibujo, dict):
+        raise TrazosInvalidos("Los trazos deben ser un objeto con 'v', 'w', 'h' y 's'.")
+    if dibujo.get('v', TRAZOS_VERSION) != TRAZOS_VERSION:
+        raise TrazosInvalidos(f"Versión de trazos no soportada: {dibujo.get('v')}.")
+
+    ancho = _entero(dibujo.get('w'), 'w')
+    alto = _entero(dibujo.get('h'), 'h')
+    if not (0 < ancho <= TRAZOS_MAX_DIMENSION and 0 < alto <= TRAZOS_MAX_DIMENSION):
+        raise TrazosInvalidos(f"Las dimensiones deben estar entre 1 y {TRAZOS_MAX_DIMENSION}.")
+
+    trazos = dibujo.get('s')
+    if not isinstance(trazos, list) or len(trazos) > TRAZOS_MAX_TRAZOS:
+        raise TrazosInvalidos(f"'s' debe ser una lista de hasta {TRAZOS_MAX_TRAZOS} trazos.")
+
+    total_puntos = 0
+    for trazo in trazos:
+        if not isinstance(trazo, list) or len(trazo) < 2 or len(trazo) % 2 != 0:
+            raise TrazosInvalidos("Cada trazo debe ser una lista [x0, y0, dx1, dy1, ...] con un número par de enteros.")
+        for valor in trazo:
+            _entero(valor, 's')
+        total_puntos += len(trazo) // 2
+    if total_puntos > TRAZOS_MAX_PUNTOS:
+        raise TrazosInvalidos(f"El dibujo excede el máximo de {TRAZOS_MAX_PUNTOS} puntos.")
+
+    return {"v": TRAZOS_VERSION, "w": ancho, "h": alto, "s": [list(t) for t in trazos]}
+
+
+def normalizar_lista_trazos(valor):
+    """
+    Acepta un dibujo o una lista de dibujos (respuestas 'dibujo' con varias firmas) y devuelve la lista validada.
+    """
+    if valor is None:
+        return None
+    dibujos = valor if isinstance(valor, list) else [valor]
+    return [validar_trazos(d) for d in dibujos] or None
+
+
+def huella_trazos(dibujo):
+    """
+    Hash estable del dibujo; sirve de ETag y de llave de caché.
+    """
+    crudo = json.dumps(dibujo, separators=(',', ':'), sort_keys=True)
+    return hashlib.sha1(crudo.encode('utf-8')).hexdigest()
+
+
+def _dimensiones(dibujo, ancho_salida):
+    if ancho_salida and 0 < ancho_salida < dibujo["w"]:
+        escala = ancho_salida / dibujo["w"]
+        return ancho_salida, max(1, round(dibujo["h"] * escala))
+    return dibujo["w"], dibujo["h"]
+
+
+def trazos_a_svg(dibujo, ancho_salida=None):
+    """
+    SVG con un único path: "M x0 y0 l dx1 dy1 dx2 dy2 ..." por trazo. El viewBox conserva las
+    coordenadas originales, así que escalar solo cambia width/height.
+    """
+    ancho, alto = _dimensiones(dibujo, ancho_salida)
+    partes = []
+    for trazo in dibujo["s"]:
+        deltas = trazo[2:] or [0, 0]  # Un punto suelto se dibuja como un punto (extremo redondeado)
+        partes.append(f"M{trazo[0]} {trazo[1]}l" + " ".join(str(v) for v in deltas))
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{ancho}" height="{alto}" '
+        f'viewBox="0 0 {dibujo["w"]} {dibujo["h"]}">'
+        f'<path d="{"".join(partes)}" fill="none" stroke="#000" stroke-width="{TRAZOS_ANCHO_LINEA}" '
+        f'stroke-linecap="round" stroke-linejoin="round"/></svg>'
+    ).encode('utf-8')
+
+
+def trazos_a_png(dibujo, ancho_salida=None):
+    """
+    PNG con fondo transparente (requiere Pillow).
+    """
+    if Image is None:
+        raise TrazosInvalidos("El render PNG no está disponible en este servidor.")
+    ancho, alto = _dimensiones(dibujo, ancho_salida)
+    escala = ancho / dibujo["w"]
+    grosor = max(1, round(TRAZOS_ANCHO_LINEA * escala))
+    imagen = Image.new('RGBA', (ancho, alto), (255, 255, 255, 0))
+    lienzo = ImageDraw.Draw(imagen)
+    for trazo in dibujo["s"]:
+        x, y = trazo[0], trazo[1]
+        puntos = [(x * escala, y * escala)]
+        for i in range(2, len(trazo), 2):
+            x += trazo[i]
+            y += trazo[i + 1]
+            puntos.append((x * escala, y * escala))
+        if len(puntos) == 1:
+            px, py = puntos[0]
+            lienzo.ellipse((px - grosor / 2, py - grosor / 2, px + grosor / 2, py + grosor / 2), fill=(0, 0, 0, 255))
+        else:
+            lienzo.line(puntos, fill=(0, 0, 0, 255), width=grosor, joint='curve')
+    salida = BytesIO()
+    imagen.save(salida, format='PNG', optimize=True)
+    return salida.getvalue()
+
+
+# --- Caché de renders (LRU en memoria) ---
+
+_renders = OrderedDict()  # (huella, formato, ancho) -> bytes
+_renders_lock = Lock()
+
+
+def renderizar(dibujo, formato='svg', ancho_salida=None):
+    """
+    Devuelve (bytes, huella) del render del dibujo, usando la caché si ya se generó antes.
+    """
+    huella = huella_trazos(dibujo)
+    clave = (huella, formato, ancho_salida)
+    with _renders_lock:
+        if clave in _renders:
+            _renders.move_to_end(clave)
+            return _renders[clave], huella
+
+    contenido = trazos_a_png(dibujo, ancho_salida) if formato == 'png' else trazos_a_svg(dibujo, ancho_salida)
+
+    with _renders_lock:
+        _renders[clave] = contenido
+        _renders.move_to_end(clave)
+        while len(_renders) > TRAZOS_CACHE_MAX:
+            _renders.popitem(last=False)
+    return contenido, huella
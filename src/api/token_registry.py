@@ -0,0 +1,127 @@
+# src/api/token_registry.py
+
+# Revocación de tokens y versiones de estado de empresa.
+# Los access tokens llevan en sus claims el rol, la empresa y la versión de estado de la
+# empresa al momento del login. Cada petición los contrasta con el principal del usuario
+# (auth_cache, caché con TTL sobre la base de datos), así que el estado es el mismo en todos
+# los workers y sobrevive a los reinicios; un cambio hecho en otro proceso tarda a lo sumo
+# PRINCIPAL_CACHE_TTL en aplicarse:
+#   - /logout revoca el token concreto (jti) en la tabla tokens_revocados hasta que expire.
+#   - Desactivar, eliminar o cambiar el rol de un usuario guarda en usuarios.tokens_revocados_desde
+#     el segundo desde el cual sus tokens anteriores dejan de valer.
+#   - Desactivar/reactivar una empresa incrementa empresas.version_estado; los tokens emitidos con
+#     una versión anterior quedan inválidos.
+#   - Un usuario o empresa inactivos, o un rol/empresa distintos a los del token, también se rechazan.
+
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+from api.models import db, Usuario, Empresa, TokenRevocado
+from api.auth_cache import obtener_principal, invalidar_principal_usuario, invalidar_principal_empresa, PRINCIPAL_CACHE_TTL
+
+
+JWT_MAX_LIFETIME = 24 * 60 * 60  # segundos, igual que JWT_ACCESS_TOKEN_EXPIRES
+TOKENS_REVOCADOS_TTL = int(os.getenv('TOKENS_REVOCADOS_TTL', PRINCIPAL_CACHE_TTL))  # segundos entre relecturas
+
+_jti_revocados = set()
+_jti_vigencia = 0.0  # monotonic hasta el cual _jti_revocados se considera al día
+_registry_lock = Lock()
+
+
+def _jtis_revocados():
+    """
+    jti revocados aún vigentes, releídos de la base de datos cada TOKENS_REVOCADOS_TTL segundos.
+    """
+    global _jti_revocados, _jti_vigencia
+    ahora = time.monotonic()
+    with _registry_lock:
+        if _jti_vigencia > ahora:
+            return _jti_revocados
+    jtis = {jti for (jti,) in db.session.query(TokenRevocado.jti).filter(TokenRevocado.expira > datetime.utcnow()).all()}
+    with _registry_lock:
+        _jti_revocados = jtis
+        _jti_vigencia = ahora + TOKENS_REVOCADOS_TTL
+    return jtis
+
+
+def claims_para_usuario(usuario):
+    """
+    Claims adicionales del access token: rol, empresa y versión de estado de la empresa.
+    """
+    return {
+        "rol": usuario.rol,
+        "id_empresa": usuario.id_empresa,
+        "ev": usuario.empresa.version_estado if usuario.empresa else 0
+    }
+
+
+def revocar_token(jti, exp):
+    """
+    Revoca un token concreto (ej. en /logout) hasta su fecha de expiración. Hace commit.
+    """
+    ahora = datetime.utcnow()
+    expira = datetime.utcfromtimestamp(exp) if exp else ahora + timedelta(seconds=JWT_MAX_LIFETIME)
+    # Las filas de tokens ya expirados no afectan a ningún token vigente
+    TokenRevocado.query.filter(TokenRevocado.expira <= ahora).delete(synchronize_session=False)
+    db.session.merge(TokenRevocado(jti=jti, expira=expira))
+    db.session.commit()
+    with _registry_lock:
+        _jti_revocados.add(jti)
+
+
+def revocar_tokens_usuario(*user_ids):
+    """
+    Invalida todos los tokens emitidos hasta ahora para los usuarios indicados. Hace commit.
+    """
+    ids = [int(user_id) for user_id in user_ids]
+    Usuario.query.filter(Usuario.id_usuario.in_(ids)).update(
+        {Usuario.tokens_revocados_desde: int(time.time())}, synchronize_session=False
+    )
+    db.session.commit()
+    invalidar_principal_usuario(*ids)
+
+
+def actualizar_version_empresa(id_empresa):
+    """
+    Incrementa la versión de estado de una empresa, invalidando los tokens emitidos con la anterior. Hace commit.
+    """
+    Empresa.query.filter(Empresa.id_empresa == int(id_empresa)).update(
+        {Empresa.version_estado: Empresa.version_estado + 1}, synchronize_session=False
+    )
+    db.session.commit()
+    invalidar_principal_empresa(id_empresa)
+
+
+def token_revocado(jwt_payload):
+    """
+    Indica si un token debe rechazarse, según el principal en caché y la lista de jti revocados.
+    """
+    if jwt_payload.get('jti') in _jtis_revocados():
+        return True
+
+    try:
+        user_id = int(jwt_payload.get('sub'))
+    except (TypeError, ValueError):
+        return True
+
+    principal = obtener_principal(user_id)
+    if principal is None or not principal.usuario_activo:
+        return True
+    # El owner no depende del estado de su empresa (mismo criterio que login/verificar-token)
+    if principal.rol != 'owner' and not principal.empresa_activo:
+        return True
+
+    # iat y tokens_revocados_desde están en segundos enteros: un token emitido en el mismo segundo
+    # que la revocación (ej. el nuevo login tras un cambio de contraseña) sigue siendo válido
+    if principal.revocado_desde is not None and int(jwt_payload.get('iat', 0)) < principal.revocado_desde:
+        return True
+
+    if 'rol' in jwt_payload:
+        if jwt_payload['rol'] != principal.rol or jwt_payload.get('id_empresa') != principal.id_empresa:
+            return True
+        if principal.rol != 'owner' and jwt_payload.get('ev', 0) < principal.version_empresa:
+            return True
+
+    return False
@@ -0,0 +1,60 @@
+# src/api/worker_leader.py
+
+# Elección de líder entre procesos con una tabla de concesiones (bloqueos_worker) en lugar de un
+# advisory lock de Postgres: funciona igual en SQLite (desarrollo) y detrás de un pooler en modo
+# transacción, donde un advisory lock de sesión se perdería al devolver la conexión.
+# El líder renueva la concesión en cada ciclo; si el proceso muere, otro la toma cuando vence.
+
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+
+from api.models import db, BloqueoWorker
+
+
+def identidad_proceso():
+    """
+    "<host>:<pid>" del proceso actual, para identificar al titular de una concesión.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def adquirir_liderazgo(nombre, titular, duracion_segundos):
+    """
+    Toma o renueva la concesión `nombre` por `duracion_segundos`. Devuelve True si `titular` es el líder.
+    Hace commit.
+    """
+    ahora = datetime.utcnow()
+    expira = ahora + timedelta(seconds=duracion_segundos)
+    resultado = db.session.execute(
+        update(BloqueoWorker)
+        .where(BloqueoWorker.nombre == nombre,
+               or_(BloqueoWorker.titular == titular, BloqueoWorker.expira < ahora))
+        .values(titular=titular, expira=expira, fecha_adquisicion=ahora)
+    )
+    if resultado.rowcount:
+        db.session.commit()
+        return True
+    try:
+        # Primera vez: la fila aún no existe. Si otro proceso la crea a la vez, su llave primaria gana.
+        db.session.add(BloqueoWorker(nombre=nombre, titular=titular, expira=expira, fecha_adquisicion=ahora))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def liberar_liderazgo(nombre, titular):
+    """
+    Suelta la concesión si `titular` la tiene, para que otro proceso la tome sin esperar a que venza.
+    """
+    db.session.execute(
+        update(BloqueoWorker)
+        .where(BloqueoWorker.nombre == nombre, BloqueoWorker.titular == titular)
+        .values(expira=datetime.utcnow())
+    )
+    db.session.commit()
@@ -10,6 +10,12 @@ from api.models import db
 from api.routes import api
 from api.admin import setup_admin
 from api.commands import setup_commands
+from api.token_registry import token_revocado
+from api.media_queue import MEDIA_UPLOAD_MODO, asegurar_worker_media
+from api.storage import verificar_configuracion as verificar_almacenamiento
+from api.mail_outbox import CORREO_WORKER_EN_WEB, asegurar_worker_correo
+from api.email_templates import precompilar as precompilar_plantillas_correo
+from api.notification_dispatcher import NOTIFICACION_WORKER_EN_WEB, asegurar_worker_notificaciones
 
 # *** IMPORTACIONES NECESARIAS PARA JWT ***
 from flask_jwt_extended import JWTManager
@@ -28,9 +34,6 @@ from flask_cors import CORS  # <--- AÑADE ESTA LÍNEA
 from flask_mail import Mail
 from itsdangerous import URLSafeTimedSerializer
 
-# *** IMPORTACIÓN NECESARIA PARA FLASK-APSCHEDULER ***
-from flask_apscheduler import APScheduler # <- IMPORTACIÓN CLAVE
-
 # Cargar variables de entorno desde el archivo .env
 load_dotenv()
 
@@ -65,19 +68,22 @@ app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL') in ('True', 'true', '1')
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME') or 'sgsstflow@gmail.com'
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD') or 'ofut rtrw kiqk lzpr'
 
-# *** CONFIGURACIÓN Y TAREAS DEL SCHEDULER ***
-class SchedulerConfig:
-    SCHEDULER_API_ENABLED = True
-    # Revisa cada 5 minutos si hay formularios a automatizar
-    SCHEDULER_JOB_INTERVAL = 300 # en segundos (5 minutos)
-
-app.config.from_object(SchedulerConfig())
-scheduler = APScheduler()
+# La automatización de formularios ya no corre en el proceso web (APScheduler): la ejecuta
+# `flask automation-worker` (ver api/form_automation.py)
 
 # *** INICIALIZACIÓN DE EXTENSIONES ***
 jwt = JWTManager(app)
 mail = Mail(app)  # <--- Inicialización de Flask-Mail
 
+# Rechazar tokens revocados (logout, usuario desactivado, cambio de estado de la empresa) sin consultar la BD
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return token_revocado(jwt_payload)
+
+@jwt.revoked_token_loader
+def revoked_token_callback(jwt_header, jwt_payload):
+    return jsonify({"valid": False, "error": "La sesión ya no es válida. Inicia sesión nuevamente."}), 401
+
 # *** CONFIGURACIÓN DE CLOUDINARY ***
 cloudinary.config(
     cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
@@ -95,6 +101,21 @@ else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# *** LÍMITES DE CARGA (envíos multipart) ***
+# Los campos de texto del multipart (ej. la parte 'datos' de /envios-formulario) se guardan en memoria
+# hasta este tamaño; los archivos grandes se vuelcan a disco a medida que llegan.
+app.config['MAX_FORM_MEMORY_SIZE'] = int(os.getenv('MAX_FORM_MEMORY_SIZE', 4 * 1024 * 1024))
+if os.getenv('MAX_CONTENT_LENGTH'):
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH'))
+
+# *** ALMACENAMIENTO LOCAL (ALMACENAMIENTO=local) ***
+# Detrás de nginx/apache, X-Sendfile deja que el servidor web envíe los archivos de /api/archivos;
+# sin él, gunicorn usa os.sendfile a través de wsgi.file_wrapper.
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE') in ('True', 'true', '1')
+# Con almacenamiento local, ALMACENAMIENTO_URL_BASE es obligatoria
+verificar_almacenamiento()
+
 MIGRATE = Migrate(app, db, compare_type=True)
 db.init_app(app)
 
@@ -115,6 +136,28 @@ setup_commands(app)
 # Add all endpoints form the API with a "api" prefix
 app.register_blueprint(api, url_prefix='/api')
 
+# Plantillas de correo compiladas una sola vez por proceso
+precompilar_plantillas_correo()
+
+
+def iniciar_workers_web():
+    """
+    Hilos en segundo plano del servidor web. Se llama desde wsgi.py (gunicorn) y al ejecutar app.py,
+    no al importar la app: así los comandos `flask` (db upgrade, mail-worker, automation-worker,
+    benchmarks...) no arrancan sus propios workers.
+    """
+    # Subida diferida de imágenes: al arrancar se retoma la cola que haya quedado pendiente
+    if MEDIA_UPLOAD_MODO == 'diferido' and os.getenv('MEDIA_WORKER_EN_WEB', '1') == '1':
+        asegurar_worker_media(app)
+
+    # Bandeja de salida de correos: se retoman los que hayan quedado sin enviar antes del reinicio
+    if CORREO_WORKER_EN_WEB:
+        asegurar_worker_correo(app)
+
+    # Despachador de notificaciones programadas (recordatorios)
+    if NOTIFICACION_WORKER_EN_WEB:
+        asegurar_worker_notificaciones(app)
+
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
 def handle_invalid_usage(error):
@@ -136,42 +179,10 @@ def serve_any_other_file(path):
     response.cache_control.max_age = 0  # avoid cache memory
     return response
 
-# Esta función se ejecutará por el scheduler
-# Debe estar fuera del if __name__ == '__main__': para que el scheduler la encuentre
-# y necesita un `with app.app_context()` si accede a la base de datos
-def ejecutar_tareas_de_automatizacion():
-    with app.app_context():
-        print("✅ Scheduler: Ejecutando tarea de automatización...")
-        # Llama a la lógica de tu API para ejecutar la automatización.
-        # Asume que la función está en api.routes.
-        # Si tu función se llama 'ejecutar_automatizacion_formularios', la llamas así.
-        try:
-            from api.routes import ejecutar_automatizacion_formularios
-            result = ejecutar_automatizacion_formularios()
-            print(f"✅ Scheduler: Tarea de automatización completada. Resultado: {result.json}")
-        except Exception as e:
-            print(f"⚠️ Scheduler: Error en la tarea de automatización: {e}")
-
-
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3001))
-    
-    # === Inicia el scheduler solo en el entorno de producción ===
-    # En desarrollo, esto puede causar que la tarea se ejecute dos veces
-    # si el reloader de Flask está activo.
-    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-        scheduler.init_app(app)
-        scheduler.start()
-        
-        # Agrega la tarea al scheduler.
-        # Usamos `interval` para que revise cada 5 minutos.
-        # Tu lógica interna de la API decidirá si es la hora correcta para ejecutar.
-        scheduler.add_job(
-            id='ejecutar_automatizacion_formularios_job',
-            func=ejecutar_tareas_de_automatizacion,
-            trigger='interval',
-            minutes=5
-        )
-
+    # debug=True activa el reloader: solo en el proceso hijo que atiende las peticiones
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_workers_web()
     app.run(host='0.0.0.0', port=PORT, debug=True)
\ No newline at end of file
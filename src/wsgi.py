@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from app import app as application
+from app import app as application, iniciar_workers_web
+
+# Workers en segundo plano (correos, notificaciones, subida diferida) solo en el servidor web
+iniciar_workers_web()
 
 if __name__ == "__main__":
     application.run()